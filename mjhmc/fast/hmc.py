@@ -1,6 +1,7 @@
 import numpy as np
 import theano
 import theano.tensor as T
+from theano.ifelse import ifelse
 from collections import OrderedDict
 
 def simulate_dynamics(initial_pos, initial_vel, stepsize, n_steps, energy_fn):
@@ -166,9 +167,145 @@ def metropolis_hastings_accept(energy_prev, energy_next, s_rng):
     ediff = energy_prev - energy_next
     return (T.exp(ediff) - s_rng.uniform(size=energy_prev.shape)) >= 0
 
-def MJHMC_accept():
+def MJHMC_accept(H_curr, H_l, H_flf, p_r, s_rng):
+    """
+    Draws the next Markov jump transition of every particle from competing
+    exponential clocks for the L, F and R transitions.
+
+    Parameters
+    ----------
+    H_curr: theano vector
+        Hamiltonian of the current state of each particle.
+    H_l: theano vector
+        Hamiltonian of the L state of each particle.
+    H_flf: theano vector
+        Hamiltonian of the FLF (aka L^-1) state of each particle.
+    p_r: theano scalar
+        Rate of momentum randomization.
+    s_rng: theano.tensor.shared_randomstreams.RandomStreams
+        Theano shared random stream object used to draw the clocks.
+
+    Returns
+    -------
+    rval1: theano integer vector
+        Transition taken by each particle: 0 for L, 1 for F and 2 for R
+    rval2: theano vector
+        Dwelling time of each particle in its current state
+    """
+    l_rate = T.exp(0.5 * (H_curr - H_l))
+    flf_rate = T.exp(0.5 * (H_curr - H_flf))
+    f_rate = flf_rate - T.minimum(flf_rate, l_rate)
+    r_rate = p_r * T.ones_like(l_rate)
+    # [3, nbatch]
+    rates = T.stack([l_rate, f_rate, r_rate])
+    # exponential draws. a zero rate gives an infinite wait
+    draws = -T.log(s_rng.uniform(size=rates.shape)) / rates
+    return T.argmin(draws, axis=0), T.min(draws, axis=0)
+
+def mjhmc_move(s_rng, positions, velocities, flf_pos, flf_vel, flf_cached,
+               energy_fn, stepsize, n_steps, p_r):
+    """
+    This function performs one Markov jump HMC transition for every particle.
+    The L and FLF states are integrated, the transition is drawn with
+    `MJHMC_accept`, and the FLF cache is updated: after an L transition the
+    previous state is the FLF state of the new one.
+
+    Parameters
+    ----------
+    s_rng: theano shared random stream
+        Symbolic random number generator used for the clocks and for R.
+    positions: theano matrix
+        Current positions, [ndims, nbatch].
+    velocities: theano matrix
+        Current velocities, [ndims, nbatch].
+    flf_pos: theano matrix
+        Cached positions of the FLF state.
+    flf_vel: theano matrix
+        Cached velocities of the FLF state.
+    flf_cached: theano int8 vector
+        1 where the cached FLF state is valid.
+    energy_fn: python function
+        Python function, operating on symbolic theano variables, used to
+        compute the potential energy at a given position.
+    stepsize: theano scalar
+        Leapfrog step size.
+    n_steps: theano integer scalar
+        Number of leapfrog steps per application of L.
+    p_r: theano scalar
+        Rate of momentum randomization.
+
+    Returns
+    -------
+    rval: list of theano variables
+        new positions, new velocities, new FLF cache (positions, velocities, flags),
+        dwelling times, transitions taken and gradient evaluations per particle
+    """
+    H_curr = hamiltonian(positions, velocities, energy_fn).flatten()
+
+    l_pos, l_vel = simulate_dynamics(positions, velocities, stepsize, n_steps, energy_fn)
+
+    # the FLF trajectory is only integrated if some particle is missing from the cache
+    all_cached = T.all(flf_cached)
+    rev_pos, rev_vel = simulate_dynamics(positions, -velocities, stepsize, n_steps, energy_fn)
+    integrated_flf_pos, integrated_flf_vel = ifelse(all_cached,
+                                                   [flf_pos, -flf_vel],
+                                                   [rev_pos, rev_vel])
+    cached_mask = flf_cached.dimshuffle('x', 0)
+    curr_flf_pos = T.switch(cached_mask, flf_pos, integrated_flf_pos)
+    curr_flf_vel = T.switch(cached_mask, flf_vel, -integrated_flf_vel)
+
+    H_l = hamiltonian(l_pos, l_vel, energy_fn).flatten()
+    H_flf = hamiltonian(curr_flf_pos, curr_flf_vel, energy_fn).flatten()
+    transition, dwelling_time = MJHMC_accept(H_curr, H_l, H_flf, p_r, s_rng)
+
+    is_l = T.eq(transition, 0).dimshuffle('x', 0)
+    is_f = T.eq(transition, 1).dimshuffle('x', 0)
+    # beta is 1 for continuous time samplers: R fully randomizes the momentum
+    r_vel = s_rng.normal(size=velocities.shape)
+    new_pos = T.switch(is_l, l_pos, positions)
+    new_vel = T.switch(is_l, l_vel, T.switch(is_f, -velocities, r_vel))
+
+    # cache the current state as FLF state for particles that made the L transition
+    # and clear the cache for particles that transitioned to F or R
+    new_flf_pos = T.switch(is_l, positions, flf_pos)
+    new_flf_vel = T.switch(is_l, velocities, flf_vel)
+    new_flf_cached = T.eq(transition, 0).astype('int8')
+
+    # simulate_dynamics evaluates the gradient n_steps + 1 times
+    n_grads = (n_steps + 1) * (2 - all_cached)
+    return [new_pos, new_vel, new_flf_pos, new_flf_vel, new_flf_cached,
+            dwelling_time, transition, n_grads]
+
+def mjhmc_scan(s_rng, positions, velocities, flf_pos, flf_vel, flf_cached,
+               energy_fn, stepsize, n_steps, p_r, n_iterations):
+    """
+    Runs `mjhmc_move` for n_iterations inside a single scan, so that many sampling
+    iterations are done per call of the compiled function.
 
-    return
+    Returns
+    -------
+    rval1: list of theano variables
+        per iteration buffers of the outputs of `mjhmc_move`, followed by the
+        positions the particles dwelt in during each iteration [n_iterations, ndims, nbatch]
+    rval2: dictionary
+        updates for the random streams used inside the scan
+    """
+    def step(pos, vel, c_pos, c_vel, c_flag, stepsize, n_steps, p_r):
+        new_state = mjhmc_move(s_rng, pos, vel, c_pos, c_vel, c_flag,
+                               energy_fn, stepsize, n_steps, p_r)
+        # the recurrent states must keep their dtype across iterations
+        for idx, init in enumerate([pos, vel, c_pos, c_vel, c_flag]):
+            new_state[idx] = new_state[idx].astype(init.dtype)
+        # the state the particles dwelt in, to be paired with the dwelling times
+        return new_state + [pos.copy()]
+
+    outputs, scan_updates = theano.scan(
+        step,
+        outputs_info=[positions, velocities, flf_pos, flf_vel, flf_cached,
+                      None, None, None, None],
+        non_sequences=[stepsize, n_steps, p_r],
+        n_steps=n_iterations)
+    return outputs, scan_updates
 
 def hmc_move(s_rng, positions, energy_fn, stepsize=0.1, n_steps=1):
     """
@@ -330,6 +467,51 @@ def wrapper_hmc(s_rng,energy_fn,dim=np.array([2,1]),L=10, beta = 0.1, epsilon =
     return simulate
 
 
+def wrapper_mjhmc(s_rng, energy_fn, dim=np.array([2,1]), L=10, beta=0.1, epsilon=0.1,
+                  n_iterations=100):
+    """
+    Compiles a Markov Jump HMC sampler that runs n_iterations sampling iterations per call
+
+    Parameters:
+      Potential Energy -- function handle that captures the interest distrbution
+      Number of Leap Frog Steps -- L (10)
+      Momentum corruption parameter -- beta (0.1)
+      Leapfrog Integrator step length -- epsilon (0.1)
+      Sampling iterations per call -- n_iterations (100)
+    Returns:
+      simulate -- compiled function returning the samples [n_iterations, ndims, nbatch],
+        the time dwelt in each sample and the transition taken out of it [n_iterations, nbatch], and the gradient
+        evaluations per particle [n_iterations]. The particle states and the FLF cache are kept in
+        shared variables between calls
+    """
+    pos = np.random.randn(dim[0],dim[1]).astype('float32')
+    vel = np.random.randn(dim[0],dim[1]).astype('float32')
+    pos = theano.shared(pos,name='pos')
+    vel = theano.shared(vel,name='vel')
+    flf_pos = theano.shared(np.zeros((dim[0], dim[1]), dtype='float32'), name='flf_pos')
+    flf_vel = theano.shared(np.zeros((dim[0], dim[1]), dtype='float32'), name='flf_vel')
+    flf_cached = theano.shared(np.zeros(dim[1], dtype='int8'), name='flf_cached')
+    epsilon = theano.shared(np.float32(epsilon),name='epsilon')
+    L = theano.shared(L,'L')
+    # transformation from discrete beta to insure matching autocorrelation
+    p_r = np.float32(- np.log(1 - beta) * 0.5)
+
+    outputs, scan_updates = mjhmc_scan(s_rng, pos, vel, flf_pos, flf_vel, flf_cached,
+                                       energy_fn, epsilon, L, p_r, n_iterations)
+    (all_pos, all_vel, all_flf_pos, all_flf_vel, all_flf_cached,
+     dwelling_times, transitions, n_grads, samples) = outputs
+
+    simulate_updates = OrderedDict(scan_updates)
+    simulate_updates[pos] = all_pos[-1]
+    simulate_updates[vel] = all_vel[-1]
+    simulate_updates[flf_pos] = all_flf_pos[-1]
+    simulate_updates[flf_vel] = all_flf_vel[-1]
+    simulate_updates[flf_cached] = all_flf_cached[-1]
+    simulate = theano.function([], [samples, dwelling_times, transitions, n_grads],
+                               updates=simulate_updates)
+    return simulate
+
+
 def autocorrelation():
     X = T.tensor3().astype('float32')
     shape = X.shape
@@ -4,8 +4,6 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import json
 
-#from LAHMC import LAHMC
-
 from warnings import warn
 from mjhmc.search.find_best_params import write_all
 
@@ -27,7 +25,7 @@ def plot_ac(distribution, control_params, mjhmc_params, lahmc_params, max_steps=
     runs the sampler for max steps and then truncates the output to autocorrelation 0.5
     throws an error if ac 0.5 is not reached
     """
-    from mjhmc.samplers.markov_jump_hmc import MarkovJumpHMC, ControlHMC
+    from mjhmc.samplers.markov_jump_hmc import MarkovJumpHMC, ControlHMC, LAHMC
     from mjhmc.misc.autocor import calculate_autocorrelation, autocorrelation
     from mjhmc.misc.nutshell import sample_nuts_to_df
     # TODO: bring up to speed of DF-less calc autocor
@@ -49,11 +47,14 @@ def plot_ac(distribution, control_params, mjhmc_params, lahmc_params, max_steps=
                                          use_cached_var=True,
                                          **mjhmc_params)
 
-    # lahmc_ac = calculate_autocorrelation(LAHMC, distribution,
-    #                                      num_steps=max_steps,
-    #                                      sample_steps=sample_steps,
-    #                                      half_window=True,
-    #                                      **lahmc_params)
+    if lahmc_params is not None:
+        print('Calculating AutoCorrelation for LAHMC')
+        lahmc_ac = calculate_autocorrelation(LAHMC, distribution,
+                                             num_steps=max_steps,
+                                             sample_steps=sample_steps,
+                                             half_window=True,
+                                             use_cached_var=True,
+                                             **lahmc_params)
 
     if nuts:
         print('Calculating AutoCorrelation for NUTS')
@@ -78,6 +79,8 @@ def plot_ac(distribution, control_params, mjhmc_params, lahmc_params, max_steps=
             trunc_idx = truncate_idx
         control_ac = control_ac.loc[:trunc_idx]
         mjhmc_ac = mjhmc_ac.loc[:trunc_idx]
+        if lahmc_params is not None:
+            lahmc_ac = lahmc_ac.loc[:trunc_idx]
 
 
 
@@ -95,6 +98,9 @@ def plot_ac(distribution, control_params, mjhmc_params, lahmc_params, max_steps=
 
     control_ac['autocorrelation'].plot(label='Control HMC')
     mjhmc_ac['autocorrelation'].plot(label='Markov Jump HMC')
+    if lahmc_params is not None:
+        lahmc_ac.index = lahmc_ac['num grad']
+        lahmc_ac['autocorrelation'].plot(label='Look Ahead HMC')
 
     plt.xlabel("Gradient Evaluations")
     plt.ylabel("Autocorrelation")
@@ -133,11 +139,13 @@ def load_params(distribution, update_best=False):
         print("Encountered error: {}".format(io_err))
         mjhmc_params = None
 
+    try:
+        with open("{}/mjhmc/search/LAHMC_{}/{}".format(prefix, extension, file_name), 'r') as lahmc:
+            lahmc_params = json.load(lahmc)
+    except IOError as io_err:
+        print("Encountered error: {}".format(io_err))
+        lahmc_params = None
 
-
-#    with open("../search/LAHMC_{}/{}".format(extension, file_name), 'r') as lahmc:
- #       lahmc_params = json.load(lahmc)
-    lahmc_params = None
     return control_params, mjhmc_params, lahmc_params
 
 def plot_best(distribution, num_steps=100000, update_params=False, **kwargs):
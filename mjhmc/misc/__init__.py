@@ -1,7 +1,7 @@
 """
  Initialization and import management for misc subpackage
 """
-__all__ = ['autocor', 'distributions',
+__all__ = ['autocor', 'distributions', 'metrics',
            'mixing', 'plotting', 'nutshell', 'utils', 'gen_mj_init']
 
 # import mjhmc.misc.autocor
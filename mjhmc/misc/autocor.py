@@ -1,10 +1,41 @@
 """
 This module contains utilities for computing the autocorrelation of a sequence of samples
 """
-import pandas as pd
-from mklfft.fftpack import fftn, ifftn
 import numpy as np
+from multiprocessing.pool import ThreadPool
 from time import time
+try:
+    from mklfft.fftpack import rfft, irfft
+    SINGLE_PRECISION_FFT = False
+except ImportError:
+    try:
+        # keeps single precision, unlike numpy.fft
+        from scipy.fft import rfft, irfft
+        SINGLE_PRECISION_FFT = True
+    except ImportError:
+        from numpy.fft import rfft, irfft
+        SINGLE_PRECISION_FFT = False
+
+def power_spectrum_lags(samples, n_fft):
+    """ Returns the lagged products of samples summed over all but the last axis,
+    from real transforms of length n_fft
+    """
+    fft_samples = rfft(samples, n=n_fft, axis=-1)
+    power = np.sum(fft_samples.real ** 2 + fft_samples.imag ** 2, axis=(0, 1))
+    return irfft(power, n=n_fft)
+
+def transform_bytes(n_fft, dtype):
+    """ Returns the bytes used to transform one sequence: a padded real copy and a
+    half length complex transform. only scipy.fft keeps dtype, the other backends
+    transform in double precision
+    """
+    itemsize = np.dtype(dtype).itemsize if SINGLE_PRECISION_FFT else 8
+    return (n_fft + 2) * itemsize * 2
+
+# bound on the memory used by the transforms of a chunk of dimensions in fft_autocor
+AUTOCOR_CHUNK_BYTES = 64 * 2 ** 20
+# bound on the memory first allocated for the samples of generate_samples with a grad budget
+SAMPLE_BUFFER_BYTES = 256 * 2 ** 20
 
 
 
@@ -34,20 +65,236 @@ def calculate_autocorrelation(sampler, distribution,
     print "Calculating autocorrelation..."
     return autocorrelation(samples, e_evals, grad_evals, half_window, cached_var=cached_var)
 
-def fft_autocor(samples):
+def fast_length(n):
+    """ Returns the smallest length of at least n whose only prime factors are 2, 3 and 5,
+    for which FFTs are fast
+    """
+    best = 2 ** int(np.ceil(np.log2(n)))
+    power_5 = 1
+    while power_5 < best:
+        power_35 = power_5
+        while power_35 < best:
+            # smallest power of 2 times power_35 that is at least n
+            length = power_35 * 2 ** max(int(np.ceil(np.log2(n / float(power_35)))), 0)
+            best = min(best, length)
+            power_35 *= 3
+        power_5 *= 5
+    return best
+
+def lag_sums(samples, max_lag, dtype=np.float64):
+    """ Sums the lagged products of samples over dimensions, particles and time
+    with FFTs, zero padded so that the sequences do not wrap around
+
+    Args:
+      samples: array of samples - [n_dims, n_batch, n_samples]
+      max_lag: largest lag to compute
+      dtype: float type of the transforms
+
+    Returns:
+      sums: sum of samples[:, :, :-lag] * samples[:, :, lag:] for each lag - [max_lag + 1]
+    """
+    n_fft = fast_length(samples.shape[-1] + max_lag)
+    lags = power_spectrum_lags(np.asarray(samples, dtype=dtype), n_fft)
+    return lags[:max_lag + 1].astype(np.float64)
+
+def fft_autocor(samples, max_lag=None, dtype=np.float64, chunk_bytes=AUTOCOR_CHUNK_BYTES,
+                n_threads=None):
     """ Calculate autocorrelation using the cross-correlation theorem
+    Matches slow_autocorrelation: the lagged products are averaged over the pairs of samples
+      that are lag apart, assuming zero mean, and normalized by the value at lag 0
+    Dimensions are read and transformed in chunks of at most chunk_bytes, so the memory used
+      does not grow with the number of dimensions, and samples can be a memory-mapped array
+      larger than memory
 
     Args:
       samples: array of samples - [n_dims, n_batch, n_samples]
+      max_lag: largest lag to compute. defaults to n_samples - 1
+      dtype: float type of the transforms. np.float32 halves the memory when scipy.fft
+         is available. the other backends transform in double precision regardless
+      chunk_bytes: bound on the size of the transforms of a chunk of dimensions
+      n_threads: Optional. number of chunks to transform at once in a thread pool.
+         each thread holds a chunk in memory
 
     Returns:
-       autocor: [n_samples]
+       autocor: [max_lag + 1]
     """
     assert samples.ndim == 3
-    fft_samples = fftn(samples, axes=[-1])
-    fft_ac = np.real(np.mean(ifftn(fft_samples * np.conj(fft_samples), axes=[-1]), axis=(0, 1)))
-    return fft_ac / fft_ac[0]
+    n_dims, n_batch, n_samples = samples.shape
+    if max_lag is None:
+        max_lag = n_samples - 1
+    n_fft = fast_length(n_samples + max_lag)
+    dim_bytes = n_batch * transform_bytes(n_fft, dtype)
+    chunk_size = max(1, int(chunk_bytes // dim_bytes))
+
+    def chunk_sums(start):
+        """ lag sums of the chunk of dimensions starting at start
+        """
+        return lag_sums(samples[start:start + chunk_size], max_lag, dtype)
+
+    starts = xrange(0, n_dims, chunk_size)
+    sums = np.zeros(max_lag + 1)
+    if n_threads is None or n_threads <= 1:
+        for start in starts:
+            sums += chunk_sums(start)
+    else:
+        pool = ThreadPool(n_threads)
+        try:
+            # in order, so that the result does not depend on the scheduling
+            for chunk_sum in pool.imap(chunk_sums, starts):
+                sums += chunk_sum
+        finally:
+            pool.terminate()
+    # mean over the pairs lag apart
+    sums /= n_samples - np.arange(max_lag + 1)
+    return sums / sums[0]
+
+def memmap_autocor(path, shape, sample_dtype=np.float64, offset=0, **kwargs):
+    """ Calculate the autocorrelation of a sample archive on disk with fft_autocor,
+    reading one chunk of dimensions at a time
+
+    Args:
+      path: path of the raw C ordered sample array, eg written through np.memmap
+      shape: shape of the archive - (n_dims, n_batch, n_samples)
+      sample_dtype: type of the archived samples
+      offset: bytes before the start of the array in the file
+      kwargs: the keyword arguments of fft_autocor
+
+    Returns:
+       autocor: [max_lag + 1]
+    """
+    samples = np.memmap(path, dtype=sample_dtype, mode='r', shape=tuple(shape), offset=offset)
+    return fft_autocor(samples, **kwargs)
+
+
+class StreamingAutocorrelation(object):
+    """ Accumulates the autocorrelation of a sequence of samples up to max_lag as they are drawn
+    Only the last max_lag samples are kept, in a circular buffer, so the memory used does not
+      grow with the length of the sequence
+    """
+
+    def __init__(self, n_dims, n_batch, max_lag):
+        """ Creates an empty accumulator
+
+        :param n_dims: number of dimensions of a sample
+        :param n_batch: number of particles
+        :param max_lag: largest lag to accumulate
+        :returns: a new accumulator
+        :rtype: StreamingAutocorrelation
+        """
+        self.n_dims = n_dims
+        self.n_batch = n_batch
+        self.max_lag = max_lag
+        # sample n_seen - lag is at index (n_seen - lag) % max_lag
+        self.buffer = np.zeros((n_dims, n_batch, max(max_lag, 1)))
+        self.n_seen = 0
+        # sums and numbers of the products of samples lag apart
+        self.sums = np.zeros(max_lag + 1)
+        self.counts = np.zeros(max_lag + 1)
+
+    def history(self):
+        """ Returns the buffered samples in the order they were drawn - [n_dims, n_batch, n_history]
+        """
+        n_history = min(self.n_seen, self.max_lag)
+        idx = np.arange(self.n_seen - n_history, self.n_seen) % self.buffer.shape[-1]
+        return self.buffer[:, :, idx]
+
+    def update(self, X):
+        """ Adds the next sample
+
+        :param X: the states of the particles - [n_dims, n_batch]
+        :returns: None
+        :rtype: None
+        """
+        n_history = min(self.n_seen, self.max_lag)
+        lags = np.arange(1, n_history + 1)
+        # products with every buffered sample, then indexed by lag
+        buffer_sums = np.tensordot(X, self.buffer, axes=([0, 1], [0, 1]))
+        self.sums[lags] += buffer_sums[(self.n_seen - lags) % self.buffer.shape[-1]]
+        self.counts[lags] += 1
+        self.sums[0] += np.sum(X ** 2)
+        self.counts[0] += 1
+        if self.max_lag > 0:
+            self.buffer[:, :, self.n_seen % self.max_lag] = X
+        self.n_seen += 1
+
+    def update_block(self, samples, dtype=np.float64):
+        """ Adds a block of consecutive samples with FFTs
+        Faster than calling update for each sample when the block is long
+
+        :param samples: the next samples - [n_dims, n_batch, n_samples]
+        :param dtype: float type of the transforms
+        :returns: None
+        :rtype: None
+        """
+        n_samples = samples.shape[-1]
+        history = self.history()
+        n_history = history.shape[-1]
+        joined = np.concatenate((history, samples), axis=-1)
+        # the pairs within the history were counted when it was added
+        self.sums += lag_sums(joined, self.max_lag, dtype)
+        if n_history > 0:
+            self.sums -= lag_sums(history, self.max_lag, dtype)
+        lags = np.arange(self.max_lag + 1)
+        self.counts += (np.maximum(n_history + n_samples - lags, 0) -
+                        np.maximum(n_history - lags, 0))
+        # the last max_lag samples of joined, in their slots of the buffer
+        n_keep = min(joined.shape[-1], self.max_lag)
+        if n_keep > 0:
+            n_total = self.n_seen + n_samples
+            idx = np.arange(n_total - n_keep, n_total) % self.max_lag
+            self.buffer[:, :, idx] = joined[:, :, -n_keep:]
+        self.n_seen += n_samples
+
+    def autocorrelation(self):
+        """ Returns the autocorrelation of the samples so far, assuming zero mean
+        Matches fft_autocor of all of the samples, up to the lags seen so far
+
+        :returns: autocorrelation at lags 0 to min(max_lag, n_seen - 1) - [n_lags]
+        :rtype: array
+        """
+        n_lags = min(self.max_lag + 1, self.n_seen)
+        means = self.sums[:n_lags] / self.counts[:n_lags]
+        return means / means[0]
+
+
+def stream_autocorrelation(sampler, distribution, max_lag, num_steps=None,
+                           num_grad_steps=None, **kwargs):
+    """ Runs sampler and accumulates the autocorrelation of its samples as they are drawn,
+    in place of generate_samples and autocorrelation, so that chains of any length fit in memory
+
+    Args:
+       sampler: sampler class
+       distribution: distribution object
+       max_lag: largest lag to compute
+       num_steps: number of desired steps - optional
+       num_grad_steps: number of desired grad steps - optional
+
+    Returns:
+       (autocor - [max_lag + 1]
+        e_evals - [max_lag + 1]
+        grad_evals - [max_lag + 1])
+    """
+    assert (((num_steps is None) and (num_grad_steps is not None)) or
+            (num_steps is not None) and (num_grad_steps is None))
+    smp = sampler(distribution=distribution, **kwargs)
+    num_steps = num_steps or num_grad_steps / smp.grad_per_sample_step + 100
+
+    accumulator = StreamingAutocorrelation(distribution.ndims, distribution.nbatch, max_lag)
+    # evaluations per particle at the first max_lag + 1 samples, as in generate_samples
+    grad_evals = np.zeros(max_lag + 1)
+    e_evals = np.zeros(max_lag + 1)
 
+    distribution.reset()
+    for t_idx in xrange(num_steps):
+        accumulator.update(smp.sample(1))
+        if t_idx <= max_lag:
+            grad_evals[t_idx] = distribution.dEdX_count / float(distribution.nbatch)
+            e_evals[t_idx] = distribution.E_count / float(distribution.nbatch)
+        if (num_grad_steps is not None and
+                distribution.dEdX_count / float(distribution.nbatch) >= num_grad_steps):
+            break
+    autocor = accumulator.autocorrelation()
+    return autocor, e_evals[:len(autocor)], grad_evals[:len(autocor)]
 
 def autocorrelation(samples, e_evals, grad_evals, half_window=True,
                     normalize=True, cached_var=None, brute_force=False,
@@ -229,11 +476,14 @@ def generate_samples(sampler, distribution, num_steps=None, num_grad_steps=None,
     assert (((num_steps is None) and (num_grad_steps is not None)) or
             (num_steps is not None) and (num_grad_steps is None))
     smp = sampler(distribution=distribution, **kwargs)
-    # fudge factor because grad per sampler step is only approximate
-    num_steps = num_steps or num_grad_steps / smp.grad_per_sample_step + 100
-
     n_dims = distribution.ndims
     n_batch = distribution.nbatch
+    if num_steps is None:
+        # grad per sampler step is only approximate, eg for NUTS it is unknown
+        #  before sampling. the buffer grows until the grad budget is reached
+        num_steps = min(num_grad_steps / smp.grad_per_sample_step + 100,
+                        max(SAMPLE_BUFFER_BYTES / (8 * n_dims * n_batch), 1))
+
     # [n_dims, n_batch, num_steps]
     samples = np.zeros((n_dims, n_batch, num_steps))
 
@@ -242,23 +492,23 @@ def generate_samples(sampler, distribution, num_steps=None, num_grad_steps=None,
 
     # reset counters
     distribution.reset()
-    for t_idx in range(num_steps):
+    t_idx = 0
+    while t_idx < samples.shape[-1]:
         samples[:, :, t_idx] = smp.sample(1)
         grad_evals[t_idx] = distribution.dEdX_count / float(n_batch)
         e_evals[t_idx] = distribution.E_count / float(n_batch)
 
-        if (num_grad_steps is not None) and grad_evals[t_idx] >= num_grad_steps:
-            samples = samples[:, :, :t_idx + 1]
-            grad_evals = grad_evals[:t_idx + 1]
-            e_evals = e_evals[:t_idx + 1]
-            return samples, e_evals, grad_evals
-
-    if num_grad_steps is not None:
-        assert grad_evals[-1] >= num_grad_steps
-        grad_sel = (grad_evals <= num_grad_steps)
-        return samples[:, :, grad_sel], e_evals[grad_sel], grad_evals[grad_sel]
-    else:
-        return samples, e_evals, grad_evals
+        if num_grad_steps is not None:
+            if grad_evals[t_idx] >= num_grad_steps:
+                samples = samples[:, :, :t_idx + 1]
+                grad_evals = grad_evals[:t_idx + 1]
+                e_evals = e_evals[:t_idx + 1]
+                return samples, e_evals, grad_evals
+            if t_idx == samples.shape[-1] - 1:
+                samples, e_evals, grad_evals = [np.concatenate((arr, np.zeros_like(arr)), axis=-1)
+                                                for arr in (samples, e_evals, grad_evals)]
+        t_idx += 1
+    return samples, e_evals, grad_evals
 
 
 def sample_to_df(sampler, distribution, num_steps=None, num_grad_steps=None,
@@ -272,15 +522,17 @@ def sample_to_df(sampler, distribution, num_steps=None, num_grad_steps=None,
     num_steps: number of sampling steps
     num_grad_steps: number of target grad steps, can either specify steps or grads, not both
     """
+    import pandas as pd
     # ridiculous assert to make sure only one of them is ever None
     assert (((num_steps is None) and (num_grad_steps is not None)) or
             (num_steps is not None) and (num_grad_steps is None))
     smp = sampler(distribution=distribution, **kwargs)
-    # fudge factor because grad per sampler step is only approximate
-    num_steps = num_steps or num_grad_steps / smp.grad_per_sample_step + 100
     # {time : {'X': samples, 'num grad' dEdX evals, 'num energy': E evals}}
     recs = {}
     smp.burn_in()
+    # fudge factor because grad per sampler step is only approximate
+    #  estimated after burn in, as NUTS only knows it once it has sampled
+    num_steps = num_steps or num_grad_steps / smp.grad_per_sample_step + 100
     distribution.reset()
     for t in xrange(num_steps):
         recs[t] = {
@@ -188,7 +188,7 @@ def check_variance():
     poe = ProductOfT(nbatch=1000, ndims=36, nbasis=36)
     var_estimates = []
     for trial_idx in xrange(100):
-        _, var_estimate = generate_initialization(poe.reset())
+        _, var_estimate, _, _ = generate_initialization(poe.reset())
         var_estimates.append(var_estimate)
         with open("var_log.txt", 'a') as vlog:
             vlog.write("Trial {} variance {}\n".format(trial_idx, var_estimate))
@@ -5,10 +5,8 @@
  distributions should inherit from Distribution
 """
 import numpy as np
-from .utils import overrides, package_path
-import os
+from .utils import overrides, stable_digest
 from scipy import stats
-import pickle
 
 class Distribution(object):
     """
@@ -80,18 +78,55 @@ class Distribution(object):
         """
         raise NotImplementedError()
 
-    def __hash__(self):
-        """ Subclasses should implement this as the hash of the tuple of all parameters
+    def E_dEdX(self, X):
+        self.E_count += X.shape[1]
+        self.dEdX_count += X.shape[1]
+        return self.E_dEdX_val(X)
+
+    def E_dEdX_val(self, X):
+        """
+        Returns the energy and its gradient at X
+        Subclasses may override this to compute both in a single pass
+        """
+        return self.E_val(X), self.dEdX_val(X)
+
+    def cache_params(self):
+        """ Subclasses should implement this as the tuple of all parameters
         that effect the distribution, including ndims. This is very important!!
-        nbatch should not be part of the hash!! Including it will break everything
+        nbatch should not be part of the parameters!! Including it will break everything
 
-        As an example, see how this is implemented in Gaussian
+        The parameters label the cached fair initialization of the distribution, so
+         they must be numbers, strings, numpy arrays, scipy.sparse matrices or
+         tuples of these, whose digest is the same in every process.
+        As an example, see how this is implemented in DiagonalGaussian
 
-        :returns: a hash of the relevant parameters of self
-        :rtype: int
+        :returns: the relevant parameters of self
+        :rtype: tuple
         """
         raise NotImplementedError()
 
+    def digest(self):
+        """ Returns a stable digest of the class and cache_params of self
+        Identical in every process, unlike the hash of strings
+
+        :returns: hex digest
+        :rtype: string
+        """
+        return stable_digest((type(self).__name__, self.cache_params()))
+
+    def __hash__(self):
+        return int(self.digest()[:15], 16)
+
+    def legacy_hash(self):
+        """ Returns the hash that named the initialization of self in the old
+         '{class}_{hash}.pickle' format, so that the shipped pickles are still found.
+        Subclasses with shipped pickles reproduce the old python 2 __hash__ here
+
+        :returns: the old hash, or None if there is no legacy initialization to look for
+        :rtype: int or None
+        """
+        return None
+
 
     def init_X(self):
         """
@@ -104,50 +139,60 @@ class Distribution(object):
     def cached_init_X(self):
         """ Sets self.Xinit to cached (serialized) initial states for continuous-time samplers, generated by burn in
         *For use with continuous-time samplers only*
+        If no initialization has been cached yet, one is generated. Concurrent processes
+         needing the same initialization wait for a single one of them to generate it
 
         :returns: None
         :rtype: none
         """
-        distr_name = type(self).__name__
-        distr_hash = hash(self)
-        file_name = '{}_{}.pickle'.format(distr_name, distr_hash)
-        file_prefix = '{}/initializations'.format(package_path())
-        if file_name in os.listdir(file_prefix):
-            with open('{}/{}'.format(file_prefix, file_name), 'rb') as cache_file:
-                mjhmc_endpt, _, _, control_endpt  = pickle.load(cache_file)
-                if self.mjhmc:
-                    self.Xinit = mjhmc_endpt[:, :self.nbatch]
-                else:
-                    self.Xinit = control_endpt[:, :self.nbatch]
+        from .init_cache import get_initialization, initialization_lock
+        init = get_initialization(self)
+        if init is None:
+            with initialization_lock(self):
+                # may have been generated while we waited for the lock
+                init = get_initialization(self)
+                if init is None:
+                    self.generate_cached_init()
+                    init = get_initialization(self)
+        mjhmc_endpt, control_endpt, _ = init
+        if self.mjhmc:
+            self.Xinit = np.array(mjhmc_endpt[:, :self.nbatch])
         else:
-            from mjhmc.misc.gen_mj_init import MAX_N_PARTICLES, cache_initialization
-            # modify this object so it can be used by gen_mj_init
-            old_nbatch = self.nbatch
-            self.nbatch = self.max_n_particles or MAX_N_PARTICLES
-            self.generation_instance = True
-
-            # must rebuild now that nbatch is changed back
-            if self.backend == 'tensorflow':
-                self.build_graph()
-
-            # start with biased initializations
-            # changes self.nbatch
-            try:
-                self.gen_init_X()
-            except NotImplementedError:
-                # completely arbitrary choice
-                self.Xinit = np.random.randn(self.ndims, self.nbatch)
-
-            #generate and cache fair initialization
-            cache_initialization(self)
-            # reconstruct this object using fair initialization
-            self.nbatch = old_nbatch
-            self.generation_instance = False
-            # must rebuild now that nbatch is changed back
-            if self.backend == 'tensorflow':
-                 self.build_graph()
-            self.cached_init_X()
+            self.Xinit = np.array(control_endpt[:, :self.nbatch])
+
+    def generate_cached_init(self):
+        """ Generates and caches a fair initialization for this distribution by burning in
+        Not user facing. Called by cached_init_X
 
+        :returns: None
+        :rtype: None
+        """
+        from mjhmc.misc.gen_mj_init import MAX_N_PARTICLES, cache_initialization
+        # modify this object so it can be used by gen_mj_init
+        old_nbatch = self.nbatch
+        self.nbatch = self.max_n_particles or MAX_N_PARTICLES
+        self.generation_instance = True
+
+        # switch to the ops for the new nbatch. only built if they depend on it
+        if self.backend == 'tensorflow':
+            self.build_graph()
+
+        # start with biased initializations
+        # changes self.nbatch
+        try:
+            self.gen_init_X()
+        except NotImplementedError:
+            # completely arbitrary choice
+            self.Xinit = np.random.randn(self.ndims, self.nbatch)
+
+        #generate and cache fair initialization
+        cache_initialization(self)
+        # reconstruct this object using fair initialization
+        self.nbatch = old_nbatch
+        self.generation_instance = False
+        # switch back to the ops for the old nbatch
+        if self.backend == 'tensorflow':
+            self.build_graph()
 
 
     def gen_init_X(self):
@@ -184,15 +229,15 @@ class Distribution(object):
          estimated variances associated with this
          distribution. Throws an error if the cache does not exist
 
-        :returns: the loaded cache: (fair_initialization, emc_var_estimate, true_var_estimate)
-        :rtype: (np.ndarray, float, float)
+        :returns: the loaded cache: (mjhmc_initialization, emc_var_estimate, true_var_estimate, control_initialization)
+        :rtype: (np.ndarray, float, float, np.ndarray)
         """
-        distr_name = type(self).__name__
-        distr_hash = hash(self)
-        file_name = '{}_{}.pickle'.format(distr_name, distr_hash)
-        file_prefix = '{}/initializations'.format(package_path())
-        with open('{}/{}'.format(file_prefix, file_name)) as cache_file:
-            return pickle.load(cache_file)
+        from .init_cache import get_initialization, entry_path
+        init = get_initialization(self)
+        if init is None:
+            raise IOError("No cached initialization at {}".format(entry_path(self)))
+        mjhmc_endpt, control_endpt, meta = init
+        return mjhmc_endpt, meta['emc_var_estimate'], meta['true_var_estimate'], control_endpt
 
 
 class LambdaDistribution(Distribution):
@@ -204,7 +249,7 @@ class LambdaDistribution(Distribution):
 
     You should give your LambdaDistribution objects a name. Use a
     descriptive name, and use the same for functionally equivalent
-    LambdaDistributions - the hash of the name is used to label the
+    LambdaDistributions - the digest of the name is used to label the
     initialization information which is generated at first run time of
     a new distribution. This requirement is a side effect of the
     unfortunate fact that there is no computable hash function which
@@ -247,38 +292,205 @@ class LambdaDistribution(Distribution):
         self.Xinit = self.init
 
     @overrides(Distribution)
-    def __hash__(self):
-        return hash((self.ndims, self.nbatch, self.name))
+    def cache_params(self):
+        return (self.ndims, self.nbatch, self.name)
+
+
+
+
+class DiagonalGaussian(Distribution):
+    """ Gaussian with a diagonal precision matrix
+    Energy and gradient cost O(ndims) per particle
+    """
+
+    def __init__(self, precision, nbatch=100):
+        """ Creates a zero mean Gaussian with precision matrix diag(precision)
+
+        :param precision: diagonal of the precision matrix - [ndims]
+        :param nbatch: the number of sampling particles to run simultaneously
+        :returns: a DiagonalGaussian object
+        :rtype: DiagonalGaussian
+        """
+        self.precision = np.asarray(precision, dtype=float).ravel()
+        super(DiagonalGaussian, self).__init__(len(self.precision), nbatch)
 
+    @property
+    def J(self):
+        """ Dense precision matrix. Only use for small ndims
+        """
+        return np.diag(self.precision)
+
+    @overrides(Distribution)
+    def E_val(self, X):
+        return np.sum(self.precision.reshape((-1, 1)) * X**2, axis=0).reshape((1, -1)) / 2.
+
+    @overrides(Distribution)
+    def dEdX_val(self, X):
+        return self.precision.reshape((-1, 1)) * X
 
+    @overrides(Distribution)
+    def gen_init_X(self):
+        self.Xinit = (1. / np.sqrt(self.precision).reshape((-1, 1))) * np.random.randn(self.ndims, self.nbatch)
 
+    @overrides(Distribution)
+    def cache_params(self):
+        return (self.ndims, self.precision)
 
-class Gaussian(Distribution):
+class Gaussian(DiagonalGaussian):
     def __init__(self, ndims=2, nbatch=100, log_conditioning=6):
         """
         Energy function, gradient, and hyperparameters for the "ill
         conditioned Gaussian" example from the LAHMC paper.
         """
         self.conditioning = 10**np.linspace(-log_conditioning, 0, ndims)
-        self.J = np.diag(self.conditioning)
         self.description = '%dD Anisotropic Gaussian, %g self.conditioning'%(ndims, 10**log_conditioning)
-        super(Gaussian, self).__init__(ndims, nbatch)
+        super(Gaussian, self).__init__(self.conditioning, nbatch)
+
+class LowRankGaussian(Distribution):
+    """ Gaussian with a low rank plus diagonal precision matrix diag(diag) + U U^T
+    Energy and gradient cost O(ndims * rank) per particle
+    """
+
+    def __init__(self, diag, factor, nbatch=100):
+        """ Creates a zero mean Gaussian with precision matrix diag(diag) + factor factor^T
+
+        :param diag: diagonal part of the precision matrix. must be positive - [ndims]
+        :param factor: low rank factor of the precision matrix - [ndims, rank]
+        :param nbatch: the number of sampling particles to run simultaneously
+        :returns: a LowRankGaussian object
+        :rtype: LowRankGaussian
+        """
+        self.diag = np.asarray(diag, dtype=float).ravel()
+        self.factor = np.asarray(factor, dtype=float).reshape((len(self.diag), -1))
+        self.rank = self.factor.shape[1]
+        super(LowRankGaussian, self).__init__(len(self.diag), nbatch)
+
+    @property
+    def J(self):
+        """ Dense precision matrix. Only use for small ndims
+        """
+        return np.diag(self.diag) + np.dot(self.factor, self.factor.T)
 
     @overrides(Distribution)
     def E_val(self, X):
-        return np.sum(X*np.dot(self.J,X), axis=0).reshape((1,-1))/2.
+        UtX = np.dot(self.factor.T, X)
+        return (np.sum(self.diag.reshape((-1, 1)) * X**2, axis=0) +
+                np.sum(UtX**2, axis=0)).reshape((1, -1)) / 2.
 
     @overrides(Distribution)
     def dEdX_val(self, X):
-        return np.dot(self.J,X)/2. + np.dot(self.J.T,X)/2.
+        return self.diag.reshape((-1, 1)) * X + np.dot(self.factor, np.dot(self.factor.T, X))
 
     @overrides(Distribution)
     def gen_init_X(self):
-        self.Xinit = (1./np.sqrt(self.conditioning).reshape((-1,1))) * np.random.randn(self.ndims,self.nbatch)
+        # J = D^1/2 (I + A A^T) D^1/2 with A = D^-1/2 U = Q S R^T
+        # so J^-1/2 = D^-1/2 (I + Q (1 / sqrt(1 + S^2) - 1) Q^T) is applied in O(ndims * rank)
+        inv_sqrt_diag = 1. / np.sqrt(self.diag).reshape((-1, 1))
+        Q, S, _ = np.linalg.svd(inv_sqrt_diag * self.factor, full_matrices=False)
+        Z = np.random.randn(self.ndims, self.nbatch)
+        shrink = (1. / np.sqrt(1. + S**2) - 1.).reshape((-1, 1))
+        self.Xinit = inv_sqrt_diag * (Z + np.dot(Q, shrink * np.dot(Q.T, Z)))
 
     @overrides(Distribution)
-    def __hash__(self):
-        return hash((self.ndims, hash(tuple(self.conditioning))))
+    def cache_params(self):
+        return (self.ndims, self.rank, self.diag, self.factor)
+
+class BandedGaussian(Distribution):
+    """ Gaussian with a symmetric banded precision matrix
+    Energy and gradient cost O(ndims * bandwidth) per particle
+    """
+
+    def __init__(self, bands, nbatch=100):
+        """ Creates a zero mean Gaussian with a banded precision matrix
+
+        :param bands: upper triangle of the precision matrix in the upper form used by
+          scipy.linalg.cholesky_banded, ie bands[u + i - j, j] = J[i, j] for i <= j
+          the main diagonal is the last row - [bandwidth + 1, ndims]
+        :param nbatch: the number of sampling particles to run simultaneously
+        :returns: a BandedGaussian object
+        :rtype: BandedGaussian
+        """
+        self.bands = np.atleast_2d(np.asarray(bands, dtype=float))
+        self.bandwidth = self.bands.shape[0] - 1
+        super(BandedGaussian, self).__init__(self.bands.shape[1], nbatch)
+
+    @property
+    def J(self):
+        """ Dense precision matrix. Only use for small ndims
+        """
+        J = np.diag(self.bands[-1])
+        for offset in xrange(1, self.bandwidth + 1):
+            upper = np.diag(self.bands[-1 - offset, offset:], offset)
+            J += upper + upper.T
+        return J
+
+    def J_dot(self, X):
+        """ Product of the precision matrix with X, one shifted product per diagonal
+        """
+        JX = self.bands[-1].reshape((-1, 1)) * X
+        for offset in xrange(1, self.bandwidth + 1):
+            band = self.bands[-1 - offset, offset:].reshape((-1, 1))
+            JX[:-offset] += band * X[offset:]
+            JX[offset:] += band * X[:-offset]
+        return JX
+
+    @overrides(Distribution)
+    def E_val(self, X):
+        return np.sum(X * self.J_dot(X), axis=0).reshape((1, -1)) / 2.
+
+    @overrides(Distribution)
+    def dEdX_val(self, X):
+        return self.J_dot(X)
+
+    @overrides(Distribution)
+    def gen_init_X(self):
+        from scipy.linalg import cholesky_banded, solve_banded
+        # J = C^T C with C upper banded, so C^-1 z has covariance J^-1
+        chol = cholesky_banded(self.bands)
+        self.Xinit = solve_banded((0, self.bandwidth), chol,
+                                  np.random.randn(self.ndims, self.nbatch))
+
+    @overrides(Distribution)
+    def cache_params(self):
+        return (self.ndims, self.bandwidth, self.bands)
+
+class SparseGaussian(Distribution):
+    """ Gaussian with a scipy.sparse precision matrix
+    Energy and gradient cost O(nnz(J)) per particle
+    """
+
+    def __init__(self, J, nbatch=100):
+        """ Creates a zero mean Gaussian with a sparse precision matrix
+
+        :param J: precision matrix. any scipy.sparse matrix or dense array.
+          it is symmetrized and stored in CSR format
+        :param nbatch: the number of sampling particles to run simultaneously
+        :returns: a SparseGaussian object
+        :rtype: SparseGaussian
+        """
+        from scipy import sparse
+        J = sparse.csr_matrix(J, dtype=float)
+        self.J = ((J + J.T) / 2.).tocsr()
+        self.J.sum_duplicates()
+        self.J.sort_indices()
+        super(SparseGaussian, self).__init__(self.J.shape[0], nbatch)
+
+    @overrides(Distribution)
+    def E_val(self, X):
+        return np.sum(X * self.J.dot(X), axis=0).reshape((1, -1)) / 2.
+
+    @overrides(Distribution)
+    def dEdX_val(self, X):
+        return self.J.dot(X)
+
+    @overrides(Distribution)
+    def gen_init_X(self):
+        # biased: matches only the conditional variances. burned in by gen_mj_init
+        self.Xinit = (1. / np.sqrt(self.J.diagonal()).reshape((-1, 1))) * np.random.randn(self.ndims, self.nbatch)
+
+    @overrides(Distribution)
+    def cache_params(self):
+        return (self.ndims, self.J)
 
 class RoughWell(Distribution):
     def __init__(self, ndims=2, nbatch=100, scale1=100, scale2=4):
@@ -308,42 +520,103 @@ class RoughWell(Distribution):
         self.Xinit = self.scale1 * np.random.randn(self.ndims, self.nbatch)
 
     @overrides(Distribution)
-    def __hash__(self):
-        return hash((self.ndims, self.scale1, self.scale2))
+    def cache_params(self):
+        return (self.ndims, self.scale1, self.scale2)
 
-class MultimodalGaussian(Distribution):
-    def __init__(self, ndims=2, nbatch=100, separation=3):
-        self.sep_vec = np.array([separation] * nbatch +
-                                [0] * (ndims - 1) * nbatch).reshape(ndims, nbatch)
-        # separated along first axis
-        self.sep_vec[0] += separation
-        super(MultimodalGaussian, self).__init__(ndims, nbatch)
+class GaussianMixture(Distribution):
+    """ Mixture of K Gaussians with diagonal covariances
+    Energy and gradient cost O(K * ndims) per particle, computed with a log-sum-exp over
+     the components and no per particle copies of the parameters
+    """
+
+    def __init__(self, means, scales=1., weights=None, nbatch=100):
+        """ Creates a mixture of Gaussians
+
+        :param means: means of the components - [K, ndims]
+        :param scales: standard deviations of the components, broadcastable to [K, ndims]
+        :param weights: mixing weights. normalized. defaults to uniform - [K]
+        :param nbatch: the number of sampling particles to run simultaneously
+        :returns: a GaussianMixture object
+        :rtype: GaussianMixture
+        """
+        self.means = np.atleast_2d(np.asarray(means, dtype=float))
+        self.n_components, ndims = self.means.shape
+        self.scales = np.broadcast_to(np.asarray(scales, dtype=float), self.means.shape).copy()
+        if weights is None:
+            weights = np.ones(self.n_components)
+        self.weights = np.asarray(weights, dtype=float) / np.sum(weights)
+        # [K, ndims]
+        self.precisions = 1. / self.scales ** 2
+        self.weighted_means = self.precisions * self.means
+        # [K, 1]
+        self.log_norms = (np.log(self.weights) - np.sum(np.log(self.scales), axis=1) -
+                          0.5 * np.sum(self.weighted_means * self.means, axis=1)).reshape((-1, 1))
+        super(GaussianMixture, self).__init__(ndims, nbatch)
+
+    def component_log_probs(self, X):
+        """ Unnormalized log probability of X under each weighted component
+        -0.5 (x - mu)^T P (x - mu) is expanded so that it is two matrix products
+
+        :param X: states - [ndims, n]
+        :returns: log probabilities - [K, n]
+        :rtype: np.ndarray
+        """
+        return (self.log_norms - 0.5 * np.dot(self.precisions, X ** 2) +
+                np.dot(self.weighted_means, X))
+
+    @staticmethod
+    def log_sum_exp(log_probs):
+        """ Numerically stable log of the sum of exp(log_probs) over the components
+        also returns the normalized responsibilities of the components
+
+        :param log_probs: [K, n]
+        :returns: log sum - [1, n], responsibilities - [K, n]
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        max_log_prob = np.max(log_probs, axis=0, keepdims=True)
+        probs = np.exp(log_probs - max_log_prob)
+        total = np.sum(probs, axis=0, keepdims=True)
+        return max_log_prob + np.log(total), probs / total
 
     @overrides(Distribution)
     def E_val(self, X):
-        trim_sep_vec = self.sep_vec[:, :X.shape[1]]
-        return -np.log(np.exp(-np.sum((X + trim_sep_vec)**2, axis=0)) +
-                       np.exp(-np.sum((X - trim_sep_vec)**2, axis=0)))
+        log_total, _ = self.log_sum_exp(self.component_log_probs(X))
+        return - log_total
 
     @overrides(Distribution)
     def dEdX_val(self, X):
-        # allows for partial batch size
-        trim_sep_vec = self.sep_vec[:, :X.shape[1]]
-        common_exp = np.exp(np.sum(4 * trim_sep_vec * X, axis=0))
-        # floating point hax
-        return ((2 * ((X - trim_sep_vec) * common_exp + trim_sep_vec + X)) /
-                (common_exp + 1))
+        _, resp = self.log_sum_exp(self.component_log_probs(X))
+        # sum_k r_k P_k (x - mu_k)
+        return np.dot(self.precisions.T, resp) * X - np.dot(self.weighted_means.T, resp)
 
+    @overrides(Distribution)
+    def gen_init_X(self):
+        components = np.random.choice(self.n_components, size=self.nbatch, p=self.weights)
+        self.Xinit = (self.means[components] + self.scales[components] *
+                      np.random.randn(self.nbatch, self.ndims)).T
+
+    @overrides(Distribution)
+    def cache_params(self):
+        return (self.ndims, self.means, self.scales, self.weights)
+
+class MultimodalGaussian(GaussianMixture):
+    def __init__(self, ndims=2, nbatch=100, separation=3):
+        """ Two isotropic modes with variance 1/2 at +- 2 * separation along the first axis
+        """
+        self.separation = separation
+        means = np.zeros((2, ndims))
+        # separated along first axis
+        means[:, 0] = [2 * separation, -2 * separation]
+        super(MultimodalGaussian, self).__init__(means, scales=np.sqrt(0.5), nbatch=nbatch)
 
     @overrides(Distribution)
     def init_X(self):
-        # okay, this is pointless... sep vecs cancel
-        self.Xinit = ((np.random.randn(self.ndims, self.nbatch) + self.sep_vec) +
-                (np.random.randn(self.ndims, self.nbatch) - self.sep_vec))
+        self.Xinit = (np.random.randn(self.ndims, self.nbatch) +
+                      np.random.randn(self.ndims, self.nbatch))
 
     @overrides(Distribution)
-    def __hash__(self):
-        return hash((self.ndims, self.separation))
+    def cache_params(self):
+        return (self.ndims, self.separation)
 
 class TestGaussian(Distribution):
 
@@ -366,58 +639,80 @@ class TestGaussian(Distribution):
         self.Xinit = np.random.randn(self.ndims, self.nbatch)
 
     @overrides(Distribution)
-    def __hash__(self):
-        return hash((self.ndims, self.sigma))
+    def cache_params(self):
+        return (self.ndims, self.sigma)
+
+# W with a smaller fraction of nonzero elements than this is stored as a sparse matrix
+POT_SPARSE_DENSITY = 0.25
 
 #pylint: disable=too-many-instance-attributes
 class ProductOfT(Distribution):
     """ Provides the product of T experts distribution
+    The energy and gradient cost O(nnz(W) + nbasis) per particle
     """
 
 
     #pylint: disable=too-many-arguments
     def __init__(self, ndims=36, nbasis=36, nbatch=100, lognu=None, W=None, b=None):
         """ Product of T experts, assumes a fixed W that is sparse and alpha that is
-        """
-        # awkward hack to import theano in poe only
-        try:
-            import theano.tensor as T
-            import theano
-            self.theano = theano
-            self.T = T
-        except:
-            raise ImportError("Theano could not be imported")
 
+        :param ndims: the dimension of the state space
+        :param nbasis: number of experts
+        :param nbatch: the number of sampling particles to run simultaneously
+        :param lognu: log of the degrees of freedom of each expert. random if None - [nbasis]
+        :param W: receptive fields of the experts. dense array or scipy.sparse matrix.
+          dense arrays with few nonzero elements are converted to sparse. identity if None - [ndims, nbasis]
+        :param b: biases of the experts. zero if None - [nbasis]
+        :returns: a ProductOfT object
+        :rtype: ProductOfT
+        """
+        from scipy import sparse
         if ndims != nbasis:
             raise NotImplementedError("Initializer only works for ndims == nbasis")
         self.ndims = ndims
         self.nbasis = nbasis
         self.nbatch = nbatch
         if W is None:
-            W = np.eye(ndims, nbasis)
-        self.weights = self.theano.shared(np.array(W, dtype='float32'), 'W')
+            W = sparse.identity(ndims, format='csr')
+        if not sparse.issparse(W) and np.count_nonzero(W) < POT_SPARSE_DENSITY * np.size(W):
+            W = sparse.csr_matrix(W)
+        if sparse.issparse(W):
+            self.weights = sparse.csr_matrix(W, dtype=float)
+            # [nbasis, ndims]
+            self.weights_T = self.weights.T.tocsr()
+        else:
+            self.weights = np.array(W, dtype=float)
+            self.weights_T = self.weights.T
         if lognu is None:
-            pre_nu = np.random.rand(nbasis,) * 2 + 2.1
+            self.nu = np.random.rand(nbasis,) * 2 + 2.1
         else:
-            pre_nu = np.exp(lognu)
-        self.nu = self.theano.shared(np.array(pre_nu, dtype='float32'), 'nu')
+            self.nu = np.exp(lognu)
         if b is None:
             b = np.zeros((nbasis,))
-        self.bias = self.theano.shared(np.array(b, dtype='float32'), 'b')
+        self.bias = np.array(b, dtype=float)
+        # [nbasis, 1]
+        self.rshp_nu = self.nu.reshape((-1, 1))
+        self.rshp_bias = self.bias.reshape((-1, 1))
+        self.alpha = (self.rshp_nu + 1.) / 2.
+        # d/du of alpha log(1 + u^2) is 2 alpha u / (1 + u^2), and du/dy is 1 / nu
+        self.grad_coef = 2. * self.alpha / self.rshp_nu
 
-        state = T.matrix()
-        energy = self.E_def(state)
-        gradient = T.grad(T.sum(energy), state)
+        super(ProductOfT,self).__init__(ndims,nbatch)
 
-        #@overrides(Distribution)
-        self.E_val = self.theano.function([state], energy, allow_input_downcast=True)
-        #@overrides(Distribution)
-        self.dEdX_val = self.theano.function([state], gradient, allow_input_downcast=True)
+    def scaled_responses(self, X):
+        """ responses of the experts divided by their degrees of freedom, (W^T X + b) / nu
 
-        super(ProductOfT,self).__init__(ndims,nbatch)
-        self.backend = 'theano'
+        :param X: states - [ndims, n]
+        :returns: scaled responses - [nbasis, n]
+        :rtype: np.ndarray
+        """
+        U = self.weights_T.dot(X)
+        U += self.rshp_bias
+        U /= self.rshp_nu
+        return U
 
-    def E_def(self,X):
+    @overrides(Distribution)
+    def E_val(self, X):
         """
         energy for a POE with student's-t expert in terms of:
                 samples [# dimensions]x[# samples] X
@@ -425,29 +720,194 @@ class ProductOfT(Distribution):
                 biases [# experts] b
                 degrees of freedom [# experts] nu
         """
-        rshp_b = self.bias.reshape((1,-1))
-        rshp_nu = self.nu.reshape((1, -1))
-        alpha = (rshp_nu + 1.)/2.
-        energy_per_expert = alpha * self.T.log(1 + ((self.T.dot(X.T, self.weights) + rshp_b) / rshp_nu) ** 2)
-        energy = self.T.sum(energy_per_expert, axis=1).reshape((1, -1))
-        return energy
+        U = self.scaled_responses(X)
+        return np.dot(self.alpha.T, np.log1p(U * U))
+
+    @overrides(Distribution)
+    def dEdX_val(self, X):
+        return self.E_dEdX_val(X)[1]
 
+    @overrides(Distribution)
+    def E_dEdX_val(self, X):
+        U = self.scaled_responses(X)
+        U_sq_1p = U * U
+        U_sq_1p += 1.
+        energy = np.dot(self.alpha.T, np.log(U_sq_1p))
+        # derivative of the energy wrt the responses, in place of U - [nbasis, n]
+        U *= self.grad_coef
+        U /= U_sq_1p
+        return energy, self.weights.dot(U)
 
     @overrides(Distribution)
     def gen_init_X(self):
         #hack to remap samples from a generic product of experts to
         #the model we are actually going to generate samples from
-        Zinit = np.zeros((self.ndims, self.nbatch))
-        for ii in xrange(self.ndims):
-            Zinit[ii] = stats.t.rvs(self.nu.get_value()[ii], size=self.nbatch)
+        from scipy import sparse
+        # (y / nu)^2 = t^2 / nu for a standard t variable t
+        Zinit = np.sqrt(self.rshp_nu) * stats.t.rvs(self.rshp_nu, size=(self.nbasis, self.nbatch))
+        Yinit = Zinit - self.rshp_bias
+        weights = self.weights.toarray() if sparse.issparse(self.weights) else self.weights
+        # responses are W^T X + b
+        self.Xinit = np.linalg.solve(weights.T, Yinit)
 
-        Yinit = Zinit - self.bias.get_value().reshape((-1, 1))
-        self.Xinit = np.dot(np.linalg.inv(self.weights.get_value()), Yinit)
+    @overrides(Distribution)
+    def cache_params(self):
+        from scipy import sparse
+        # digested as sparse whether W is stored dense or sparse
+        return (self.ndims,
+                self.nbasis,
+                self.nu,
+                sparse.csr_matrix(self.weights),
+                self.bias)
 
     @overrides(Distribution)
-    def __hash__(self):
+    def legacy_hash(self):
+        from scipy import sparse
+        # the parameters used to be stored as float32 theano variables
+        weights = self.weights.toarray() if sparse.issparse(self.weights) else self.weights
         return hash((self.ndims,
                      self.nbasis,
-                     hash(tuple(self.nu.get_value())),
-                     hash(tuple(self.weights.get_value().ravel())),
-                     hash(tuple(self.bias.get_value().ravel()))))
+                     hash(tuple(self.nu.astype('float32'))),
+                     hash(tuple(weights.astype('float32').ravel())),
+                     hash(tuple(self.bias.astype('float32').ravel()))))
+
+
+class DataDistribution(Distribution):
+    """ Posterior over parameters given a data set that may be too large to evaluate at every step
+    The data can be a np.memmap of shape (n_data, n_features), with one target per row.
+    The full data energy and gradient stream over the data in chunks of chunk_size rows.
+    The stochastic energy and gradient are unbiased estimates from a random minibatch of
+     batch_size rows, so they cost the same for any size of data set. They are meant for
+     mjhmc.samplers.stochastic_gradient
+    The prior is an isotropic gaussian with precision prior_precision
+    """
+
+    #pylint: disable=too-many-arguments
+    def __init__(self, data, targets, ndims, nbatch=100, batch_size=100, chunk_size=10000,
+                 prior_precision=1.):
+        """ Creates a posterior given data
+
+        :param data: data set, one example per row. may be memory-mapped - [n_data, n_features]
+        :param targets: target of each example. may be memory-mapped - [n_data]
+        :param ndims: the dimension of the parameter space
+        :param nbatch: the number of sampling particles to run simultaneously
+        :param batch_size: number of examples in each minibatch
+        :param chunk_size: number of examples read at once by the full data energy and gradient
+        :param prior_precision: precision of the gaussian prior on the parameters
+        :returns: the posterior distribution
+        :rtype: DataDistribution
+        """
+        self.data = data
+        self.targets = targets
+        self.n_data = data.shape[0]
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.prior_precision = float(prior_precision)
+        super(DataDistribution, self).__init__(ndims=ndims, nbatch=nbatch)
+
+    def data_E_dEdX_val(self, X, data, targets):
+        """ Subclasses should implement this as the energy of the likelihood of the examples
+        data with targets, summed over the examples, and its gradient
+
+        :param X: parameters - [ndims, n_particles]
+        :param data: examples - [n_examples, n_features]
+        :param targets: targets of the examples - [n_examples]
+        :returns: energy - [1, n_particles], gradient - [ndims, n_particles]
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        raise NotImplementedError()
+
+    def prior_E_dEdX_val(self, X):
+        """ Returns the energy of the prior and its gradient at X
+        """
+        return (self.prior_precision / 2. * np.sum(X ** 2, axis=0).reshape((1, -1)),
+                self.prior_precision * X)
+
+    def rows(self, idx):
+        """ Reads the examples idx, a slice or a sorted index array, into memory
+        """
+        return np.asarray(self.data[idx], dtype=float), np.asarray(self.targets[idx], dtype=float)
+
+    @overrides(Distribution)
+    def E_dEdX_val(self, X):
+        E, dEdX = self.prior_E_dEdX_val(X)
+        for start in xrange(0, self.n_data, self.chunk_size):
+            data, targets = self.rows(slice(start, start + self.chunk_size))
+            E_chunk, dEdX_chunk = self.data_E_dEdX_val(X, data, targets)
+            E += E_chunk
+            dEdX += dEdX_chunk
+        return E, dEdX
+
+    @overrides(Distribution)
+    def E_val(self, X):
+        return self.E_dEdX_val(X)[0]
+
+    @overrides(Distribution)
+    def dEdX_val(self, X):
+        return self.E_dEdX_val(X)[1]
+
+    def stochastic_E_dEdX_val(self, X):
+        """ Returns unbiased estimates of the energy and its gradient at X from a minibatch
+        The examples are drawn with replacement and read in order, so that only the pages
+         of a memory-mapped data set holding them are touched
+        """
+        idx = np.sort(np.random.randint(self.n_data, size=self.batch_size))
+        data, targets = self.rows(idx)
+        E, dEdX = self.data_E_dEdX_val(X, data, targets)
+        scale = self.n_data / float(self.batch_size)
+        E_prior, dEdX_prior = self.prior_E_dEdX_val(X)
+        return E_prior + scale * E, dEdX_prior + scale * dEdX
+
+    def stochastic_E(self, X):
+        self.E_count += X.shape[1]
+        return self.stochastic_E_dEdX_val(X)[0]
+
+    def stochastic_dEdX(self, X):
+        self.dEdX_count += X.shape[1]
+        return self.stochastic_E_dEdX_val(X)[1]
+
+    @overrides(Distribution)
+    def init_X(self):
+        # a fair initialization would have to be generated with full data gradients
+        self.gen_init_X()
+
+    @overrides(Distribution)
+    def gen_init_X(self):
+        self.Xinit = np.random.randn(self.ndims, self.nbatch) / np.sqrt(self.prior_precision)
+
+    @overrides(Distribution)
+    def cache_params(self):
+        # memory-mapped data is identified by its file rather than by digesting all of it
+        return (self.ndims,
+                self.n_data,
+                self.prior_precision,
+                getattr(self.data, 'filename', None) or self.data,
+                getattr(self.targets, 'filename', None) or self.targets)
+
+
+class BayesianLogisticRegression(DataDistribution):
+    """ Posterior over the weights of a logistic regression
+    Each row of data holds the features of one example, including a constant feature for a bias.
+    Targets are 0 or 1
+    """
+
+    def __init__(self, data, targets, **kwargs):
+        """ Creates the posterior of a logistic regression given data
+
+        :param data: features of each example. may be memory-mapped - [n_data, ndims]
+        :param targets: class of each example, 0 or 1. may be memory-mapped - [n_data]
+        :param kwargs: passed on to DataDistribution
+        :returns: the posterior distribution
+        :rtype: BayesianLogisticRegression
+        """
+        super(BayesianLogisticRegression, self).__init__(data, targets, data.shape[1], **kwargs)
+
+    @overrides(DataDistribution)
+    def data_E_dEdX_val(self, X, data, targets):
+        from scipy.special import expit
+        # +1 or -1 times the logit of every example and particle - [n_examples, n_particles]
+        signs = (2. * targets - 1.).reshape((-1, 1))
+        margins = signs * np.dot(data, X)
+        E = np.sum(np.logaddexp(0., - margins), axis=0).reshape((1, -1))
+        dEdX = - np.dot(data.T, signs * expit(- margins))
+        return E, dEdX
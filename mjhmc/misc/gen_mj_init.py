@@ -1,98 +1,439 @@
 """
  This module contains methods for generating and caching fair initializations for MJHMC
+
+ The MJHMC and control chains are independent, as are the particles within each chain, so
+  generation is split into tasks, one per chain and shard of particles, which are run by a
+  pool of forked worker processes. The variance estimates of the shards are merged exactly
+  with the parallel update of Chan et al.
+
+ By default the lengths of the burn in and variance phases are chosen adaptively, within the
+  budgets BURN_IN_STEPS - VAR_STEPS and VAR_STEPS. Since the particles are independent chains,
+  burn in stops once the distribution of the particles at geometrically spaced checkpoints no
+  longer changes and the particles have forgotten their state at the previous checkpoint.
+  The variance phase stops once the spread of the per particle estimates puts the relative
+  standard error of the variance estimate below a target.
 """
 
-import pickle
+import logging
+import multiprocessing
+import time
 import numpy as np
+from scipy import stats
 from mjhmc.samplers.markov_jump_hmc import MarkovJumpHMC, ControlHMC
-from .utils import package_path
+from .init_cache import save_initialization
 
 BURN_IN_STEPS = int(1E6)
 VAR_STEPS = int(5E5)
 MAX_N_PARTICLES = 1000
 
-def generate_initialization(distribution):
-    """ Run mjhmc for BURN_IN_STEPS on distribution, generating a fair set of initial states
+# minimum number of seconds between progress reports of a task
+PROGRESS_INTERVAL = 60
+
+# adaptive phase lengths
+MIN_BURN_IN_STEPS = 1000
+MIN_VAR_STEPS = 1000
+# ratio between the sampling iterations of consecutive checkpoints
+CHECK_GROWTH = 1.5
+# number of consecutive checkpoints that must agree to end burn in
+N_STABLE_CHECKS = 3
+# family wise false alarm rate of the stationarity tests at a checkpoint
+STATIONARITY_ALPHA = 0.01
+# largest correlation across particles of the energies at consecutive checkpoints
+MAX_ENERGY_CORRELATION = 0.1
+# target relative standard error of the pooled variance estimate
+TARGET_REL_ERR = 0.01
+
+logger = logging.getLogger(__name__)
+
+# the distribution being generated for and the progress callback. inherited by the forked
+# workers so that distributions holding compiled functions need not be pickled
+_generation_distribution = None
+_generation_progress = None
+
+class Moments(object):
+    """ Running count, mean and sum of squared deviations of each coordinate of a stream
+     of (ndims, nbatch) blocks of samples
+    Blocks are merged with the parallel algorithm of Chan et al., so every update is a
+     handful of vectorized operations
+    """
+
+    def __init__(self, count=0, mean=0., M2=0.):
+        """ Creates an accumulator, by default an empty one
+
+        :param count: number of samples of each coordinate
+        :param mean: mean of each coordinate - [ndims]
+        :param M2: sum of squared deviations from the mean of each coordinate - [ndims]
+        :returns: a new accumulator
+        :rtype: Moments
+        """
+        self.count = count
+        self.mean = mean
+        self.M2 = M2
+
+    def update(self, X):
+        """ Adds a block of samples, one per column
+        returns self for convenience
+
+        :param X: samples - [ndims, nbatch]
+        """
+        block_mean = np.mean(X, axis=1)
+        block_M2 = np.sum((X - block_mean.reshape((-1, 1))) ** 2, axis=1)
+        return self.merge(Moments(X.shape[1], block_mean, block_M2))
+
+    def merge(self, other):
+        """ Adds all of the samples summarized by other, the parallel algorithm of Chan et al.
+        returns self for convenience
+        """
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / float(count)
+        self.M2 = self.M2 + other.M2 + delta ** 2 * self.count * other.count / float(count)
+        self.count = count
+        return self
+
+    @property
+    def coordinate_variance(self):
+        """ unbiased variance estimate of each coordinate - [ndims]
+        """
+        return self.M2 / float(self.count - 1)
+
+    @property
+    def variance(self):
+        """ unbiased variance estimate of all coordinates pooled together
+        """
+        M2 = np.atleast_1d(self.M2)
+        mean = np.atleast_1d(self.mean)
+        pooled_M2 = np.sum(M2) + self.count * np.sum((mean - np.mean(mean)) ** 2)
+        return pooled_M2 / float(self.count * len(M2) - 1)
+
+def log_progress(task, step, n_steps):
+    """ Default progress callback of generate_initialization. Logs at INFO level
+
+    :param task: description of the task
+    :param step: number of sampling iterations done
+    :param n_steps: total number of sampling iterations of the task
+    :returns: None
+    :rtype: None
+    """
+    logger.info("%s: %d / %d sampling iterations (%.0f%%)", task, step, n_steps,
+                100. * step / n_steps)
+
+class Snapshot(object):
+    """ Distribution of the particles of a sampler at one sampling iteration
+    """
+
+    def __init__(self, sampler):
+        """ Summarizes the current state of sampler
+
+        :param sampler: sampler whose particles are independent chains
+        :returns: the summary
+        :rtype: Snapshot
+        """
+        # [nbatch]
+        self.energy = sampler.state.EX[0].copy()
+        self.nbatch = len(self.energy)
+        # [ndims]
+        self.mean = np.mean(sampler.state.X, axis=1)
+        self.var = np.var(sampler.state.X, axis=1, ddof=1)
+
+    def agrees_with(self, other):
+        """ Tests whether the particles of self and other follow the same distribution and
+         are uncorrelated
+
+        Compares the mean energy, and the mean and variance of every coordinate, with z tests
+         whose threshold is Bonferroni corrected to a false alarm rate of STATIONARITY_ALPHA
+
+        :param other: earlier snapshot of the same particles
+        :returns: True if no test detects a change
+        :rtype: bool
+        """
+        n = float(self.nbatch)
+        n_tests = 1 + 2 * len(self.mean)
+        z_crit = stats.norm.isf(STATIONARITY_ALPHA / (2. * n_tests))
+        z_energy = (np.abs(np.mean(self.energy) - np.mean(other.energy)) /
+                    np.sqrt((np.var(self.energy) + np.var(other.energy)) / n + 1e-300))
+        z_mean = np.abs(self.mean - other.mean) / np.sqrt((self.var + other.var) / n + 1e-300)
+        z_var = np.abs(self.var - other.var) / np.sqrt(2 * (self.var ** 2 + other.var ** 2) / (n - 1) + 1e-300)
+        z_max = max(z_energy, np.max(z_mean), np.max(z_var))
+        if np.std(self.energy) > 0 and np.std(other.energy) > 0:
+            correlation = np.corrcoef(self.energy, other.energy)[0, 1]
+        else:
+            correlation = 1.
+        return z_max < z_crit and correlation < max(MAX_ENERGY_CORRELATION, 3. / np.sqrt(n))
+
+def adaptive_burn_in(sampler, max_steps, progress=None):
+    """ Runs sampler until its particles look stationary, or for max_steps sampling iterations
+
+    Snapshots of the particles are taken at checkpoints spaced by a factor of CHECK_GROWTH,
+     starting at MIN_BURN_IN_STEPS. Burn in ends at the first checkpoint which agrees with
+     the previous one, as tested by Snapshot.agrees_with, N_STABLE_CHECKS times in a row.
+
+    :param sampler: sampler whose particles are independent chains
+    :param max_steps: budget of sampling iterations
+    :param progress: optional callback progress(step), called at most every PROGRESS_INTERVAL seconds
+    :returns: the number of sampling iterations run, the mean particle energy at each checkpoint
+    :rtype: int, list
+    """
+    next_check = min(MIN_BURN_IN_STEPS, max_steps)
+    previous = None
+    n_stable = 0
+    energy_trace = []
+    last_report = time.time()
+    for step in xrange(1, max_steps + 1):
+        sampler.sampling_iteration()
+        if progress is not None and time.time() - last_report > PROGRESS_INTERVAL:
+            progress(step)
+            last_report = time.time()
+        if step == next_check:
+            snapshot = Snapshot(sampler)
+            energy_trace.append(float(np.mean(snapshot.energy)))
+            if previous is not None and snapshot.agrees_with(previous):
+                n_stable += 1
+            else:
+                n_stable = 0
+            if n_stable >= N_STABLE_CHECKS:
+                return step, energy_trace
+            previous = snapshot
+            next_check = min(max(int(np.ceil(step * CHECK_GROWTH)), step + 1), max_steps)
+    return max_steps, energy_trace
+
+def generate_initialization(distribution, **kwargs):
+    """ Run mjhmc and control hmc for up to BURN_IN_STEPS on distribution, generating a fair set of initial states
 
     :param distribution: Distribution object. Must have nbatch == MAX_N_PARTICLES
+    :param kwargs: passed on to generate_chains
     :returns: a set of fair initial states and an estimate of the variance for emc and true both
-    :rtype: tuple: (array of shape (distribution.ndims, MAX_N_PARTICLES), float, float)
+    :rtype: tuple: (array of shape (distribution.ndims, MAX_N_PARTICLES), float, float,
+      array of shape (distribution.ndims, MAX_N_PARTICLES))
     """
-    print('Generating fair initialization for {} by burning in {} steps'.format(
-        type(distribution).__name__, BURN_IN_STEPS))
-    assert BURN_IN_STEPS > VAR_STEPS
-    # must rebuild graph to nbatch=MAX_N_PARTICLES
-    if distribution.backend == 'tensorflow':
-        distribution.build_graph()
-    mjhmc = MarkovJumpHMC(distribution=distribution, resample=False)
-    for _ in xrange(BURN_IN_STEPS - VAR_STEPS):
-        mjhmc.sampling_iteration()
-    assert mjhmc.resample == False
+    endpts, moments, _ = generate_chains(distribution, **kwargs)
+    return (endpts['mjhmc'], moments['mjhmc'].variance,
+            moments['control'].variance, endpts['control'])
 
-    emc_var_estimate, mjhmc = online_variance(mjhmc, distribution)
-    # we discard v since p(x,v) = p(x)p(v)
-    mjhmc_endpt = mjhmc.state.copy().X
+def generate_chains(distribution, n_workers=None, n_shards=1, progress=log_progress,
+                    adaptive=True, target_rel_err=TARGET_REL_ERR):
+    """ Burns in the mjhmc and control chains on distribution and estimates their moments
 
-    # otherwise will go into recursive loop
-    distribution.mjhmc = False
+    :param distribution: Distribution object. Must have nbatch == MAX_N_PARTICLES
+    :param n_workers: number of worker processes. Defaults to one per task, up to the number
+      of cpus. Tensorflow sessions do not survive a fork, so tensorflow distributions are
+      always generated in process
+    :param n_shards: number of shards the particles of each chain are split into
+    :param progress: callback progress(task, step, n_steps) called periodically by each task
+    :param adaptive: if True, the burn in and variance phases stop early as described in the
+      module docstring. otherwise they run for their full budgets
+    :param target_rel_err: target relative standard error of the variance estimates
+    :returns: the final states of the chains - [ndims, MAX_N_PARTICLES], the moments of
+      their variance phases and a list with the phase lengths chosen for each shard,
+      each in a dictionary keyed by 'mjhmc' and 'control'
+    :rtype: (dict, dict, dict)
+    """
+    global _generation_distribution, _generation_progress
+    logger.info('Generating fair initialization for %s by burning in %d steps',
+                type(distribution).__name__, BURN_IN_STEPS)
+    assert BURN_IN_STEPS > VAR_STEPS
+    nbatch = distribution.nbatch
+    n_shards = max(1, min(n_shards, nbatch))
+
+    mjhmc_init = distribution.Xinit
     try:
         distribution.gen_init_X()
+        control_init = distribution.Xinit
     except NotImplementedError:
-        print("No explicit init method found, using mjhmc endpoint")
+        logger.info("No explicit init method found, using the mjhmc initialization")
+        control_init = mjhmc_init
+
+    bounds = np.linspace(0, nbatch, n_shards + 1).astype(int)
+    tasks = []
+    for chain, chain_init in [('mjhmc', mjhmc_init), ('control', control_init)]:
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            # forked workers share the random state, so each task is seeded from it
+            seed = np.random.randint(2 ** 31)
+            # so that the merged estimate meets the target
+            shard_rel_err = target_rel_err * np.sqrt(nbatch / float(stop - start)) if adaptive else None
+            tasks.append((chain, start, stop, chain_init[:, start:stop].copy(), seed,
+                          adaptive, shard_rel_err))
+
+    if n_workers is None:
+        n_workers = min(len(tasks), multiprocessing.cpu_count())
+    if distribution.backend == 'tensorflow':
+        n_workers = 1
 
+    _generation_distribution = distribution
+    _generation_progress = progress
+    try:
+        if n_workers > 1:
+            pool = multiprocessing.Pool(n_workers)
+            try:
+                results = pool.map(_run_chain, tasks, chunksize=1)
+            finally:
+                pool.terminate()
+        else:
+            results = [_run_chain(task) for task in tasks]
+    finally:
+        _generation_distribution = None
+        _generation_progress = None
+        distribution.nbatch = nbatch
+
+    endpts = {'mjhmc': np.zeros((distribution.ndims, nbatch)),
+              'control': np.zeros((distribution.ndims, nbatch))}
+    moments = {'mjhmc': Moments(), 'control': Moments()}
+    lengths = {'mjhmc': [], 'control': []}
+    for chain, start, stop, endpt, shard_moments, shard_lengths in results:
+        endpts[chain][:, start:stop] = endpt
+        moments[chain].merge(shard_moments)
+        lengths[chain].append(dict(shard_lengths, start=int(start), stop=int(stop)))
+
+    return endpts, moments, lengths
+
+def _run_chain(task):
+    """ Burns in one shard of the particles of one chain of _generation_distribution
+    Not user facing. Run by the workers of generate_initialization
+
+    :param task: tuple (chain, start, stop, Xinit, seed, adaptive, target_rel_err) where chain is
+      'mjhmc' or 'control', the shard is particles start to stop, Xinit is their initial state,
+      seed seeds numpy and the rest are as in generate_chains
+    :returns: (chain, start, stop, final state of the shard, moments of the variance phase,
+      dictionary of the phase lengths)
+    :rtype: tuple
+    """
+    chain, start, stop, Xinit, seed, adaptive, target_rel_err = task
+    distribution = _generation_distribution
+    progress = _generation_progress or (lambda task, step, n_steps: None)
+    name = '{} {} particles {}-{}'.format(type(distribution).__name__, chain, start, stop)
+    np.random.seed(seed)
+    distribution.nbatch = stop - start
+    distribution.Xinit = Xinit
     distribution.E_count = 0
     distribution.dEdX_count = 0
+    # switch to the ops for the size of the shard. only built if they depend on it
+    if distribution.backend == 'tensorflow':
+        distribution.build_graph()
+    if chain == 'mjhmc':
+        sampler = MarkovJumpHMC(distribution=distribution, resample=False)
+        assert sampler.resample == False
+    else:
+        # otherwise will go into recursive loop
+        distribution.mjhmc = False
+        sampler = ControlHMC(distribution=distribution)
 
-    control = ControlHMC(distribution=distribution)
-    for _ in xrange(BURN_IN_STEPS - VAR_STEPS):
-        control.sampling_iteration()
-    true_var_estimate, control = online_variance(control, distribution)
-    control_endpt = control.state.copy().X
-
-    return mjhmc_endpt, emc_var_estimate, true_var_estimate, control_endpt
+    max_burn_in = BURN_IN_STEPS - VAR_STEPS
+    if adaptive:
+        n_burn_in, energy_trace = adaptive_burn_in(
+            sampler, max_burn_in, lambda step: progress(name, step, BURN_IN_STEPS))
+    else:
+        n_burn_in, energy_trace = max_burn_in, []
+        last_report = time.time()
+        for step in xrange(max_burn_in):
+            sampler.sampling_iteration()
+            if time.time() - last_report > PROGRESS_INTERVAL:
+                progress(name, step + 1, BURN_IN_STEPS)
+                last_report = time.time()
+    moments, sampler, n_var, rel_err = online_variance(
+        sampler, distribution, lambda step: progress(name, n_burn_in + step, BURN_IN_STEPS),
+        target_rel_err=target_rel_err)
+    progress(name, n_burn_in + n_var, n_burn_in + n_var)
+    lengths = {
+        'burn_in_steps': n_burn_in,
+        'var_steps': n_var,
+        'var_rel_err': float(rel_err),
+        'energy_trace': energy_trace
+    }
+    # we discard v since p(x,v) = p(x)p(v)
+    return chain, start, stop, sampler.state.copy().X, moments, lengths
 
-def cache_initialization(distribution):
+def cache_initialization(distribution, **kwargs):
     """ Generates fair initialization for mjhmc on distribution and then caches it
 
     :param distribution: Distribution object. Must have nbatch == MAX_N_PARTICLES
-    :returns:
-    :rtype:
+    :param kwargs: passed on to generate_chains
+    :returns: path of the cache entry
+    :rtype: string
     """
     distr_name = type(distribution).__name__
-    distr_hash = hash(distribution)
-    mjhmc_endpt, emc_var_estimate, true_var_estimate, control_endpt = generate_initialization(distribution)
+    endpts, moments, lengths = generate_chains(distribution, **kwargs)
+    emc_var_estimate = moments['mjhmc'].variance
+    true_var_estimate = moments['control'].variance
 
-    file_name = '{}_{}.pickle'.format(distr_name, distr_hash)
-    file_prefix = '{}/initializations'.format(package_path())
-    with open('{}/{}'.format(file_prefix, file_name), 'wb') as cache_file:
-        pickle.dump((mjhmc_endpt, emc_var_estimate, true_var_estimate, control_endpt), cache_file)
-    print "Fair initialization for {} saved as {}".format(distr_name, file_name)
-    print "The embedded jump process on {} has estimated variance of {}".format(
-        distr_name, emc_var_estimate)
-    print "Meanwhile {} itself has an estimated variance of {}".format(
-        distr_name, true_var_estimate)
+    meta = {
+        'emc_var_estimate': float(emc_var_estimate),
+        'true_var_estimate': float(true_var_estimate),
+        'emc_coordinate_var_estimate': moments['mjhmc'].coordinate_variance.tolist(),
+        'true_coordinate_var_estimate': moments['control'].coordinate_variance.tolist(),
+        'mjhmc_phase_lengths': lengths['mjhmc'],
+        'control_phase_lengths': lengths['control']
+    }
+    path = save_initialization(distribution, endpts['mjhmc'], endpts['control'], meta)
+    logger.info("Fair initialization for %s saved in %s", distr_name, path)
+    logger.info("The embedded jump process on %s has estimated variance of %s",
+                distr_name, emc_var_estimate)
+    logger.info("Meanwhile %s itself has an estimated variance of %s",
+                distr_name, true_var_estimate)
+    return path
 
 
-def online_variance(sampler, distribution):
+def online_variance(sampler, distribution, progress=None, target_rel_err=None,
+                    max_steps=None, min_steps=MIN_VAR_STEPS):
     """ computes the variance in an online fashion to allow arbitrarily large sample sizes
+    every sampling iteration is merged into the running moments as one (ndims, nbatch) block
 
+    If target_rel_err is given, sampling stops once the relative standard error of the pooled
+     variance estimate falls below it. The error is estimated from the spread of the estimates
+     of the individual particles, which are independent chains, so it accounts for autocorrelation.
+     It is checked at iterations spaced by a factor of CHECK_GROWTH
 
     :param sampler: initialized sampler
     :param distribution: initialized distribution
-    :returns: variance estimate, sampler (for convenience)
-    :rtype: float, HMCBase
+    :param progress: optional callback progress(step), called at most every PROGRESS_INTERVAL seconds
+    :param target_rel_err: target relative standard error. if None, runs for max_steps
+    :param max_steps: budget of sampling iterations. defaults to VAR_STEPS
+    :param min_steps: minimum number of sampling iterations when target_rel_err is given
+    :returns: moments of the samples, whose variance property is the pooled estimate, sampler (for convenience),
+      number of sampling iterations run and estimated relative error of the pooled variance
+    :rtype: Moments, HMCBase, int, float
+
+    """
+    if max_steps is None:
+        max_steps = VAR_STEPS
+    moments = Moments()
+    # per particle sums over time and coordinates of x and x^2 - [nbatch]
+    particle_sum = 0.
+    particle_sumsq = 0.
+    next_check = min(min_steps, max_steps)
+    rel_err = np.inf
+    last_report = time.time()
+    for step in xrange(1, max_steps + 1):
+        sampler.sampling_iteration()
+        X = sampler.state.X
+        moments.update(X)
+        particle_sum = particle_sum + np.sum(X, axis=0)
+        particle_sumsq = particle_sumsq + np.sum(X ** 2, axis=0)
+        if progress is not None and time.time() - last_report > PROGRESS_INTERVAL:
+            progress(step)
+            last_report = time.time()
+        if step == next_check or step == max_steps:
+            rel_err = particle_rel_err(particle_sum, particle_sumsq, moments, step)
+            if target_rel_err is not None and rel_err < target_rel_err:
+                return moments, sampler, step, rel_err
+            next_check = max(int(np.ceil(step * CHECK_GROWTH)), step + 1)
+    return moments, sampler, max_steps, rel_err
+
+def particle_rel_err(particle_sum, particle_sumsq, moments, n_steps):
+    """ Relative standard error of the pooled variance estimate of moments, estimated from
+     the spread of the pooled variance estimates of the individual particles
 
+    :param particle_sum: sum over time and coordinates of each particle - [nbatch]
+    :param particle_sumsq: sum over time and coordinates of each particle squared - [nbatch]
+    :param moments: moments of all of the samples
+    :param n_steps: number of sampling iterations summed over
+    :returns: relative standard error
+    :rtype: float
     """
-    #online variance computation, algorithm due to Knuth and Wellford
-    curr_mean = 0
-    curr_sumsq = 0
-    trial_idx = 0
-    for _ in xrange(VAR_STEPS):
-        # very slow but safe
-        for val in  sampler.sample(1).ravel():
-            trial_idx += 1
-            delta = val - curr_mean
-            curr_mean += float(delta) / trial_idx
-            curr_sumsq += delta * (val - curr_mean)
-    var_estimate = curr_sumsq / float(VAR_STEPS * distribution.nbatch * distribution.ndims - 1)
-    return var_estimate, sampler
+    n_vals = float(n_steps * np.size(moments.mean))
+    pooled_mean = np.mean(moments.mean)
+    particle_var = (particle_sumsq - 2 * pooled_mean * particle_sum) / n_vals + pooled_mean ** 2
+    if len(particle_var) < 2 or np.mean(particle_var) <= 0:
+        return np.inf
+    return np.std(particle_var, ddof=1) / np.sqrt(len(particle_var)) / np.mean(particle_var)
@@ -0,0 +1,235 @@
+"""
+ This module contains the on disk store of fair initializations generated by gen_mj_init
+
+ Each distribution has one entry in the initializations directory, named after its class and
+  the stable digest of its parameters. An entry is a directory holding the particle states as
+  .npy files, which are memory-mapped when loaded, and the variance estimates and other
+  metadata in meta.json
+ Entries are written to a temporary directory and renamed into place, so readers never see a
+  partially written entry. Processes that need the same missing entry serialize on a lock file
+  in the system temporary directory, so that only one of them generates it while the others wait.
+ Loaded entries are kept in a process wide LRU cache capped at INIT_CACHE_BYTES, so resetting
+  a distribution does not touch the filesystem after its entry has been read once.
+ Initializations shipped in the old '{class}_{hash}.pickle' format are imported into the store
+  the first time their distribution asks for an entry that does not exist yet.
+"""
+import errno
+import fcntl
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from .utils import package_path
+
+MJHMC_ENDPT_FILE = 'mjhmc_endpt.npy'
+CONTROL_ENDPT_FILE = 'control_endpt.npy'
+META_FILE = 'meta.json'
+
+# maximum number of bytes of particle states held in memory by get_initialization
+INIT_CACHE_BYTES = 256 * 2 ** 20
+
+# entry name -> (mjhmc_endpt, control_endpt, meta), least recently used first
+_loaded_inits = OrderedDict()
+_loaded_inits_lock = threading.Lock()
+
+def init_dir():
+    """ Returns the directory holding all of the cached initializations, creating it if needed
+
+    :returns: absolute path to the initializations directory
+    :rtype: string
+    """
+    path = '{}/initializations'.format(package_path())
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    return path
+
+def entry_name(distribution):
+    """ Returns the name of the store entry of distribution
+
+    :param distribution: Distribution object
+    :returns: entry name of the form {class name}_{digest}
+    :rtype: string
+    """
+    return '{}_{}'.format(type(distribution).__name__, distribution.digest())
+
+def entry_path(distribution):
+    """ Returns the absolute path of the store entry of distribution
+    """
+    return '{}/{}'.format(init_dir(), entry_name(distribution))
+
+def load_initialization(distribution, mmap_mode='r'):
+    """ Loads the cached fair initialization of distribution
+
+    :param distribution: Distribution object
+    :param mmap_mode: passed to np.load. the default memory-maps the states read only
+    :returns: the initial states for MJHMC and for the control samplers, each of shape
+      (ndims, n_particles), and the metadata of the entry. None if there is no entry
+    :rtype: (np.ndarray, np.ndarray, dict) or None
+    """
+    path = entry_path(distribution)
+    if not os.path.isdir(path):
+        return None
+    mjhmc_endpt = np.load('{}/{}'.format(path, MJHMC_ENDPT_FILE), mmap_mode=mmap_mode)
+    control_endpt = np.load('{}/{}'.format(path, CONTROL_ENDPT_FILE), mmap_mode=mmap_mode)
+    with open('{}/{}'.format(path, META_FILE)) as meta_file:
+        meta = json.load(meta_file)
+    return mjhmc_endpt, control_endpt, meta
+
+def save_initialization(distribution, mjhmc_endpt, control_endpt, meta):
+    """ Atomically writes the fair initialization of distribution to the store
+    If an entry already exists it is left untouched
+
+    :param distribution: Distribution object
+    :param mjhmc_endpt: fair initial states for MJHMC - [ndims, n_particles]
+    :param control_endpt: fair initial states for the control samplers - [ndims, n_particles]
+    :param meta: json serializable metadata, eg the variance estimates
+    :returns: absolute path of the entry
+    :rtype: string
+    """
+    path = entry_path(distribution)
+    meta = dict(meta, distribution=type(distribution).__name__,
+                digest=distribution.digest(), ndims=distribution.ndims,
+                n_particles=mjhmc_endpt.shape[1])
+    tmp_path = tempfile.mkdtemp(prefix='.{}.'.format(entry_name(distribution)), dir=init_dir())
+    try:
+        # mkdtemp creates the directory private to this user
+        os.chmod(tmp_path, 0o755)
+        np.save('{}/{}'.format(tmp_path, MJHMC_ENDPT_FILE), np.asarray(mjhmc_endpt))
+        np.save('{}/{}'.format(tmp_path, CONTROL_ENDPT_FILE), np.asarray(control_endpt))
+        with open('{}/{}'.format(tmp_path, META_FILE), 'w') as meta_file:
+            json.dump(meta, meta_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+    except OSError as err:
+        # another process won the race to write this entry
+        if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+    return path
+
+def get_initialization(distribution):
+    """ Returns the fair initialization of distribution, from memory if it has been loaded before
+    Entries read from disk are copied into the in memory LRU cache, evicting the least
+     recently used entries beyond INIT_CACHE_BYTES. The returned arrays are shared, do not modify them
+
+    :param distribution: Distribution object
+    :returns: the initial states for MJHMC and for the control samplers, each of shape
+      (ndims, n_particles), and the metadata of the entry. None if there is no entry
+    :rtype: (np.ndarray, np.ndarray, dict) or None
+    """
+    name = entry_name(distribution)
+    with _loaded_inits_lock:
+        if name in _loaded_inits:
+            init = _loaded_inits.pop(name)
+            _loaded_inits[name] = init
+            return init
+    init = load_initialization(distribution, mmap_mode=None)
+    if init is None and legacy_pickle_name(distribution) in os.listdir(init_dir()):
+        import_legacy_pickle(distribution, legacy_pickle_name(distribution))
+        init = load_initialization(distribution, mmap_mode=None)
+    if init is None:
+        return None
+    with _loaded_inits_lock:
+        _loaded_inits[name] = init
+        _evict(INIT_CACHE_BYTES)
+    return init
+
+def clear_loaded_initializations():
+    """ Empties the in memory cache of get_initialization
+    """
+    with _loaded_inits_lock:
+        _loaded_inits.clear()
+
+def _evict(max_bytes):
+    """ Drops least recently used entries until at most max_bytes are held
+    The most recently used entry is always kept. Must hold _loaded_inits_lock
+    """
+    n_bytes = sum(init[0].nbytes + init[1].nbytes for init in _loaded_inits.values())
+    while n_bytes > max_bytes and len(_loaded_inits) > 1:
+        _, init = _loaded_inits.popitem(last=False)
+        n_bytes -= init[0].nbytes + init[1].nbytes
+
+def lock_path(distribution):
+    """ Returns the path of the lock file of the entry of distribution
+    Lock files are kept in the temporary directory, out of the tracked initializations directory,
+     and are named after the store as well as the entry so that different checkouts do not share them
+    """
+    import hashlib
+    store_digest = hashlib.sha1(init_dir().encode('utf-8')).hexdigest()[:12]
+    return '{}/mjhmc_init_{}_{}.lock'.format(tempfile.gettempdir(), store_digest,
+                                              entry_name(distribution))
+
+@contextmanager
+def initialization_lock(distribution):
+    """ Context manager holding an exclusive, inter-process lock on the entry of distribution
+    Use it around the check for a missing entry and its generation
+    """
+    with open(lock_path(distribution), 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def legacy_pickle_name(distribution):
+    """ Returns the name distribution's initialization had in the old format, or None
+    """
+    legacy_hash = distribution.legacy_hash()
+    if legacy_hash is None:
+        return None
+    return '{}_{}.pickle'.format(type(distribution).__name__, legacy_hash)
+
+def import_legacy_pickle(distribution, file_name):
+    """ Copies an initialization cached in the old '{class}_{hash}.pickle' format into the store
+    The old file names used hash(distribution), which is reproduced by distribution.legacy_hash.
+     Pickles can also be named explicitly, eg if the hash of their parameters has changed
+    The oldest pickles have no control initialization. Since the control samplers leave the
+     distribution itself invariant, exact samples from gen_init_X are used in its place
+
+    :param distribution: Distribution object the pickle was generated for
+    :param file_name: name of the pickle in the initializations directory
+    :returns: path of the new entry
+    :rtype: string
+    """
+    with open('{}/{}'.format(init_dir(), file_name), 'rb') as cache_file:
+        cache = pickle.load(cache_file)
+    if len(cache) == 3:
+        mjhmc_endpt, emc_var_estimate, true_var_estimate = cache
+        control_endpt = exact_samples(distribution, mjhmc_endpt.shape[1])
+        if control_endpt is None:
+            raise ValueError("{} predates the control initializations and must be regenerated".format(
+                file_name))
+    else:
+        mjhmc_endpt, emc_var_estimate, true_var_estimate, control_endpt = cache
+    meta = {
+        'emc_var_estimate': float(emc_var_estimate),
+        'true_var_estimate': float(true_var_estimate),
+        'imported_from': file_name
+    }
+    return save_initialization(distribution, mjhmc_endpt, control_endpt, meta)
+
+def exact_samples(distribution, n_particles):
+    """ Returns n_particles states drawn by distribution.gen_init_X, leaving distribution unchanged
+
+    :returns: states - [ndims, n_particles], or None if gen_init_X is not implemented
+    :rtype: np.ndarray or None
+    """
+    # called before Xinit is first set when the distribution is constructed
+    old_nbatch, old_Xinit = distribution.nbatch, getattr(distribution, 'Xinit', None)
+    distribution.nbatch = n_particles
+    try:
+        distribution.gen_init_X()
+        return distribution.Xinit
+    except NotImplementedError:
+        return None
+    finally:
+        distribution.nbatch, distribution.Xinit = old_nbatch, old_Xinit
@@ -0,0 +1,173 @@
+"""
+This module contains sampler quality metrics computed from autocorrelations:
+  integrated autocorrelation time, bulk and tail effective sample size (ESS),
+  and ESS per gradient evaluation and per second
+
+The integrated autocorrelation time is estimated with Geyer's initial positive and initial
+  monotone sequence estimators (Geyer, Practical Markov Chain Monte Carlo, 1992), which truncate
+  the sum of the autocorrelation where the sums of consecutive pairs of lags stop being positive.
+  Bulk and tail ESS follow Vehtari et al. (https://arxiv.org/abs/1903.08008): split chains,
+  rank normalization for the bulk, and the indicators of the outer quantiles for the tails.
+Every function works on all of the dimensions at once.
+"""
+import numpy as np
+from numpy.fft import rfft, irfft
+from scipy.stats import norm
+from .autocor import fast_length
+
+def integrated_autocorrelation_time(autocor, monotone=True):
+    """ Estimates the integrated autocorrelation time 1 + 2 sum_{t > 0} autocor[t]
+    with Geyer's initial positive sequence estimator
+
+    :param autocor: normalized autocorrelations, with lags on the last axis - [..., n_lags]
+    :param monotone: if True, the sums of pairs of lags are also made non increasing,
+      which is Geyer's initial monotone sequence estimator
+    :returns: integrated autocorrelation times, in samples - [...]
+    :rtype: array
+    """
+    autocor = np.asarray(autocor, dtype=float)
+    n_pairs = autocor.shape[-1] // 2
+    pair_sums = autocor[..., 0:2 * n_pairs:2] + autocor[..., 1:2 * n_pairs:2]
+    # every pair before the first non positive one
+    initial_positive = np.cumprod(pair_sums > 0, axis=-1).astype(bool)
+    if monotone:
+        pair_sums = np.minimum.accumulate(pair_sums, axis=-1)
+    return -1. + 2. * np.sum(np.where(initial_positive, pair_sums, 0.), axis=-1)
+
+def split_chains(samples):
+    """ Splits each chain in half, so that chains that are not stationary disagree
+    The last sample is dropped when the number of samples is odd
+
+    :param samples: [n_dims, n_batch, n_samples]
+    :returns: [n_dims, 2 * n_batch, n_samples // 2]
+    :rtype: array
+    """
+    n_half = samples.shape[-1] // 2
+    return np.concatenate((samples[:, :, :n_half], samples[:, :, n_half:2 * n_half]), axis=1)
+
+def chain_autocorrelation(samples, max_lag=None):
+    """ Autocorrelation of each dimension, combined over chains as in Stan, so that chains
+    with different means lower it
+
+    :param samples: [n_dims, n_batch, n_samples]
+    :param max_lag: largest lag to compute. defaults to n_samples - 1
+    :returns: autocorrelation of each dimension - [n_dims, max_lag + 1]
+    :rtype: array
+    """
+    samples = np.asarray(samples, dtype=float)
+    n_samples = samples.shape[-1]
+    if max_lag is None:
+        max_lag = n_samples - 1
+    chain_means = np.mean(samples, axis=-1)
+    n_fft = fast_length(n_samples + max_lag)
+    fft_samples = rfft(samples - chain_means[:, :, np.newaxis], n=n_fft, axis=-1)
+    # biased autocovariances of each chain, averaged over chains - [n_dims, max_lag + 1]
+    autocov = irfft(fft_samples.real ** 2 + fft_samples.imag ** 2, n=n_fft, axis=-1)
+    mean_autocov = np.mean(autocov[:, :, :max_lag + 1], axis=1) / n_samples
+    within_var = mean_autocov[:, :1] * n_samples / (n_samples - 1.)
+    between_var = 0.
+    if samples.shape[1] > 1:
+        between_var = np.var(chain_means, axis=1, ddof=1)[:, np.newaxis]
+    var_plus = within_var * (n_samples - 1.) / n_samples + between_var
+    return 1. - (within_var - mean_autocov) / var_plus
+
+def effective_sample_size(samples, split=True, monotone=True):
+    """ Effective number of independent samples of each dimension, over all chains
+
+    :param samples: [n_dims, n_batch, n_samples]
+    :param split: if True, the chains are split in half first
+    :param monotone: use the initial monotone rather than the initial positive sequence
+    :returns: ESS of each dimension - [n_dims]
+    :rtype: array
+    """
+    if split:
+        samples = split_chains(samples)
+    _, n_batch, n_samples = samples.shape
+    tau = integrated_autocorrelation_time(chain_autocorrelation(samples), monotone)
+    return n_batch * n_samples / tau
+
+def rank_normalize(samples):
+    """ Replaces the samples of each dimension by the normal quantiles of their ranks
+    over all chains and times
+
+    :param samples: [n_dims, n_batch, n_samples]
+    :returns: [n_dims, n_batch, n_samples]
+    :rtype: array
+    """
+    flat = samples.reshape((samples.shape[0], -1))
+    ranks = np.argsort(np.argsort(flat, axis=1), axis=1) + 1.
+    return norm.ppf((ranks - 0.375) / (flat.shape[1] + 0.25)).reshape(samples.shape)
+
+def bulk_ess(samples, monotone=True):
+    """ ESS of the rank normalized split chains, for estimates of the center of the distribution
+
+    :param samples: [n_dims, n_batch, n_samples]
+    :param monotone: use the initial monotone rather than the initial positive sequence
+    :returns: bulk ESS of each dimension - [n_dims]
+    :rtype: array
+    """
+    return effective_sample_size(rank_normalize(split_chains(samples)), False, monotone)
+
+def tail_ess(samples, prob=0.05, monotone=True):
+    """ Smaller of the ESS of the prob and 1 - prob quantiles, for estimates of the tails
+
+    :param samples: [n_dims, n_batch, n_samples]
+    :param prob: quantile of the lower tail
+    :param monotone: use the initial monotone rather than the initial positive sequence
+    :returns: tail ESS of each dimension - [n_dims]
+    :rtype: array
+    """
+    samples = split_chains(samples)
+    flat = samples.reshape((samples.shape[0], -1))
+    lower, upper = np.percentile(flat, [100 * prob, 100 * (1 - prob)], axis=1)
+    return np.minimum(
+        effective_sample_size(samples <= lower[:, np.newaxis, np.newaxis], False, monotone),
+        effective_sample_size(samples >= upper[:, np.newaxis, np.newaxis], False, monotone))
+
+def sample_metrics(samples, grad_evals, run_time=None):
+    """ Computes every metric of samples, reduced to the worst dimension
+
+    :param samples: [n_dims, n_batch, n_samples]
+    :param grad_evals: number of gradient evaluations per chain taken to draw the samples
+    :param run_time: Optional. seconds taken to draw the samples
+    :returns: dict with 'tau_int', 'bulk_ess', 'tail_ess', 'ess_per_grad' and 'ess_per_second'.
+      ESS per gradient evaluation is per chain, so that it does not depend on the batch size
+    :rtype: dict
+    """
+    _, n_batch, n_samples = samples.shape
+    ess = np.min(bulk_ess(samples))
+    metrics = {
+        'tau_int': n_batch * n_samples / ess,
+        'bulk_ess': ess,
+        'tail_ess': np.min(tail_ess(samples)),
+        'ess_per_grad': ess / (n_batch * float(grad_evals)),
+        'ess_per_second': None
+    }
+    if run_time:
+        metrics['ess_per_second'] = ess / float(run_time)
+    return metrics
+
+def autocor_metrics(autocor, grad_evals, run_time=None, n_samples=None, monotone=True):
+    """ Computes the metrics that an autocorrelation alone determines, eg from
+    calculate_autocorrelation or stream_autocorrelation
+
+    :param autocor: normalized autocorrelation, averaged over dimensions and chains - [n_lags]
+    :param grad_evals: cumulative gradient evaluations per chain at each of the first samples
+    :param run_time: Optional. seconds taken to draw the samples
+    :param n_samples: number of samples per chain. defaults to len(grad_evals)
+    :param monotone: use the initial monotone rather than the initial positive sequence
+    :returns: dict with 'tau_int', in samples, and 'ess_per_grad' and 'ess_per_second' per chain
+    :rtype: dict
+    """
+    grad_evals = np.asarray(grad_evals, dtype=float).ravel()
+    n_samples = n_samples or len(grad_evals)
+    tau = integrated_autocorrelation_time(np.asarray(autocor).ravel(), monotone)
+    grads_per_sample = grad_evals[-1] / len(grad_evals)
+    metrics = {
+        'tau_int': tau,
+        'ess_per_grad': 1. / (tau * grads_per_sample),
+        'ess_per_second': None
+    }
+    if run_time:
+        metrics['ess_per_second'] = n_samples / (tau * float(run_time))
+    return metrics
@@ -1,4 +1,4 @@
-from nuts import nuts6
+from mjhmc.samplers.nuts import NUTS
 import numpy as np
 import pandas as pd
 
@@ -11,24 +11,25 @@ def sample_nuts_to_df(distribution, n_samples=5000,
     """
     runs NUTS on distribution for num_steps
     returns a dataframe containing samples, number of gradient evaluations at each step,
-    distributions : initialized distributions object, must have nbatch=1
-    sample_steps: the number of sampling steps concatenated into one time step. LAHMC used 10
-    n_batch: the number of sampling runs from nuts concatenated into a batch
-    n_burn_in: number of steps for NUTS to burn in and
+    distributions : initialized distributions object. all nbatch particles are run at once
+    n_burn_in: number of steps for NUTS to burn in and adapt its step size
+    kwargs are passed on to mjhmc.samplers.nuts.NUTS
     """
-    assert distribution.nbatch == 1
-    x_init = distribution.Xinit[:, 0]
-    samples = nuts6(distribution, n_samples, n_burn_in, x_init)[0]
-    grad_per_sample_step = distribution.dEdX_count / float(n_samples + n_burn_in)
-    e_per_sample_step = distribution.E_count / float(n_samples + n_burn_in)
-    print "grad per sample step: {}".format(grad_per_sample_step)
+    nuts = NUTS(distribution=distribution, **kwargs)
+    nuts.n_burn_in = n_burn_in
+    nuts.burn_in()
+    burn_in_grads = nuts.grad_count.copy()
+    samples = nuts.sample(n_samples, preserve_order=True)
+    # every leaf of the trajectory costs one energy and one gradient evaluation
+    grads_per_particle = np.mean(nuts.grad_trace - burn_in_grads.reshape(-1, 1), axis=0)
+    print "grad per sample step: {}".format(grads_per_particle[-1] / float(n_samples))
 
     recs = {}
     for t in xrange(n_samples):
         recs[t] = {
-            'X': samples[t].reshape(distribution.ndims, 1),
-            'num grad' : grad_per_sample_step * t,
-            'num energy' : e_per_sample_step * t
+            'X': samples[:, :, t],
+            'num grad' : grads_per_particle[t],
+            'num energy' : grads_per_particle[t]
         }
     df = pd.DataFrame.from_records(recs).T
     # might want to truncate df at gradient count
@@ -0,0 +1,138 @@
+"""
+This module contains the sampling profiler used by TensorflowDistribution when prof_run is set
+
+Tracing a session run is expensive, and writing a Chrome trace per run swamps the runs being
+  measured with disk I/O. SamplingProfiler instead traces every Nth run of each kind, until an
+  optional budget of traced wall time is spent, and aggregates op timings in memory.
+  The traces are merged into a single timeline, which is written together with a summary
+  table of the op timings by write, or when the process exits.
+"""
+import atexit
+import os
+import time
+from collections import defaultdict
+from os.path import expanduser
+
+#pylint: disable=too-many-instance-attributes
+
+class SamplingProfiler(object):
+    """ Traces a sampled subset of session runs and aggregates their op timings
+    """
+
+    #pylint: disable=too-many-arguments
+    def __init__(self, name, every=100, time_budget=None, max_traces=100,
+                 log_dir='~/tmp/logs', write_at_exit=True):
+        """ Creates a profiler
+
+        :param name: names the files written
+        :param every: trace one in every runs of each kind, starting with the first
+        :param time_budget: Optional. stop tracing once the traced runs have taken this many seconds
+        :param max_traces: maximum number of traces merged into the timeline.
+          op timings are aggregated for every traced run
+        :param log_dir: directory the timeline and summary are written to
+        :param write_at_exit: if True, write is called when the process exits
+        :returns: a new profiler
+        :rtype: SamplingProfiler
+        """
+        self.name = name
+        self.every = every
+        self.time_budget = time_budget
+        self.max_traces = max_traces
+        self.log_dir = expanduser(log_dir)
+        # kind of run -> number of runs, number of traced runs, total wall time of all runs
+        self.n_runs = defaultdict(int)
+        self.n_traced = defaultdict(int)
+        self.run_time = defaultdict(float)
+        self.traced_time = 0.
+        # (kind of run, device, op) -> number of executions, total microseconds
+        self.op_counts = defaultdict(int)
+        self.op_micros = defaultdict(int)
+        # the merged step stats of the first max_traces traced runs
+        self.step_stats = None
+        self.n_merged = 0
+        if write_at_exit:
+            atexit.register(self.write)
+
+    def should_trace(self, kind):
+        """ Returns True if the next run of kind should be traced
+        """
+        if self.time_budget is not None and self.traced_time >= self.time_budget:
+            return False
+        return self.n_runs[kind] % self.every == 0
+
+    def record(self, kind, wall_time, step_stats=None):
+        """ Records a run of kind, and its trace if it was traced
+
+        :param kind: kind of run, eg 'energy' or 'grad'
+        :param wall_time: seconds taken by the run
+        :param step_stats: the step_stats of the RunMetadata of a traced run
+        :returns: None
+        :rtype: None
+        """
+        self.n_runs[kind] += 1
+        self.run_time[kind] += wall_time
+        if step_stats is None:
+            return
+        self.n_traced[kind] += 1
+        self.traced_time += wall_time
+        for dev_stats in step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                key = (kind, dev_stats.device, node_stats.node_name)
+                self.op_counts[key] += 1
+                self.op_micros[key] += node_stats.all_end_rel_micros
+        if self.n_merged < self.max_traces:
+            if self.step_stats is None:
+                self.step_stats = type(step_stats)()
+            # node start times are absolute, so merged runs follow each other on the timeline
+            self.step_stats.MergeFrom(step_stats)
+            self.n_merged += 1
+
+    def summary(self):
+        """ Returns the aggregated op timings, slowest first
+
+        :returns: list of (kind, device, op, number of executions, total ms, mean ms)
+        :rtype: list
+        """
+        rows = []
+        for key, count in self.op_counts.items():
+            total_ms = self.op_micros[key] / 1000.
+            rows.append(key + (count, total_ms, total_ms / count))
+        return sorted(rows, key=lambda row: - row[4])
+
+    def summary_table(self):
+        """ Returns the run counts and the op summary formatted as a table
+        """
+        lines = ['{:<12} {:>8} {:>8} {:>12}'.format('run', 'calls', 'traced', 'total ms')]
+        for kind in sorted(self.n_runs):
+            lines.append('{:<12} {:>8} {:>8} {:>12.1f}'.format(
+                kind, self.n_runs[kind], self.n_traced[kind], self.run_time[kind] * 1000))
+        lines.append('')
+        lines.append('{:<12} {:<24} {:<48} {:>8} {:>12} {:>10}'.format(
+            'run', 'device', 'op', 'count', 'total ms', 'mean ms'))
+        for row in self.summary():
+            lines.append('{:<12} {:<24} {:<48} {:>8} {:>12.3f} {:>10.3f}'.format(*row))
+        return '\n'.join(lines)
+
+    def write(self):
+        """ Writes the merged timeline and the summary table to log_dir
+        Does nothing if no run has been recorded
+
+        :returns: paths of the timeline and of the summary, or None if nothing was written
+        :rtype: (string, string) or None
+        """
+        if not self.n_runs:
+            return None
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        timeline_path = '{}/tf_{}_timeline_{}.json'.format(self.log_dir, self.name, stamp)
+        summary_path = '{}/tf_{}_summary_{}.txt'.format(self.log_dir, self.name, stamp)
+        if self.step_stats is not None:
+            from tensorflow.python.client import timeline
+            with open(timeline_path, 'w') as timeline_file:
+                timeline_file.write(timeline.Timeline(self.step_stats).generate_chrome_trace_format())
+        else:
+            timeline_path = None
+        with open(summary_path, 'w') as summary_file:
+            summary_file.write(self.summary_table() + '\n')
+        return timeline_path, summary_path
@@ -0,0 +1,161 @@
+"""
+This module tunes the CPU threading of the sessions of TensorflowDistributions
+
+autotune micro-benchmarks the energy, the gradient and a compiled leapfrog trajectory of a
+  distribution with sessions configured with different intra_op and inter_op thread counts,
+  and saves the fastest configuration under the name of the distribution's initialization
+  store entry. TensorflowDistribution applies the saved configuration whenever it creates a session.
+"""
+import errno
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import numpy as np
+from mjhmc.samplers.integrators import LEAPFROG
+from .init_cache import entry_name
+from .utils import package_path
+
+# number of leapfrog steps of the benchmarked trajectory
+TRAJECTORY_STEPS = 10
+
+def thread_config_path():
+    """ Returns the path of the json file holding the tuned configuration of every distribution
+    """
+    return '{}/tf_thread_configs.json'.format(package_path())
+
+def load_thread_configs():
+    """ Returns the saved configurations, keyed by distribution entry name
+
+    :returns: entry name -> dict with the thread counts and benchmark times
+    :rtype: dict
+    """
+    try:
+        with open(thread_config_path()) as config_file:
+            return json.load(config_file)
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return {}
+
+def load_thread_config(distribution):
+    """ Returns the saved configuration of distribution, or None if it has not been tuned
+    """
+    return load_thread_configs().get(entry_name(distribution))
+
+def save_thread_config(distribution, config):
+    """ Saves config as the configuration of distribution, atomically replacing the config file
+    """
+    configs = load_thread_configs()
+    configs[entry_name(distribution)] = config
+    path = thread_config_path()
+    fd, tmp_path = tempfile.mkstemp(prefix='.tf_thread_configs.', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as config_file:
+        json.dump(configs, config_file, indent=2, sort_keys=True)
+    # mkstemp creates the file private to this user
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+def apply_thread_config(distribution, sess_config):
+    """ Sets the thread counts of sess_config to the saved configuration of distribution
+
+    :param distribution: TensorflowDistribution
+    :param sess_config: tf.ConfigProto to modify in place
+    :returns: True if a saved configuration was applied
+    :rtype: bool
+    """
+    config = load_thread_config(distribution)
+    if config is None:
+        return False
+    sess_config.intra_op_parallelism_threads = config['intra_op_parallelism_threads']
+    sess_config.inter_op_parallelism_threads = config['inter_op_parallelism_threads']
+    return True
+
+def candidate_configs(max_threads=None):
+    """ Returns the (intra_op, inter_op) thread counts to benchmark
+    0 lets tensorflow choose, the rest are powers of two up to max_threads
+
+    :param max_threads: the most threads to try. defaults to the number of cpus
+    :returns: list of (intra_op_parallelism_threads, inter_op_parallelism_threads)
+    :rtype: list
+    """
+    max_threads = max_threads or multiprocessing.cpu_count()
+    counts = [2 ** power for power in xrange(int(np.log2(max_threads)) + 1)]
+    return [(0, 0)] + [(intra, inter) for intra in counts for inter in counts
+                       if intra * inter <= max_threads]
+
+def benchmark(distribution, intra_op, inter_op, X, n_reps=20):
+    """ Times the energy, gradient and compiled trajectory of distribution at X in a session
+    with the given thread counts
+
+    :param distribution: TensorflowDistribution
+    :param intra_op: intra_op_parallelism_threads
+    :param inter_op: inter_op_parallelism_threads
+    :param X: state to evaluate at - [ndims, nbatch]
+    :param n_reps: number of timed evaluations of each, after one untimed warm up
+    :returns: mean seconds per evaluation of 'energy', 'grad' and 'trajectory'
+    :rtype: dict
+    """
+    import tensorflow as tf
+    sess_config = tf.ConfigProto(allow_soft_placement=True,
+                                 intra_op_parallelism_threads=intra_op,
+                                 inter_op_parallelism_threads=inter_op)
+    V = np.random.randn(*X.shape)
+    benchmarks = [
+        ('energy', lambda: distribution.E_val(X)),
+        ('grad', lambda: distribution.dEdX_val(X)),
+        ('trajectory', lambda: distribution.trajectory(X, V, dEdX, 1e-3, TRAJECTORY_STEPS, LEAPFROG))
+    ]
+    old_sess = distribution.sess
+    distribution.sess = tf.Session(graph=distribution.graph, config=sess_config)
+    try:
+        distribution.sess.run(distribution.init_op)
+        dEdX = distribution.dEdX_val(X)
+        times = {}
+        for name, run in benchmarks:
+            run()
+            start_time = time.time()
+            for _ in xrange(n_reps):
+                run()
+            times[name] = (time.time() - start_time) / n_reps
+        return times
+    finally:
+        distribution.sess.close()
+        distribution.sess = old_sess
+
+def autotune(distribution, nbatch=None, configs=None, n_reps=20, save=True):
+    """ Benchmarks every thread configuration in configs and saves the fastest for distribution
+    The fastest configuration minimizes the time of one trajectory plus one energy
+     and one gradient evaluation
+
+    :param distribution: TensorflowDistribution
+    :param nbatch: number of particles to benchmark with. defaults to distribution.nbatch
+    :param configs: list of (intra_op, inter_op) thread counts. defaults to candidate_configs()
+    :param n_reps: number of timed evaluations per benchmark
+    :param save: if True, the best configuration is saved and used for new sessions
+    :returns: the best configuration, with its benchmark times
+    :rtype: dict
+    """
+    nbatch = nbatch or distribution.nbatch
+    X = distribution.Xinit[:, np.arange(nbatch) % distribution.Xinit.shape[1]]
+    # benchmarking should not show up in the counters or the profile
+    counts = distribution.E_count, distribution.dEdX_count
+    profiler, distribution.profiler = distribution.profiler, None
+    try:
+        results = []
+        for intra_op, inter_op in configs or candidate_configs():
+            times = benchmark(distribution, intra_op, inter_op, X, n_reps)
+            results.append((sum(times.values()), {
+                'intra_op_parallelism_threads': intra_op,
+                'inter_op_parallelism_threads': inter_op,
+                'nbatch': nbatch,
+                'times': times
+            }))
+    finally:
+        distribution.E_count, distribution.dEdX_count = counts
+        distribution.profiler = profiler
+    best = min(results, key=lambda result: result[0])[1]
+    if save:
+        save_thread_config(distribution, best)
+    return best
@@ -4,11 +4,9 @@ This module contains the TensorflowDistribution base class and distributions tha
 
 import numpy as np
 import tensorflow as tf
-from tensorflow.python.client import timeline
 from .utils import overrides, package_path
 import os
 import time
-from os.path import expanduser
 from scipy import stats
 from scipy.io import loadmat
 import pickle
@@ -16,6 +14,8 @@ from math import sqrt
 
 
 from mjhmc.misc.distributions import Distribution
+from mjhmc.misc.profiler import SamplingProfiler
+from mjhmc.misc.tf_autotune import apply_thread_config
 
 
 class TensorflowDistribution(Distribution):
@@ -24,7 +24,7 @@ class TensorflowDistribution(Distribution):
 
     You should give your TensorflowDistribution objects a name. Use a
     descriptive name, and use the same for functionally equivalent
-    TensorflowDistributions - the hash of the name is used to label the
+    TensorflowDistributions - the digest of the name is used to label the
     initialization information which is generated at first run time of
     a new distribution. This requirement is a side effect of the
     unfortunate fact that there is no computable hash function which
@@ -45,10 +45,13 @@ class TensorflowDistribution(Distribution):
         :param name: name of this distribution. use the same name for functionally identical distributions
         :param sess: optional session. If none, one will be created
         :param device: device to execute tf ops on. By default uses cpu to avoid compatibility issues
-        :param prof_run: if True, save a trace so we can profile performance later
+        :param prof_run: if True, trace a sample of the session runs and write their merged
+          timeline and op summary under ~/tmp/logs at exit. may also be a SamplingProfiler
         :param gpu_frac: fraction of GPU memory to allocate.
         :param allow_growth: if False, pre-allocate all GPU memory
         :param log_placement: if True, log device placement
+          The session uses the thread counts saved by mjhmc.misc.tf_autotune.autotune for
+          this distribution, if name is given and it has been tuned
         :returns: TensorflowDistribution object
         :rtype: TensorflowDistribution
         """
@@ -68,15 +71,26 @@ class TensorflowDistribution(Distribution):
         self.device = self.energy_device
 
         self.prof_run = prof_run
+        # graph_key -> (state_pl, energy_op, grad_op, trajectory_ops)
+        self.built_graphs = {}
+        # cache_params may need the name to label the tuned thread configuration
+        self.name = name
         with self.graph.as_default(), tf.device(self.device):
             gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac, allow_growth=allow_growth)
             sess_config = tf.ConfigProto(allow_soft_placement=True, gpu_options=gpu_options,
                                          log_device_placement=log_placement)
+            # use the thread counts found by tf_autotune.autotune, if there are any
+            if name is not None:
+                apply_thread_config(self, sess_config)
             self.sess = sess or tf.Session(config=sess_config)
             self.build_graph()
 
 
         self.name = name or self.energy_op.op.name
+        if prof_run is True:
+            self.profiler = SamplingProfiler(self.name)
+        else:
+            self.profiler = prof_run or None
 
         super(TensorflowDistribution, self).__init__(ndims=self.ndims, nbatch=self.nbatch)
 
@@ -85,11 +99,31 @@ class TensorflowDistribution(Distribution):
 
 
     def build_graph(self):
-        with self.graph.as_default(), tf.device(self.device):
-            self.state_pl = tf.placeholder(tf.float32, [self.ndims, None])
-            self.build_energy_op()
-            self.grad_op = tf.gradients(self.energy_op, self.state_pl)[0]
-            self.sess.run(tf.initialize_all_variables())
+        """ Sets the state placeholder, energy op and gradient op for the current nbatch
+        Ops are only built the first time they are needed for a graph_key, and reused
+         afterwards, so resets and initialization generation do not grow the graph
+        """
+        key = self.graph_key()
+        if key not in self.built_graphs:
+            with self.graph.as_default(), tf.device(self.device):
+                self.state_pl = tf.placeholder(tf.float32, [self.ndims, None])
+                self.build_energy_op()
+                self.grad_op = tf.gradients(self.energy_op, self.state_pl)[0]
+                self.init_op = tf.initialize_all_variables()
+                self.sess.run(self.init_op)
+            # compiled trajectories, built on first use. see trajectory
+            self.built_graphs[key] = (self.state_pl, self.energy_op, self.grad_op, {})
+        self.state_pl, self.energy_op, self.grad_op, self.trajectory_ops = self.built_graphs[key]
+
+    def graph_key(self):
+        """ Returns the value of the attributes the ops built by build_energy_op depend on
+        The state placeholder has a dynamic batch dimension, so by default a single set of ops
+         serves every number of particles. Subclasses whose energy op is built for a fixed
+         number of particles should override this to return self.nbatch
+
+        :returns: hashable key
+        """
+        return None
 
 
     def build_energy_op(self):
@@ -98,46 +132,140 @@ class TensorflowDistribution(Distribution):
         """
         raise NotImplementedError("this method must be defined to subclass TensorflowDistribution")
 
+    def energy_of(self, state):
+        """ Returns a new energy op evaluated at the tensor state instead of at state_pl
+        build_energy_op reads self.state_pl, so it is pointed at state while the op is built
+
+        :param state: tensor of shape [ndims, n_particles]
+        :returns: energy of each particle - [n_particles]
+        :rtype: tf.Tensor
+        """
+        state_pl, energy_op = self.state_pl, self.energy_op
+        self.state_pl = state
+        try:
+            self.build_energy_op()
+            return self.energy_op
+        finally:
+            self.state_pl, self.energy_op = state_pl, energy_op
+
+    def build_trajectory_op(self, integrator):
+        """ Builds a while loop integrating the energy with integrator, in a single graph
+
+        Returns the placeholders for the start point X, V, the tempered gradient dEdX at X,
+         the step sizes, the inverse temperatures and the number of steps,
+         and the ops for X, V, dEdX and the tempered energy at the end point.
+        Unlike SplittingIntegrator.integrate, adjacent kicks are not merged,
+         which only saves python dispatches
+
+        :param integrator: mjhmc.samplers.integrators.SplittingIntegrator
+        :returns: placeholders, end point ops
+        :rtype: (tuple, tuple)
+        """
+        with self.graph.as_default(), tf.device(self.grad_device):
+            X_pl = tf.placeholder(tf.float32, [self.ndims, None], name='trajectory_X')
+            V_pl = tf.placeholder(tf.float32, [self.ndims, None], name='trajectory_V')
+            dEdX_pl = tf.placeholder(tf.float32, [self.ndims, None], name='trajectory_dEdX')
+            # [1, n_particles]
+            epsilon_pl = tf.placeholder(tf.float32, [1, None], name='trajectory_epsilon')
+            inv_temperature_pl = tf.placeholder(tf.float32, [1, None], name='trajectory_inv_temperature')
+            n_steps_pl = tf.placeholder(tf.int32, [], name='trajectory_n_steps')
+
+            def step(step_idx, X, V, dEdX, energy):
+                for stage, drift in enumerate(integrator.drifts):
+                    V = V - integrator.kicks[stage] * epsilon_pl * dEdX
+                    X = X + drift * epsilon_pl * V
+                    energy = self.energy_of(X) * inv_temperature_pl[0]
+                    dEdX = tf.gradients(energy, X)[0]
+                V = V - integrator.kicks[-1] * epsilon_pl * dEdX
+                return step_idx + 1, X, V, dEdX, energy
+
+            _, X, V, dEdX, energy = tf.while_loop(
+                lambda step_idx, *_: step_idx < n_steps_pl, step,
+                [tf.constant(0), X_pl, V_pl, dEdX_pl, tf.zeros_like(X_pl[0])])
+        return ((X_pl, V_pl, dEdX_pl, epsilon_pl, inv_temperature_pl, n_steps_pl),
+                (X, V, dEdX, energy))
+
+    def trajectory(self, X, V, dEdX, epsilon, n_steps, integrator, inv_temperature=None):
+        """ Integrates the particles X, V for n_steps steps of integrator in a single session run
+        Used by HMCState in place of integrator.integrate and the energy evaluation at the end point.
+        Energies and gradients are scaled by inv_temperature if it is given
+
+        :param X: positions - [ndims, n_particles]
+        :param V: momenta - [ndims, n_particles]
+        :param dEdX: tempered energy gradient at X - [ndims, n_particles]
+        :param epsilon: step size. either a scalar or an array of shape (1, n_particles)
+        :param n_steps: number of steps to take
+        :param integrator: mjhmc.samplers.integrators.SplittingIntegrator
+        :param inv_temperature: Optional. inverse temperature of each particle - [1, n_particles]
+        :returns: X, V, tempered dEdX - [ndims, n_particles] and tempered energy - [1, n_particles]
+          at the end point
+        :rtype: (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+        """
+        n_particles = X.shape[1]
+        if inv_temperature is None:
+            inv_temperature = np.ones((1, n_particles))
+        if n_steps == 0:
+            # the loop would not set the energy
+            return X.copy(), V.copy(), dEdX, self.E(X).reshape((1, -1)) * inv_temperature
+        key = (tuple(integrator.kicks), tuple(integrator.drifts))
+        if key not in self.trajectory_ops:
+            self.trajectory_ops[key] = self.build_trajectory_op(integrator)
+        placeholders, end_point = self.trajectory_ops[key]
+        feed_values = (X, V, dEdX, epsilon * np.ones((1, n_particles)), inv_temperature, n_steps)
+        self.E_count += n_particles
+        self.dEdX_count += n_particles * n_steps * integrator.n_stages
+        with self.graph.as_default(), tf.device(self.grad_device):
+            X, V, dEdX, energy = self.run(list(end_point), dict(zip(placeholders, feed_values)),
+                                          'trajectory')
+        return X, V, dEdX, energy.reshape((1, -1))
+
+    def run(self, fetches, feed_dict, label):
+        """ Evaluates fetches in a single session run
+        If prof_run is set, the run is timed, and traced if the profiler samples it
+
+        :param fetches: op or list of ops to evaluate
+        :param feed_dict: values of the placeholders
+        :param label: kind of run, for the profiler
+        :returns: the values of fetches
+        """
+        if self.profiler is None:
+            return self.sess.run(fetches, feed_dict=feed_dict)
+        if self.profiler.should_trace(label):
+            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+            start_time = time.time()
+            values = self.sess.run(fetches, feed_dict=feed_dict,
+                                   options=run_options, run_metadata=run_metadata)
+            self.profiler.record(label, time.time() - start_time, run_metadata.step_stats)
+        else:
+            start_time = time.time()
+            values = self.sess.run(fetches, feed_dict=feed_dict)
+            self.profiler.record(label, time.time() - start_time)
+        return values
+
     @overrides(Distribution)
     def E_val(self, X):
         with self.graph.as_default(), tf.device(self.energy_device):
-            if self.prof_run:
-                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-                run_metadata = tf.RunMetadata()
-
-                energy = self.sess.run(self.energy_op, feed_dict={self.state_pl: X},
-                                       options=run_options, run_metadata=run_metadata)
-                tf_tl  = timeline.Timeline(run_metadata.step_stats)
-                ctf = tf_tl.generate_chrome_trace_format()
-                log_path = expanduser('~/tmp/logs/tf_{}_energy_timeline_{}.json'.format(self.name, time.time()))
-                with open(log_path, 'w') as log_file:
-                    log_file.write(ctf)
-            else:
-                energy = self.sess.run(self.energy_op, feed_dict={self.state_pl: X})
-            return energy
+            return self.run(self.energy_op, {self.state_pl: X}, 'energy')
 
     @overrides(Distribution)
     def dEdX_val(self, X):
         with self.graph.as_default(), tf.device(self.grad_device):
-            if self.prof_run:
-                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-                run_metadata = tf.RunMetadata()
-
-                grad = self.sess.run(self.grad_op, feed_dict={self.state_pl: X},
-                                       options=run_options, run_metadata=run_metadata)
-
-                tf_tl  = timeline.Timeline(run_metadata.step_stats)
-                ctf = tf_tl.generate_chrome_trace_format()
-                log_path = expanduser('~/tmp/logs/tf_{}_grad_timeline_{}.json'.format(self.name, time.time()))
-                with open(log_path, 'w') as log_file:
-                    log_file.write(ctf)
-            else:
-                grad = self.sess.run(self.grad_op, feed_dict={self.state_pl: X})
-            return grad
+            return self.run(self.grad_op, {self.state_pl: X}, 'grad')
+
+    @overrides(Distribution)
+    def E_dEdX_val(self, X):
+        """ Fetches the energy and its gradient in one session run,
+        feeding X to the graph only once
+        """
+        with self.graph.as_default(), tf.device(self.grad_device):
+            energy, grad = self.run([self.energy_op, self.grad_op], {self.state_pl: X},
+                                    'energy_grad')
+            return energy, grad
 
     @overrides(Distribution)
-    def __hash__(self):
-        return hash((self.ndims, self.name))
+    def cache_params(self):
+        return (self.ndims, self.name)
 
 class Funnel(TensorflowDistribution):
     """ This class implements the Funnel distribution as specified in Neal, 2003
@@ -173,7 +301,11 @@ class Funnel(TensorflowDistribution):
         self.Xinit = np.vstack((x_0, x_k))
 
     @overrides(Distribution)
-    def __hash__(self):
+    def cache_params(self):
+        return (self.scale, self.ndims)
+
+    @overrides(Distribution)
+    def legacy_hash(self):
         return hash((self.scale, self.ndims))
 
 class TFGaussian(TensorflowDistribution):
@@ -198,8 +330,8 @@ class TFGaussian(TensorflowDistribution):
         self.Xinit = np.random.randn(self.ndims, self.nbatch)
 
     @overrides(Distribution)
-    def __hash__(self):
-        return hash((self.ndims, self.sigma))
+    def cache_params(self):
+        return (self.ndims, self.sigma)
 
 class SparseImageCode(TensorflowDistribution):
     """ Distribution over the coefficients in an inference model of sparse coding on natural images a la Olshausen and Field
@@ -241,26 +373,24 @@ class SparseImageCode(TensorflowDistribution):
     @overrides(TensorflowDistribution)
     def build_energy_op(self):
         with self.graph.as_default(), tf.device(self.device):
-            n_active = tf.shape(self.state_pl)[1]
-            # [n_patches, 1, img_size]
-            self.patches = tf.to_float(tf.reshape(self.patches,
-                                                  [self.n_patches, 1, self.img_size]),
-                                       name='patches')
-            shaped_state = tf.reshape(self.state_pl, [self.n_patches, -1, self.n_coeffs, 1], name='shaped_state')
-
-            # [n_patches, nbatch, img_size, n_coeffs]
-            full_tiled_basis_arr = np.tile(np.reshape(self.basis, (1, 1, self.img_size, self.n_coeffs)),
-                                           (self.n_patches, self.nbatch, 1, 1))
-            full_tiled_basis_tf = tf.constant(full_tiled_basis_arr)
-            # [n_patches, n_active, img_size, n_coeffs]
-            shaped_basis = full_tiled_basis_tf[:, :n_active, :, :]
-
-
-            # [n_patches, nbatch, img_size]
-            reconstructions = tf.batch_matmul(shaped_basis, shaped_state, name='reconstructions')[:, :, :, 0]
-            # [n_patches, nbatch]
-            reconstruction_error = tf.reduce_sum(0.5 * (self.patches - reconstructions) ** 2, -1)
-            # [nbatch]
+            # [img_size, n_patches, 1]
+            patches = tf.constant(self.patches.T.reshape((self.img_size, self.n_patches, 1)),
+                                  dtype=tf.float32, name='patches')
+            # the basis is shared by every patch and particle, so it is stored once
+            # [img_size, n_coeffs]
+            basis = tf.constant(self.basis, dtype=tf.float32, name='basis')
+            # the coefficients of patch p are rows p * n_coeffs to (p + 1) * n_coeffs of the state
+            # [n_coeffs, n_patches * n_active]
+            coeffs = tf.reshape(tf.transpose(tf.reshape(self.state_pl, [self.n_patches, self.n_coeffs, -1]),
+                                             [1, 0, 2]),
+                                [self.n_coeffs, -1], name='coeffs')
+            # all patches of all particles are reconstructed by a single matmul
+            # [img_size, n_patches, n_active]
+            reconstructions = tf.reshape(tf.matmul(basis, coeffs),
+                                         [self.img_size, self.n_patches, -1], name='reconstructions')
+            # [n_patches, n_active]
+            reconstruction_error = tf.reduce_sum(0.5 * (patches - reconstructions) ** 2, 0)
+            # [n_active]
             reconstruction_error = tf.reduce_mean(reconstruction_error, 0, name='reconstruction_error')
 
             if self.cauchy:
@@ -273,12 +403,19 @@ class SparseImageCode(TensorflowDistribution):
 
 
     @overrides(Distribution)
-    def __hash__(self):
-        # so they can be hashed
-        self.imgs.flags.writeable = False
-        self.basis.flags.writeable = False
-        return hash((hash(self.imgs.data),
-                     hash(self.basis.data),
+    def cache_params(self):
+        return (self.imgs,
+                self.basis,
+                self.lmbda,
+                self.n_patches,
+                self.n_coeffs,
+                self.cauchy)
+
+    @overrides(Distribution)
+    def legacy_hash(self):
+        # the hash of an array's buffer is the hash of its bytes
+        return hash((hash(np.ascontiguousarray(self.imgs).tostring()),
+                     hash(np.ascontiguousarray(self.basis).tostring()),
                      hash(self.lmbda),
                      hash(self.n_patches),
                      self.n_coeffs))
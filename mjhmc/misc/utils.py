@@ -70,3 +70,44 @@ def package_path():
         raise Exception('You must include MJHMC in your PYTHON_PATH')
     prefix = mjhmc_path.split('MJHMC')[0]
     return "{}MJHMC".format(prefix)
+
+def stable_digest(params):
+    """ Returns a hex digest of params that is identical across processes, platforms and runs
+    Unlike hash, it does not depend on the hash randomization of strings
+
+    :param params: nested tuples or lists of numbers, strings, None,
+      numpy arrays and scipy.sparse matrices
+    :returns: sha1 hex digest of the contents of params
+    :rtype: string
+    """
+    import hashlib
+    sha = hashlib.sha1()
+    def update(param):
+        if isinstance(param, (tuple, list)):
+            sha.update('({}:'.format(len(param)).encode('ascii'))
+            for item in param:
+                update(item)
+            sha.update(b')')
+        elif hasattr(param, 'tocsr'):
+            # scipy.sparse matrix
+            csr = param.tocsr()
+            csr.sort_indices()
+            update(('sparse', csr.shape, csr.data, csr.indices, csr.indptr))
+        elif isinstance(param, (np.ndarray, np.generic)):
+            arr = np.ascontiguousarray(param)
+            sha.update('array:{}:{}:'.format(arr.dtype.str, arr.shape).encode('ascii'))
+            sha.update(arr.tostring())
+        elif isinstance(param, basestring):
+            if isinstance(param, unicode):
+                param = param.encode('utf-8')
+            sha.update('str:{}:'.format(len(param)).encode('ascii') + param)
+        elif param is None or isinstance(param, bool):
+            sha.update('{!r}:'.format(param).encode('ascii'))
+        elif isinstance(param, (int, long)):
+            sha.update('int:{:d}:'.format(param).encode('ascii'))
+        elif isinstance(param, float):
+            sha.update('float:{!r}:'.format(param).encode('ascii'))
+        else:
+            raise TypeError("Cannot digest parameter of type {}".format(type(param)))
+    update(params)
+    return sha.hexdigest()
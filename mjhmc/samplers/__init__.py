@@ -1,7 +1,7 @@
 """
   Initialization and import management for samplers subpackage
 """
-__all__ = ['algebraic_hmc', 'generic_discrete', 'markov_jump_hmc']
+__all__ = ['algebraic_hmc', 'generic_discrete', 'markov_jump_hmc', 'nuts', 'stochastic_gradient', 'tempering']
 
 # import mjhmc.samplers.algebraic_hmc
 # import mjhmc.samplers.generic_discrete
@@ -1,16 +1,19 @@
 """
 This file contains the class HMC state which holds state variables,
-  provides leapfrog integration methods and serves as a cache
+  applies the ladder operators L, F and R through the parent's integrator and serves as a cache
 """
 
 import numpy as np
 
 #pylint: disable=too-many-class-attributes
 
+# default number of ladder rungs remembered per particle
+LADDER_CACHE_SIZE = 8
+
 class HMCState(object):
     """ Holds all the state variables for sampling particles."""
 
-    def __init__(self, X, parent, V=None, EX=None, EV=None, dEdX=None, slave=False):
+    def __init__(self, X, parent, V=None, EX=None, EV=None, dEdX=None, ladder=None):
         """
         Initialize sampling particle states.  Called by all continuous state
          space sampler classes
@@ -25,39 +28,70 @@ class HMCState(object):
             N = self.X.shape[0]
             self.V = np.random.randn(N, self.nbatch)
         self.EX = EX
-        if EX is None:
+        self.dEdX = dEdX
+        if EX is None and dEdX is None:
+            self.EX = np.zeros((1,self.nbatch))
+            self.dEdX = np.zeros(X.shape)
+            self.update_EX_dEdX()
+        elif EX is None:
             self.EX = np.zeros((1,self.nbatch))
             self.update_EX()
+        elif dEdX is None:
+            self.dEdX = np.zeros(X.shape)
+            self.update_dEdX()
 
         self.EV = EV
         if EV is None:
             self.EV = np.zeros((1,self.nbatch))
             self.update_EV()
-        self.dEdX = dEdX
-        if dEdX is None:
-            self.dEdX = np.zeros(X.shape)
-            self.update_dEdX()
 
-        if not slave:
-            self.cached_flf_state = self.copy(copy_slave=True)
-            # True at idx if the cache holds the flf_state at idx
-            self.cache_active = np.array([False] * self.nbatch)
+        # the ladder cache is shared between a state and all of its copies
+        # copies only carry their own position on the ladder
+        self.ladder = ladder
+        if ladder is None:
+            cache_size = getattr(parent, 'ladder_cache_size', LADDER_CACHE_SIZE)
+            self.ladder = LadderCache(X.shape[0], self.nbatch, cache_size)
+            self.reset_ladder_cache()
+
+    def temper(self, values):
+        """ Scales the energies or gradients of the active particles by their
+        inverse temperature, if the parent has one """
+        inv_temperature = getattr(self.parent, 'inv_temperature', None)
+        if inv_temperature is None:
+            return values
+        return values * inv_temperature[:, self.active_idx]
 
     def update_EX(self):
-        self.EX[:,self.active_idx] = self.parent.E(self.X[:,self.active_idx]).reshape((1,-1))
+        if len(self.active_idx) == 0:
+            return
+        EX = self.parent.E(self.X[:,self.active_idx]).reshape((1,-1))
+        self.EX[:,self.active_idx] = self.temper(EX)
 
     def update_EV(self):
         self.EV[:,self.active_idx] = np.sum(self.V[:,self.active_idx]**2, axis=0).reshape((1,-1))/2.
 
     def update_dEdX(self):
-        self.dEdX[:,self.active_idx] = self.parent.dEdX(self.X[:,self.active_idx])
+        if len(self.active_idx) == 0:
+            return
+        dEdX = self.parent.dEdX(self.X[:,self.active_idx])
+        self.dEdX[:,self.active_idx] = self.temper(dEdX)
 
-    def copy(self, copy_slave=False):
-        Z = HMCState(self.X.copy(), self.parent, V=self.V.copy(), EX=self.EX.copy(), EV=self.EV.copy(), dEdX=self.dEdX.copy(), slave=copy_slave)
+    def update_EX_dEdX(self):
+        """ Updates the energy and its gradient together
+        The parent evaluates both in a single call if its distribution can """
+        if len(self.active_idx) == 0:
+            return
+        EX, dEdX = self.parent.E_dEdX(self.X[:,self.active_idx])
+        self.EX[:,self.active_idx] = self.temper(EX)
+        self.dEdX[:,self.active_idx] = self.temper(dEdX)
+
+    def copy(self):
+        Z = HMCState(self.X.copy(), self.parent, V=self.V.copy(), EX=self.EX.copy(), EV=self.EV.copy(),
+                     dEdX=self.dEdX.copy(), ladder=self.ladder)
         Z.active_idx = self.active_idx.copy()
-        if not copy_slave:
-            Z.cached_flf_state = self.cached_flf_state.copy(True)
-            Z.cache_active = self.cache_active.copy()
+        Z.ladder_pos = self.ladder_pos.copy()
+        Z.ladder_dir = self.ladder_dir.copy()
+        Z.ladder_epoch = self.ladder_epoch.copy()
         return Z
 
     def update(self, idx, Z):
@@ -70,6 +104,9 @@ class HMCState(object):
         self.EX[:, idx] = Z.EX[:, idx]
         self.EV[:, idx] = Z.EV[:, idx]
         self.dEdX[:, idx] = Z.dEdX[:, idx]
+        self.ladder_pos[idx] = Z.ladder_pos[idx]
+        self.ladder_dir[idx] = Z.ladder_dir[idx]
+        self.ladder_epoch[idx] = Z.ladder_epoch[idx]
 
     def get_state(self):
         """returns the concatentaion of X and V
@@ -83,20 +120,52 @@ class HMCState(object):
         """
         return self.EX + self.EV
 
-    def leapfrog(self):
-        """ A single leapfrog step for X and V """
-        self.V[:, self.active_idx] += -self.parent.epsilon/2. * self.dEdX[:, self.active_idx]
-        self.X[:, self.active_idx] += self.parent.epsilon * self.V[:, self.active_idx]
-        self.update_dEdX()
-        self.V[:, self.active_idx] += -self.parent.epsilon/2. * self.dEdX[:, self.active_idx]
+    def integrate(self, epsilon, n_steps):
+        """ Integrates the active particles with the parent's integrator and updates their energy
+        If the parent's distribution provides a compiled trajectory, as TensorflowDistribution
+          does, the whole trajectory is computed by it in a single call
+
+        :param epsilon: step size. either a scalar or an array of shape (1, nbatch)
+        :param n_steps: number of steps to take
+        :returns: None
+        :rtype: None
+        """
+        trajectory = getattr(getattr(self.parent, 'distribution', None), 'trajectory', None)
+        if trajectory is None:
+            self.parent.integrator.integrate(self, epsilon, n_steps, update_EX=True)
+            return
+        idx = self.active_idx
+        if len(idx) == 0:
+            return
+        if np.ndim(epsilon) > 0:
+            epsilon = epsilon[:, idx]
+        inv_temperature = getattr(self.parent, 'inv_temperature', None)
+        if inv_temperature is not None:
+            inv_temperature = inv_temperature[:, idx]
+        (self.X[:, idx], self.V[:, idx], self.dEdX[:, idx],
+         self.EX[:, idx]) = trajectory(self.X[:, idx], self.V[:, idx], self.dEdX[:, idx],
+                                       epsilon, n_steps, self.parent.integrator, inv_temperature)
 
     def L(self):
-        """ Run the leapfrog operator for M leapfrog steps
+        """ Run the parent's integrator for M steps on the active particles
+        particles whose destination rung is in the ladder cache are read from it
         returns self for convenience"""
-        for _ in range(self.parent.num_leapfrog_steps):
-            self.leapfrog()
-        self.update_EV()
-        self.update_EX()
+        moving_idx = self.active_idx
+        self.cache_ladder_rung(moving_idx)
+        target_pos = self.ladder_pos[moving_idx] + self.ladder_dir[moving_idx]
+        hit = self.ladder.lookup(moving_idx, target_pos, self.ladder_epoch[moving_idx])
+        cached_idx = moving_idx[hit]
+
+        self.active_idx = moving_idx[~hit]
+        if len(self.active_idx) > 0:
+            self.integrate(self.parent.epsilon, self.parent.num_leapfrog_steps)
+            self.update_EV()
+        computed_idx = self.active_idx
+        self.active_idx = moving_idx
+
+        self.ladder_pos[moving_idx] = target_pos
+        self.ladder.fetch(cached_idx, self)
+        self.cache_ladder_rung(computed_idx)
         return self
 
     def F(self):
@@ -104,45 +173,120 @@ class HMCState(object):
         returns self for convenience
         """
         self.V[:, self.active_idx] = - self.V[:, self.active_idx]
+        self.ladder_dir[self.active_idx] = - self.ladder_dir[self.active_idx]
         return self
 
     def FLF(self):
         """
         Returns the FLF state
-        reads from the cache if possible
+        reads from the ladder cache if possible
         """
-        cached_idx = np.where(self.cache_active == True)[0]
-        self.active_idx = np.where(self.cache_active == False)[0]
-        flf_state = self.F().L().F()
-        flf_state.update(cached_idx, self.cached_flf_state)
-        self.active_idx = np.arange(self.nbatch)
-        return flf_state
+        return self.F().L().F()
 
     def R(self):
         """randomizes the momentum with rate beta
-        resets the cache
+        starts a new ladder
         return self for convenience
         """
         self.V = self.V*np.sqrt(1.-self.parent.beta) + np.random.randn(
             self.parent.ndims, self.nbatch)*np.sqrt(self.parent.beta)
         self.update_EV()
+        self.reset_ladder_cache()
         return self
 
-    def cache_flf_state(self, idx, Z):
+    def cache_ladder_rung(self, idx):
         """
-        stores a copy of Z as the flf_state
+        stores the current state of the particles idx as their current ladder rung
         """
-        self.cached_flf_state.update(idx, Z)
-        self.cache_active[idx] = True
+        self.ladder.store(idx, self)
 
-    def clear_flf_cache(self, idx):
+    def reset_ladder_cache(self, idx=None):
+        """ Starts a new ladder for the particles idx, or for every particle if idx is None
+        Previously cached rungs are never read again
         """
-        clears the cached flf state
+        if idx is None:
+            self.ladder_pos = np.zeros(self.nbatch, dtype=int)
+            self.ladder_dir = np.ones(self.nbatch, dtype=int)
+            self.ladder_epoch = self.ladder.new_epochs(self.nbatch)
+        elif len(idx) > 0:
+            self.ladder_pos[idx] = 0
+            self.ladder_dir[idx] = 1
+            self.ladder_epoch[idx] = self.ladder.new_epochs(len(idx))
+
+
+class LadderCache(object):
+    """ Per particle ring buffer of visited ladder rungs
+
+    Between momentum randomizations a particle only moves between rungs
+      L^k zeta of a deterministic ladder, so every rung it has integrated
+      to can be served from memory the next time it is needed.
+    Rungs are keyed by (epoch, position) where a new epoch is started whenever
+      the ladder is invalidated, ie on R.
+    Momentum is stored in the orientation of the ladder at the start of the epoch;
+      HMCState.ladder_dir records whether the particle currently has it flipped.
+    """
+
+    def __init__(self, ndims, nbatch, size=LADDER_CACHE_SIZE):
+        """ Creates an empty cache holding size rungs for each of nbatch particles
+
+        :param ndims: dimension of the state space
+        :param nbatch: number of sampling particles
+        :param size: number of rungs remembered per particle. 0 disables the cache
+        :returns: a new cache
+        :rtype: LadderCache
         """
-        # to be called from update
-        self.cache_active[idx] = False
+        self.size = size
+        self.nbatch = nbatch
+        # [size, nbatch, ndims]
+        self.X = np.zeros((size, nbatch, ndims))
+        self.V = np.zeros((size, nbatch, ndims))
+        self.dEdX = np.zeros((size, nbatch, ndims))
+        # [size, nbatch]
+        self.EX = np.zeros((size, nbatch))
+        self.EV = np.zeros((size, nbatch))
+        self.pos = np.zeros((size, nbatch), dtype=int)
+        self.epoch = - np.ones((size, nbatch), dtype=int)
+        self.n_epochs = 0
 
-    def reset_flf_cache(self):
-        """ Entirely wipes the cache
+    def new_epochs(self, n):
+        """ Returns n never before used epoch labels
         """
-        self.cache_active = np.zeros_like(self.cache_active)
+        epochs = np.arange(self.n_epochs, self.n_epochs + n)
+        self.n_epochs += n
+        return epochs
+
+    def lookup(self, idx, pos, epoch):
+        """ Returns a boolean array of shape (len(idx),), True where rung pos of ladder epoch
+        is cached for particle idx
+        """
+        if self.size == 0:
+            return np.zeros(len(idx), dtype=bool)
+        slots = pos % self.size
+        return (self.epoch[slots, idx] == epoch) & (self.pos[slots, idx] == pos)
+
+    def store(self, idx, Z):
+        """ Stores the current rung of the particles idx of state Z
+        """
+        if self.size == 0 or len(idx) == 0:
+            return
+        slots = Z.ladder_pos[idx] % self.size
+        ladder_dir = Z.ladder_dir[idx]
+        self.X[slots, idx] = Z.X[:, idx].T
+        self.V[slots, idx] = (Z.V[:, idx] * ladder_dir).T
+        self.dEdX[slots, idx] = Z.dEdX[:, idx].T
+        self.EX[slots, idx] = Z.EX[0, idx]
+        self.EV[slots, idx] = Z.EV[0, idx]
+        self.pos[slots, idx] = Z.ladder_pos[idx]
+        self.epoch[slots, idx] = Z.ladder_epoch[idx]
+
+    def fetch(self, idx, Z):
+        """ Overwrites the particles idx of state Z with their cached current rung
+        """
+        if len(idx) == 0:
+            return
+        slots = Z.ladder_pos[idx] % self.size
+        Z.X[:, idx] = self.X[slots, idx].T
+        Z.V[:, idx] = self.V[slots, idx].T * Z.ladder_dir[idx]
+        Z.dEdX[:, idx] = self.dEdX[slots, idx].T
+        Z.EX[0, idx] = self.EX[slots, idx]
+        Z.EV[0, idx] = self.EV[slots, idx]
@@ -0,0 +1,109 @@
+"""
+This file contains the symplectic integrators used by HMCState to apply the L operator
+
+All of the integrators are symmetric splitting schemes: alternating kicks of the momentum
+  by the energy gradient and drifts of the position by the momentum.
+  They are time reversible and volume preserving, so any of them can be used to
+  build the ladder in any of the samplers.
+Adjacent kicks of consecutive steps are merged, so an integrator with n_stages
+  drifts per step costs exactly n_stages gradient evaluations per step.
+"""
+
+import numpy as np
+
+class SplittingIntegrator(object):
+    """ Symmetric splitting integrator defined by its kick and drift coefficients
+
+    A single step of size epsilon applies
+      kick(kicks[0]) drift(drifts[0]) kick(kicks[1]) ... drift(drifts[-1]) kick(kicks[-1])
+      where kick(b) is V -= b * epsilon * dEdX and drift(a) is X += a * epsilon * V
+    """
+
+    def __init__(self, kicks, drifts, name=None):
+        """ Creates an integrator from its splitting coefficients
+
+        :param kicks: momentum update coefficients. must have one more element than drifts
+        :param drifts: position update coefficients
+        :param name: name of the scheme
+        :returns: a new integrator
+        :rtype: SplittingIntegrator
+        """
+        assert len(kicks) == len(drifts) + 1
+        assert np.isclose(np.sum(kicks), 1) and np.isclose(np.sum(drifts), 1)
+        self.kicks = [float(kick) for kick in kicks]
+        self.drifts = [float(drift) for drift in drifts]
+        self.n_stages = len(drifts)
+        self.name = name
+
+    def integrate(self, Z, epsilon, n_steps, update_EX=False):
+        """ Integrates the active particles of Z for n_steps steps of size epsilon
+        Updates Z.X, Z.V and Z.dEdX in place, and Z.EX if update_EX is set
+
+        :param Z: HMCState to integrate
+        :param epsilon: step size. either a scalar or an array of shape (1, nbatch)
+        :param n_steps: number of steps to take
+        :param update_EX: if True, the energy at the end point is evaluated
+          together with the last gradient
+        :returns: None
+        :rtype: None
+        """
+        if n_steps == 0:
+            # the trajectory is the start point, as for TensorflowDistribution.trajectory
+            if update_EX:
+                Z.update_EX_dEdX()
+            return
+        idx = Z.active_idx
+        if np.ndim(epsilon) > 0:
+            epsilon = epsilon[:, idx]
+        Z.V[:, idx] += - self.kicks[0] * epsilon * Z.dEdX[:, idx]
+        for step in xrange(n_steps):
+            for stage, drift in enumerate(self.drifts):
+                Z.X[:, idx] += drift * epsilon * Z.V[:, idx]
+                last_stage = stage == self.n_stages - 1
+                if update_EX and last_stage and step == n_steps - 1:
+                    Z.update_EX_dEdX()
+                else:
+                    Z.update_dEdX()
+                kick = self.kicks[stage + 1]
+                # merge the closing kick of this step with the opening kick of the next
+                if last_stage and step < n_steps - 1:
+                    kick += self.kicks[0]
+                Z.V[:, idx] += - kick * epsilon * Z.dEdX[:, idx]
+
+
+# Stormer-Verlet
+LEAPFROG = SplittingIntegrator([0.5, 0.5], [1.], name='leapfrog')
+
+# two stage minimal norm scheme of Omelyan et al. and Blanes et al. (arXiv:1405.3153)
+MN_LAMBDA = 0.1931833275037836
+TWO_STAGE = SplittingIntegrator([MN_LAMBDA, 1 - 2 * MN_LAMBDA, MN_LAMBDA], [0.5, 0.5],
+                                name='two_stage')
+
+# three stage scheme of Blanes, Casas and Sanz-Serna (arXiv:1405.3153)
+BCSS_A = 0.29619504261126
+BCSS_B = 0.11888010966548
+THREE_STAGE = SplittingIntegrator([BCSS_B, 0.5 - BCSS_B, 0.5 - BCSS_B, BCSS_B],
+                                  [BCSS_A, 1 - 2 * BCSS_A, BCSS_A],
+                                  name='three_stage')
+
+INTEGRATORS = {
+    'leapfrog': LEAPFROG,
+    'two_stage': TWO_STAGE,
+    'three_stage': THREE_STAGE
+}
+
+def get_integrator(integrator):
+    """ Returns the integrator specified by integrator
+
+    :param integrator: either the name of one of the integrators in INTEGRATORS
+      or a SplittingIntegrator instance
+    :returns: the integrator
+    :rtype: SplittingIntegrator
+    """
+    if isinstance(integrator, SplittingIntegrator):
+        return integrator
+    try:
+        return INTEGRATORS[integrator]
+    except KeyError:
+        raise ValueError("Unknown integrator {}. Choose one of {}".format(
+            integrator, sorted(INTEGRATORS.keys())))
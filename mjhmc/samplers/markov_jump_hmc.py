@@ -8,7 +8,8 @@ As there is a significant amount of logic common to all algorithms, all of the d
 import numpy as np
 from mjhmc.misc.utils import overrides, min_idx, draw_from
 from mjhmc.misc.distributions import Distribution
-from .hmc_state import HMCState
+from .hmc_state import HMCState, LADDER_CACHE_SIZE
+from .integrators import get_integrator
 
 #pylint: disable=too-many-instance-attributes
 #pylint: disable=too-many-arguments
@@ -23,7 +24,8 @@ class HMCBase(object):
 
     def __init__(self, Xinit=None, E=None, dEdX=None,
                  epsilon=1e-4, alpha=0.2, beta=None,
-                 num_leapfrog_steps=5, distribution=None):
+                 num_leapfrog_steps=5, distribution=None,
+                 ladder_cache_size=LADDER_CACHE_SIZE, integrator='leapfrog'):
         """ Construct and return a new HMCBase instance
 
         :param Xinit: Initial configuration for position variables. Of shape (n_dims, n_batch)
@@ -39,9 +41,20 @@ class HMCBase(object):
         :param beta: specifies momentum corruption rate
         :param num_leapfrog_steps: number of leapfrog integration steps per application
           of L operator
+        :param ladder_cache_size: number of visited ladder rungs cached per particle.
+          0 disables the ladder cache
+        :param integrator: symplectic integrator used by the L operator. Either the name
+          of one of mjhmc.samplers.integrators.INTEGRATORS or a SplittingIntegrator
         :returns: a new instance
         :rtype: HMCBase
         """
+        # read by HMCState when it builds its ladder cache
+        self.ladder_cache_size = ladder_cache_size
+        self.integrator = get_integrator(integrator)
+        # read by HMCState. if set, the energy of each particle is scaled by its
+        #  inverse temperature - [1, nbatch]. see mjhmc.samplers.tempering
+        self.inv_temperature = None
+
         # do not execute this block if I am an instance of MarkovJumpHMC
         if not isinstance(self, MarkovJumpHMC):
             if isinstance(distribution, Distribution):
@@ -51,6 +64,7 @@ class HMCBase(object):
                 self.nbatch = distribution.Xinit.shape[1]
                 self.energy_func = distribution.E
                 self.grad_func = distribution.dEdX
+                self.energy_grad_func = distribution.E_dEdX
                 self.state = HMCState(distribution.Xinit.copy(), self)
                 self.distribution = distribution
             else:
@@ -62,6 +76,7 @@ class HMCBase(object):
                 self.nbatch = Xinit.shape[1]
                 self.energy_func = E
                 self.grad_func = dEdX
+                self.energy_grad_func = None
                 self.state = HMCState(Xinit.copy(), self)
 
         self.num_leapfrog_steps = num_leapfrog_steps
@@ -87,7 +102,7 @@ class HMCBase(object):
         self.r_count = 0
 
         # only approximate!! lower bound
-        self.grad_per_sample_step = self.num_leapfrog_steps
+        self.grad_per_sample_step = self.num_leapfrog_steps * self.integrator.n_stages
 
 
 
@@ -103,6 +118,14 @@ class HMCBase(object):
         dEdX = self.grad_func(X)
         return dEdX
 
+    def E_dEdX(self, X):
+        """compute energy function and its gradient at X
+        in a single call if the distribution provides one"""
+        if self.energy_grad_func is None:
+            return self.E(X), self.dEdX(X)
+        E, dEdX = self.energy_grad_func(X)
+        return E.reshape((1,-1)), dEdX
+
     def leap_prob(self, Z1, Z2):
         """
         Metropolis-Hastings Probability of transitioning from state Z1 to
@@ -230,6 +253,7 @@ class ContinuousTimeHMC(HMCBase):
             self.nbatch = distribution.Xinit.shape[1]
             self.energy_func = distribution.E
             self.grad_func = distribution.dEdX
+            self.energy_grad_func = distribution.E_dEdX
             self.state = HMCState(distribution.Xinit.copy(), self)
             self.distribution = distribution
         else:
@@ -267,8 +291,9 @@ class ContinuousTimeHMC(HMCBase):
         f_draws = draw_from(f_rates[0])
         r_draws = draw_from(r_rates[0])
 
-        # choose min for each particle
-        f_idx, fl_idx, r_idx = min_idx([f_draws, fl_draws, r_draws])
+        # choose min for each particle. only the active particles transition
+        f_idx, fl_idx, r_idx = [np.intersect1d(idx, self.state.active_idx)
+                                for idx in min_idx([f_draws, fl_draws, r_draws])]
 
         # record dwelling times
         self.dwelling_times = np.amin(
@@ -381,35 +406,115 @@ class MarkovJumpHMC(ContinuousTimeHMC):
             depth = np.log(self.original_epsilon / self.epsilon) / np.log(2)
             print("Ecountered infinite rate, doubling back. Depth: {}".format(depth))
             # try again
-            self.state.reset_flf_cache()
+            # cached rungs were integrated with the old step size
+            self.state.reset_ladder_cache()
             self.sampling_iteration()
             # restore the old guys
             self.epsilon *= 2
             self.num_leapfrog_steps = int(self.num_leapfrog_steps / 2)
+            self.state.reset_ladder_cache()
             return
 
-        # choose min for each particle
-        l_idx, f_idx, r_idx = min_idx([l_draws, f_draws, r_draws])
+        # choose min for each particle. only the active particles transition
+        l_idx, f_idx, r_idx = [np.intersect1d(idx, self.state.active_idx)
+                               for idx in min_idx([l_draws, f_draws, r_draws])]
 
         # record dwelling times
         self.dwelling_times = np.amin(
             np.concatenate((l_draws, f_draws, r_draws)), axis=0)
 
-        # cache current state as FLF state for next L transition
-        self.state.cache_flf_state(l_idx, self.state)
-        # cache FL as FLF state for for particles that made transition to F
-        # self.state.cache_flf_state(f_idx, l_state.F())
-
         # update accepted proposed states
+        # the states carry their position on the ladder, and every rung integrated
+        # to above is now in the ladder cache. r_state starts a fresh ladder
         self.state.update(l_idx, l_state)
         self.state.update(f_idx, f_state)
         self.state.update(r_idx, r_state)
 
-        # clear flf cache for particles that transition to R, F
-        self.state.clear_flf_cache(r_idx)
-        self.state.clear_flf_cache(f_idx)
-
-
         self.l_count += len(l_idx)
         self.f_count += len(f_idx)
         self.r_count += len(r_idx)
+
+
+class LAHMC(HMCBase):
+    """This class implements Look Ahead HMC as described in http://arxiv.org/abs/1409.5191
+    Unlike the reference implementation it advances the whole batch at once,
+      integrating only the particles which have not yet transitioned
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Initializer method for Look Ahead HMC
+
+        :param num_look_ahead_steps: maximum number of applications of the L operator
+          attempted before the momentum is flipped
+        :returns: the constructed instance
+        :rtype: LAHMC
+        """
+        self.num_look_ahead_steps = kwargs.pop('num_look_ahead_steps', 4)
+        super(LAHMC, self).__init__(*args, **kwargs)
+
+    @overrides(HMCBase)
+    def sampling_iteration(self):
+        """Perform a single sampling step
+        """
+        # the chain of ladder states L^k zeta
+        Z_chain = [self.state.copy()]
+        # every rung of the chain is compared against the same uniform draw
+        rand_comparison = np.random.rand(self.nbatch)
+        # memoized cumulative transition probabilities between rungs of the chain
+        C = np.ones((self.num_look_ahead_steps + 1,
+                     self.num_look_ahead_steps + 1,
+                     self.nbatch)) * np.nan
+        # particles which have not yet transitioned
+        active_idx = np.arange(self.nbatch)
+        for kk in xrange(self.num_look_ahead_steps):
+            Z_next = Z_chain[-1].copy()
+            # only integrate the particles which are still looking ahead
+            Z_next.active_idx = active_idx
+            Z_chain.append(Z_next.L())
+
+            p_cum = self.leap_prob_recurse(Z_chain, C[:kk + 2, :kk + 2], active_idx)
+            accepted = p_cum.ravel() >= rand_comparison[active_idx]
+            self.state.update(active_idx[accepted], Z_next)
+            self.l_count += np.sum(accepted)
+
+            active_idx = active_idx[~accepted]
+            if len(active_idx) == 0:
+                break
+
+        # flip the momentum of the particles that could not transition anywhere
+        self.state.active_idx = active_idx
+        self.state.F()
+        self.state.active_idx = np.arange(self.nbatch)
+        self.f_count += len(active_idx)
+
+        # corrupt the momentum
+        self.r_count += self.nbatch
+        self.state.R()
+
+    def leap_prob_recurse(self, Z_chain, C, active_idx):
+        """
+        Recursively computes the cumulative probability of transitioning from
+        the first state of Z_chain to the last one for the particles active_idx.
+        C holds the cumulative probabilities already computed between rungs of Z_chain
+        and is filled in as a side effect, so each leaf is only visited once
+        """
+        if np.isfinite(C[0, -1, active_idx]).all():
+            # this leaf has already been visited
+            return C[0, -1, active_idx].reshape((1, -1))
+
+        if len(Z_chain) == 2:
+            # the two states are one rung apart
+            p_acc = self.leap_prob(Z_chain[0], Z_chain[1])[:, active_idx]
+            C[0, -1, active_idx] = p_acc.ravel()
+            return p_acc
+
+        cum_forward = self.leap_prob_recurse(Z_chain[:-1], C[:-1, :-1], active_idx)
+        cum_reverse = self.leap_prob_recurse(Z_chain[:0:-1], C[:0:-1, :0:-1], active_idx)
+
+        Ediff = Z_chain[0].H() - Z_chain[-1].H()
+        start_state_ratio = np.exp(Ediff[:, active_idx])
+        prob = np.vstack((1. - cum_forward,
+                          start_state_ratio * (1. - cum_reverse))).min(axis=0).reshape((1, -1))
+        cumu = cum_forward + prob
+        C[0, -1, active_idx] = cumu.ravel()
+        return cumu
@@ -0,0 +1,237 @@
+"""
+This file contains a batched implementation of the No-U-Turn Sampler
+  as described in http://arxiv.org/abs/1111.4246
+
+Every sampling particle builds its own trajectory tree, but all of the trees are
+  advanced in lockstep so that gradients are always evaluated on (ndims, nbatch) blocks.
+Particles whose tree has terminated are masked out of the remaining leapfrog steps
+  and do not cost any more gradient evaluations.
+"""
+import numpy as np
+from mjhmc.misc.utils import overrides
+from .markov_jump_hmc import HMCBase
+
+#pylint: disable=too-many-instance-attributes
+
+# energy error beyond which a trajectory is considered divergent
+DELTA_MAX = 1000.
+
+class NUTS(HMCBase):
+    """Implements the No-U-Turn Sampler with slice sampling of the trajectory
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Initializer method for NUTS
+
+        :param max_tree_depth: maximum number of trajectory doublings per sample
+        :param target_accept: target acceptance statistic for step size adaptation during burn in
+        :param adapt_epsilon: if True, epsilon is tuned by dual averaging during burn_in
+        :returns: the constructed instance
+        :rtype: NUTS
+        """
+        self.max_tree_depth = kwargs.pop('max_tree_depth', 10)
+        self.target_accept = kwargs.pop('target_accept', 0.6)
+        self.adapt_epsilon = kwargs.pop('adapt_epsilon', True)
+        # trajectories never revisit rungs of a ladder
+        kwargs.setdefault('ladder_cache_size', 0)
+        super(NUTS, self).__init__(*args, **kwargs)
+
+        # cumulative number of gradient evaluations made by each particle
+        self.grad_count = np.zeros(self.nbatch)
+        # cumulative gradient evaluations per particle at each sample of the last call to sample
+        self.grad_trace = None
+        # acceptance statistic of the last sampling iteration, for step size adaptation
+        self.accept_stat = np.zeros(self.nbatch)
+        self.n_accept_stat = np.zeros(self.nbatch)
+        self.tree_depth = np.zeros(self.nbatch, dtype=int)
+        # grads are only known after the tree has been built. estimated from the
+        #  mean gradient evaluations per particle of the iterations since burn in
+        self.grad_per_sample_step = 1
+        self.sample_grad_count = 0.
+        self.n_sample_iterations = 0
+
+    def leapfrog(self, Z, step):
+        """ A single integrator step of signed size step for the active particles of Z
+
+        :param Z: HMCState to integrate in place
+        :param step: signed step size for each particle - [1, nbatch]
+        :returns: None
+        :rtype: None
+        """
+        Z.integrate(step, 1)
+        Z.update_EV()
+        self.grad_count[Z.active_idx] += self.integrator.n_stages
+
+    @staticmethod
+    def no_u_turn(direction, Z_start, Z_end, idx):
+        """ Returns a boolean array that is True for the particles idx whose trajectory
+          from Z_start to Z_end, built in direction, has not started to double back
+        """
+        delta = (Z_end.X[:, idx] - Z_start.X[:, idx]) * direction[:, idx]
+        return ((np.sum(delta * Z_start.V[:, idx], axis=0) >= 0) &
+                (np.sum(delta * Z_end.V[:, idx], axis=0) >= 0))
+
+    def build_tree(self, Z, direction, depth, log_u, H0, building):
+        """ Extends the trajectories of the particles building by 2^depth leapfrog steps
+
+        Leaves are generated in order so that the U-turn criterion of every balanced
+          subtree can be checked as soon as its last leaf is known, and particles whose
+          subtree fails are masked out for the remaining steps.
+
+        :param Z: HMCState holding the trajectory edge to extend from. integrated in place
+        :param direction: direction of integration for each particle - [1, nbatch]
+        :param depth: height of the subtree
+        :param log_u: log of the slice variable - [1, nbatch]
+        :param H0: total energy at the start of the trajectory - [1, nbatch]
+        :param building: boolean mask of the particles to extend - [nbatch]
+        :returns: proposal drawn uniformly from the valid leaves, number of valid leaves,
+          boolean mask of the particles whose subtree is acceptable
+        :rtype: (HMCState, array, array)
+        """
+        step = direction * self.epsilon
+        proposal = Z.copy()
+        n_valid = np.zeros(self.nbatch)
+        subtree_ok = building.copy()
+        # first leaf of the current subtree at each height
+        starts = [None] * (depth + 1)
+        for leaf_idx in xrange(2 ** depth):
+            idx = np.where(subtree_ok)[0]
+            if len(idx) == 0:
+                break
+            Z.active_idx = idx
+            self.leapfrog(Z, step)
+
+            H = Z.H()[0, idx]
+            valid = log_u[0, idx] <= - H
+            n_valid[idx] += valid
+            subtree_ok[idx] &= log_u[0, idx] < DELTA_MAX - H
+            self.accept_stat[idx] += np.minimum(1., np.exp(H0[0, idx] - H))
+            self.n_accept_stat[idx] += 1
+
+            # progressive uniform sampling over the valid leaves of the subtree
+            replace = valid & (np.random.rand(len(idx)) * n_valid[idx] < 1)
+            proposal.update(idx[replace], Z)
+
+            if leaf_idx % 2 == 0 and depth > 0:
+                # this leaf starts a subtree at every height 2^height divides leaf_idx by
+                leaf = Z.copy()
+            for height in xrange(1, depth + 1):
+                if leaf_idx % 2 ** height == 0:
+                    starts[height] = leaf
+                if (leaf_idx + 1) % 2 ** height == 0:
+                    subtree_ok[idx] &= self.no_u_turn(direction, starts[height], Z, idx)
+        Z.active_idx = np.arange(self.nbatch)
+        return proposal, n_valid, subtree_ok
+
+    @overrides(HMCBase)
+    def sampling_iteration(self):
+        """Perform a single sampling step
+        """
+        # fully resample the momentum
+        self.state.V = np.random.randn(self.ndims, self.nbatch)
+        self.state.update_EV()
+        H0 = self.state.H()
+        log_u = np.log(np.random.rand(1, self.nbatch)) - H0
+
+        Z_minus = self.state.copy()
+        Z_plus = self.state.copy()
+        proposal = self.state.copy()
+        n_valid = np.ones(self.nbatch)
+        building = np.ones(self.nbatch, dtype=bool)
+        self.accept_stat = np.zeros(self.nbatch)
+        self.n_accept_stat = np.zeros(self.nbatch)
+        self.tree_depth = np.zeros(self.nbatch, dtype=int)
+        start_grads = np.mean(self.grad_count)
+
+        for depth in xrange(self.max_tree_depth):
+            direction = np.where(np.random.rand(1, self.nbatch) < 0.5, -1., 1.)
+            backward = direction[0] < 0
+            Z_edge = Z_plus.copy()
+            Z_edge.update(np.where(backward)[0], Z_minus)
+
+            subtree_prop, subtree_n, subtree_ok = self.build_tree(
+                Z_edge, direction, depth, log_u, H0, building)
+            Z_minus.update(np.where(building & backward)[0], Z_edge)
+            Z_plus.update(np.where(building & ~backward)[0], Z_edge)
+
+            accept = subtree_ok & (np.random.rand(self.nbatch) * n_valid < subtree_n)
+            proposal.update(np.where(accept)[0], subtree_prop)
+            n_valid += subtree_n * building
+
+            self.tree_depth[building] = depth + 1
+            idx = np.where(building)[0]
+            building[idx] = subtree_ok[idx] & self.no_u_turn(np.ones((1, self.nbatch)),
+                                                             Z_minus, Z_plus, idx)
+            if not building.any():
+                break
+
+        moved_idx = np.where(np.any(proposal.X != self.state.X, axis=0))[0]
+        self.l_count += len(moved_idx)
+        self.state.update(np.arange(self.nbatch), proposal)
+        self.accept_stat /= np.maximum(self.n_accept_stat, 1)
+        self.r_count += self.nbatch
+
+        self.sample_grad_count += np.mean(self.grad_count) - start_grads
+        self.n_sample_iterations += 1
+        self.grad_per_sample_step = max(int(self.sample_grad_count / self.n_sample_iterations), 1)
+
+    def reset_grad_estimate(self):
+        """ Restarts the estimate of grad_per_sample_step, keeping the last one until
+        the next sampling iteration
+        """
+        self.sample_grad_count = 0.
+        self.n_sample_iterations = 0
+
+    @overrides(HMCBase)
+    def sample(self, n_samples=1000, preserve_order=False):
+        """
+        Draws nsamples, returns them all
+        The cumulative number of gradient evaluations made by each particle at each
+          sample is recorded in self.grad_trace - [n_batch, n_samples]
+
+        Args:
+           n_samples: number of samples to draw - int
+           preserve_order: if True, time is given it's own axis.
+              otherwise, it is rolled into the batch axis
+
+        Returns:
+           if preserve_order:
+               samples - [n_dim, n_batch, n_samples]
+           else:
+               samples - [n_dim, n_batch * n_samples]
+        """
+        samples = np.zeros((self.ndims, self.nbatch, n_samples))
+        self.grad_trace = np.zeros((self.nbatch, n_samples))
+        for t_idx in xrange(n_samples):
+            self.sampling_iteration()
+            samples[:, :, t_idx] = self.state.X
+            self.grad_trace[:, t_idx] = self.grad_count
+        if preserve_order:
+            return samples
+        else:
+            # same ordering as concatenating samples along the batch axis
+            return samples.transpose(0, 2, 1).reshape(self.ndims, -1)
+
+    @overrides(HMCBase)
+    def burn_in(self, gamma=0.05, t_0=10, kappa=0.75):
+        """Runs the sampler for a number of burn in sampling iterations
+        If adapt_epsilon is set, epsilon is tuned by dual averaging so that the
+          mean acceptance statistic across particles matches target_accept
+        """
+        if not self.adapt_epsilon:
+            super(NUTS, self).burn_in()
+            self.reset_grad_estimate()
+            return
+        mu = np.log(10 * self.epsilon)
+        log_eps_bar = 0.
+        H_bar = 0.
+        for itr in xrange(1, self.n_burn_in + 1):
+            self.sampling_iteration()
+            eta = 1. / (itr + t_0)
+            H_bar = (1 - eta) * H_bar + eta * (self.target_accept - np.mean(self.accept_stat))
+            log_eps = mu - np.sqrt(itr) / gamma * H_bar
+            self.epsilon = np.exp(log_eps)
+            eta = itr ** -kappa
+            log_eps_bar = eta * log_eps + (1 - eta) * log_eps_bar
+        self.epsilon = np.exp(log_eps_bar)
+        self.reset_grad_estimate()
@@ -0,0 +1,67 @@
+"""
+This file contains a stochastic gradient variant of MJHMC for posteriors over large data sets,
+  in the style of stochastic gradient HMC (http://arxiv.org/abs/1402.4102)
+
+Every gradient is estimated on a random minibatch of the data by a
+  mjhmc.misc.distributions.DataDistribution, so the cost of an iteration does not depend on
+  the size of the data set. Without exact energies there can be no jump rates or
+  Metropolis-Hastings corrections. Instead the momentum is corrupted by friction in every
+  integrator step, at the rate MJHMC with the same beta randomizes it, and the noise injected
+  with the friction is reduced by the estimated noise of the stochastic gradients.
+"""
+import numpy as np
+from warnings import warn
+from mjhmc.misc.utils import overrides
+from .markov_jump_hmc import HMCBase
+
+class StochasticGradientMJHMC(HMCBase):
+    """ Integrates Hamiltonian dynamics with minibatch gradients and friction
+    """
+
+    def __init__(self, distribution=None, grad_noise=0., **kwargs):
+        """ Initializer method for stochastic gradient MJHMC
+
+        :param distribution: mjhmc.misc.distributions.DataDistribution to sample
+        :param grad_noise: estimated variance of each element of the stochastic gradients
+        :param kwargs: the keyword arguments of HMCBase
+        :returns: the constructed instance
+        :rtype: StochasticGradientMJHMC
+        """
+        # the trajectory is never retraced
+        kwargs.setdefault('ladder_cache_size', 0)
+        distribution.mjhmc = False
+        distribution.reset()
+        super(StochasticGradientMJHMC, self).__init__(
+            distribution.Xinit, distribution.stochastic_E, distribution.stochastic_dEdX, **kwargs)
+        self.distribution = distribution
+        self.grad_noise = grad_noise
+        # the rate at which MJHMC randomizes the momentum, per application of L
+        self.p_r = - np.log(1 - self.beta) * 0.5
+        # fraction of the momentum kept by the friction of each integrator step,
+        #  so that it decays by exp(-p_r) over num_leapfrog_steps steps
+        self.momentum_decay = np.exp(- self.p_r / self.num_leapfrog_steps)
+
+    def friction(self):
+        """ Applies half a step of friction to the momentum, with the matching injected noise
+        """
+        decay = np.sqrt(self.momentum_decay)
+        # each step of the integrator adds epsilon^2 grad_noise of variance to the momentum
+        noise_var = 1. - self.momentum_decay - self.epsilon ** 2 * self.grad_noise / 2.
+        if noise_var < 0:
+            warn(("The gradient noise exceeds the noise of the friction, so the sampler does not"
+                  " target the posterior. Decrease epsilon or increase beta"))
+            noise_var = 0.
+        self.state.V = decay * self.state.V + np.sqrt(noise_var) * np.random.randn(
+            self.ndims, self.nbatch)
+
+    @overrides(HMCBase)
+    def sampling_iteration(self):
+        """Perform a single sampling step
+        The state energies are the minibatch estimates from initialization and are not updated
+        """
+        for _ in xrange(self.num_leapfrog_steps):
+            self.friction()
+            self.integrator.integrate(self.state, self.epsilon, 1)
+            self.friction()
+        self.state.update_EV()
+        self.l_count += self.nbatch
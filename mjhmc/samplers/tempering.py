@@ -0,0 +1,180 @@
+"""
+This file contains a parallel tempering (replica exchange) wrapper for the samplers
+  in markov_jump_hmc and nuts
+
+The particles on the batch axis of the wrapped sampler are split into groups of equal size,
+  one per temperature. Group k samples exp(-E(X) / T_k), with T_0 = 1, through the energy
+  scaling HMCState applies for sampler.inv_temperature. Every swap_interval samples, particle c
+  of every group proposes to exchange its position with particle c of the neighbouring group,
+  with the replica exchange Metropolis acceptance probability. All of the proposals of a round
+  are made at once, between either the even or the odd pairs of neighbouring temperatures.
+  Only the samples of the T = 1 group are returned.
+
+The embedded Markov chain of the continuous-time samplers is not distributed according to
+  the target, so swaps can not simply be interleaved with its transitions. Instead every
+  particle is advanced by the same amount of continuous time between samples, and the
+  particles are swapped and sampled at those common points in time.
+"""
+import numpy as np
+from .markov_jump_hmc import ContinuousTimeHMC
+
+#pylint: disable=too-many-instance-attributes
+
+class ParallelTempering(object):
+    """ Runs the particles of a sampler at a ladder of temperatures and exchanges them
+    """
+
+    #pylint: disable=too-many-arguments
+    def __init__(self, sampler, n_temperatures=4, max_temperature=10., temperatures=None,
+                 swap_interval=10, sample_interval=1.):
+        """ Wraps sampler in a replica exchange scheme
+
+        :param sampler: HMCBase instance to temper. Its batch size must be a multiple
+          of the number of temperatures
+        :param n_temperatures: number of temperatures of the geometric ladder
+        :param max_temperature: highest temperature of the geometric ladder
+        :param temperatures: Optional. increasing temperatures starting at 1,
+          in place of the geometric ladder
+        :param swap_interval: number of samples between rounds of swap proposals
+        :param sample_interval: continuous-time samplers only. amount of time
+          each particle is advanced by between samples
+        :returns: a new instance
+        :rtype: ParallelTempering
+        """
+        if temperatures is None:
+            temperatures = np.logspace(0, np.log10(max_temperature), n_temperatures)
+        temperatures = np.asarray(temperatures, dtype=float)
+        if temperatures[0] != 1 or np.any(np.diff(temperatures) <= 0):
+            raise ValueError("temperatures must increase from 1, got {}".format(temperatures))
+        if sampler.nbatch % len(temperatures) != 0:
+            raise ValueError("{} particles can not be split between {} temperatures".format(
+                sampler.nbatch, len(temperatures)))
+
+        self.sampler = sampler
+        self.temperatures = temperatures
+        self.n_temperatures = len(temperatures)
+        # number of particles at each temperature
+        # particle c of temperature k is at index k * n_chains + c of the batch axis
+        self.n_chains = sampler.nbatch // self.n_temperatures
+        self.cold_idx = np.arange(self.n_chains)
+        self.inv_temperature = np.repeat(1. / temperatures, self.n_chains).reshape((1, -1))
+        self.swap_interval = swap_interval
+        self.sample_interval = sample_interval
+        self.continuous_time = isinstance(sampler, ContinuousTimeHMC)
+        self.n_burn_in = sampler.n_burn_in
+
+        # the state was built before the temperatures were set
+        sampler.inv_temperature = self.inv_temperature
+        sampler.state.EX *= self.inv_temperature
+        sampler.state.dEdX *= self.inv_temperature
+        sampler.state.reset_ladder_cache()
+
+        self.n_iterations = 0
+        self.n_swap_rounds = 0
+        # swaps proposed and accepted between temperatures k and k + 1
+        self.swap_attempts = np.zeros(self.n_temperatures - 1, dtype=int)
+        self.swap_accepts = np.zeros(self.n_temperatures - 1, dtype=int)
+
+    @property
+    def swap_acceptance_rate(self):
+        """ Fraction of the proposed swaps accepted between each pair of
+        neighbouring temperatures - [n_temperatures - 1]
+        """
+        return self.swap_accepts / np.maximum(self.swap_attempts, 1).astype(float)
+
+    def swap(self):
+        """ Proposes to exchange the positions of particle c at temperatures k and k + 1
+        for every c and for every even k, or every odd k, alternating between calls
+        Momenta stay in place, since they have the same distribution at every temperature
+        """
+        lower = np.arange(self.n_swap_rounds % 2, self.n_temperatures - 1, 2)
+        self.n_swap_rounds += 1
+        if len(lower) == 0:
+            return
+        state = self.sampler.state
+        beta = self.inv_temperature[0]
+        cold_idx = (lower.reshape((-1, 1)) * self.n_chains + self.cold_idx).ravel()
+        hot_idx = cold_idx + self.n_chains
+        # the untempered energies
+        E_cold = state.EX[0, cold_idx] / beta[cold_idx]
+        E_hot = state.EX[0, hot_idx] / beta[hot_idx]
+        log_p_acc = (beta[cold_idx] - beta[hot_idx]) * (E_cold - E_hot)
+        accept = np.log(np.random.rand(len(cold_idx))) < log_p_acc
+
+        self.swap_attempts[lower] += self.n_chains
+        self.swap_accepts[lower] += np.sum(accept.reshape((len(lower), -1)), axis=1)
+
+        swap_idx = np.concatenate((cold_idx[accept], hot_idx[accept]))
+        partner_idx = np.concatenate((hot_idx[accept], cold_idx[accept]))
+        rescale = (beta[swap_idx] / beta[partner_idx]).reshape((1, -1))
+        state.X[:, swap_idx] = state.X[:, partner_idx]
+        state.EX[:, swap_idx] = state.EX[:, partner_idx] * rescale
+        state.dEdX[:, swap_idx] = state.dEdX[:, partner_idx] * rescale
+        state.reset_ladder_cache(swap_idx)
+
+    def advance(self, duration):
+        """ Advances every particle of a continuous-time sampler by duration units of time
+        Only the particles that have not got there yet are integrated and transition, through
+        state.active_idx. A particle that gets there is returned to the state it occupied at
+        that time. Since the waiting times are memoryless, all of the particles can be
+        restarted from the end point
+
+        :param duration: amount of continuous time to advance by
+        :returns: None
+        :rtype: None
+        """
+        sampler = self.sampler
+        elapsed = np.zeros(sampler.nbatch)
+        active_idx = np.arange(sampler.nbatch)
+        while len(active_idx) > 0:
+            sampler.state.active_idx = active_idx
+            start_state = sampler.state.copy()
+            sampler.sampling_iteration()
+            # dwelling_times holds the time spent in start_state
+            elapsed[active_idx] += sampler.dwelling_times[active_idx]
+            arrived = elapsed[active_idx] >= duration
+            sampler.state.update(active_idx[arrived], start_state)
+            active_idx = active_idx[~arrived]
+        sampler.state.active_idx = np.arange(sampler.nbatch)
+
+    def sampling_iteration(self):
+        """ Advances every particle to its next sample, and swaps particles if one is due
+        """
+        if self.continuous_time:
+            self.advance(self.sample_interval)
+        else:
+            self.sampler.sampling_iteration()
+        self.n_iterations += 1
+        if self.n_iterations % self.swap_interval == 0:
+            self.swap()
+
+    def sample(self, n_samples=1000, preserve_order=False):
+        """
+        Draws n_samples from each of the particles at temperature 1, returns them all
+
+        Args:
+           n_samples: number of samples to draw - int
+           preserve_order: if True, time is given it's own axis.
+              otherwise, it is rolled into the batch axis
+
+        Returns:
+           if preserve_order:
+               samples - [n_dim, n_chains, n_samples]
+           else:
+               samples - [n_dim, n_chains * n_samples]
+        """
+        samples = np.zeros((self.sampler.ndims, self.n_chains, n_samples))
+        for t_idx in xrange(n_samples):
+            self.sampling_iteration()
+            samples[:, :, t_idx] = self.sampler.state.X[:, self.cold_idx]
+        if preserve_order:
+            return samples
+        else:
+            # same ordering as concatenating samples along the batch axis
+            return samples.transpose(0, 2, 1).reshape(self.sampler.ndims, -1)
+
+    def burn_in(self):
+        """Runs the tempered sampler for a number of burn in sampling iterations
+        """
+        for _ in xrange(self.n_burn_in):
+            self.sampling_iteration()
@@ -14,6 +14,7 @@ import time
 
 from scipy.optimize import curve_fit
 from mjhmc.misc.autocor import calculate_autocorrelation
+from mjhmc.misc.metrics import autocor_metrics
 from mjhmc.misc.plotting import plot_fit, plot_search_ac
 from mjhmc.samplers.markov_jump_hmc import ContinuousTimeHMC
 
@@ -72,7 +73,10 @@ def obj_func_helper(sampler, distr, unpack, kwargs):
 
     print "Calculating autocorrelation for {} grad evals".format(num_target_grad_evals)
     # grad evals was previously cast to int, why?
+    start_time = time.time()
     autocor, _, n_grad_evals = calculate_autocorrelation(sampler, distr, **kwargs)
+    metrics = autocor_metrics(autocor, n_grad_evals, run_time=time.time() - start_time)
+    print "tau_int: {tau_int} samples, ESS per grad eval: {ess_per_grad}".format(**metrics)
 
     # necessary to keep curve_fit from borking: THIS IS VERY IMPORTANT
     normed_n_grad_evals = n_grad_evals / (0.5 * num_target_grad_evals)
@@ -82,18 +86,20 @@ def obj_func_helper(sampler, distr, unpack, kwargs):
     if SAVE_TRACE:
         formatted_time = time.strftime("%Y%m%d-%H%M%S")
         trace_name = '{}_{}'.format(type(distr).__name__, formatted_time)
-        save_trace(normed_n_grad_evals, autocor, exp_coef, cos_coef, trace_name)
+        save_trace(normed_n_grad_evals, autocor, exp_coef, cos_coef, trace_name, metrics)
     return cos_coef, normed_n_grad_evals, exp_coef, autocor, kwargs
 
-def save_trace(t_data, y_data, tf_ec, tf_cc, trace_name):
+def save_trace(t_data, y_data, tf_ec, tf_cc, trace_name, metrics=None):
     """ Save the trace for later inspection
+    metrics are the mjhmc.misc.metrics.autocor_metrics of the autocorrelation
     """
     with open('{}/{}.pkl'.format(TRACE_PATH, trace_name), 'wb') as pkl_file:
         trace_dict = {
             'grad_evals': t_data,
             'autocor': y_data,
             'tf_exp_coeff': tf_ec,
-            'tf_cos_coeff': tf_cc
+            'tf_cos_coeff': tf_cc,
+            'metrics': metrics
         }
         pickle.dump(trace_dict, pkl_file)
 
@@ -0,0 +1,13 @@
+"""
+Helpers shared by the unit tests
+"""
+
+
+def no_cached_init(distr_class):
+    """ returns a subclass of distr_class that starts from gen_init_X
+    so that the tests do not have to generate a fair initialization
+    """
+    class Uncached(distr_class):
+        def init_X(self):
+            self.gen_init_X()
+    return Uncached
@@ -1,8 +1,14 @@
 import unittest
-from mjhmc.samplers.markov_jump_hmc import ContinuousTimeHMC, HMCBase, MarkovJumpHMC, HMC, ControlHMC
-from mjhmc.misc.distributions import TestGaussian, Gaussian
+from mjhmc.samplers.markov_jump_hmc import ContinuousTimeHMC, HMCBase, MarkovJumpHMC, HMC, ControlHMC, LAHMC
+from mjhmc.samplers.nuts import NUTS
+from mjhmc.samplers.integrators import INTEGRATORS
+from mjhmc.samplers.tempering import ParallelTempering
+from mjhmc.samplers.stochastic_gradient import StochasticGradientMJHMC
+from mjhmc.misc.distributions import TestGaussian, Gaussian, GaussianMixture, DataDistribution
 import numpy as np
+from mjhmc.misc.autocor import generate_samples
 from mjhmc.misc.utils import overrides
+from mjhmc.tests.helpers import no_cached_init
 
 n_seed = 1
 eps = .05
@@ -113,3 +119,299 @@ class TestMJHMC(TestControl):
     def setUp(self):
         np.random.seed(n_seed)
         self.sampler_to_test = MarkovJumpHMC
+
+class TestLAHMC(TestControl):
+
+    @overrides(TestControl)
+    def setUp(self):
+        np.random.seed(n_seed)
+        self.sampler_to_test = LAHMC
+
+class TestNUTS(TestControl):
+
+    @overrides(TestControl)
+    def setUp(self):
+        np.random.seed(n_seed)
+        self.sampler_to_test = NUTS
+
+    def test_grad_budget(self):
+        """
+        Checks that NUTS estimates its gradients per sample, so that a grad budget
+        does not allocate a sample for every gradient
+        """
+        gaussian = no_cached_init(TestGaussian)(ndims=2, nbatch=10)
+        num_grad_steps = 2000
+        samples, _, grad_evals = generate_samples(NUTS, gaussian, num_grad_steps=num_grad_steps)
+        self.assertTrue(grad_evals[-1] >= num_grad_steps)
+        self.assertTrue(grad_evals[-2] < num_grad_steps)
+        self.assertEqual(samples.shape[-1], len(grad_evals))
+
+        sampler = NUTS(distribution=gaussian.reset())
+        sampler.sample(50)
+        self.assertEqual(sampler.grad_per_sample_step, int(np.mean(sampler.grad_count) / 50))
+        self.assertTrue(sampler.grad_per_sample_step > 1)
+
+
+class TestLadderCache(unittest.TestCase):
+    """
+    Checks that serving ladder rungs from the cache leaves the chain unchanged
+    """
+
+    def setUp(self):
+        self.n_samples = 1000
+
+    def run_sampler(self, ladder_cache_size):
+        np.random.seed(n_seed)
+        gaussian = no_cached_init(Gaussian)(ndims=2, log_conditioning=1)
+        np.random.seed(n_seed)
+        sampler = MarkovJumpHMC(distribution=gaussian.reset(),
+                                ladder_cache_size=ladder_cache_size,
+                                resample=False)
+        samples = sampler.sample(self.n_samples)
+        return samples, gaussian.dEdX_count
+
+    def test_cache_matches_integration(self):
+        """
+        Checks that MJHMC with the ladder cache produces the same samples with fewer gradients
+        """
+        uncached_samples, uncached_grads = self.run_sampler(0)
+        cached_samples, cached_grads = self.run_sampler(8)
+        self.assertTrue(np.allclose(uncached_samples, cached_samples),
+                        msg="ladder cache changed the sampled chain")
+        self.assertTrue(cached_grads < uncached_grads,
+                        msg="ladder cache did not save any gradient evaluations")
+
+
+class TestIntegrators(unittest.TestCase):
+    """
+    Checks that every integrator builds a reversible ladder
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+
+    def test_reversibility(self):
+        """
+        Checks that FLF undoes L for every integrator
+        """
+        gaussian = no_cached_init(TestGaussian)(ndims=3)
+        for name in INTEGRATORS:
+            sampler = HMC(gaussian.Xinit, gaussian.E, gaussian.dEdX,
+                          epsilon=0.3, integrator=name, ladder_cache_size=0)
+            start = sampler.state.copy()
+            end = sampler.state.copy().L().FLF()
+            self.assertTrue(np.allclose(start.X, end.X) and np.allclose(start.V, end.V),
+                            msg="{} integrator is not reversible".format(name))
+
+    def test_zero_steps(self):
+        """
+        Checks that a trajectory of zero steps leaves the state unchanged, with fresh energies
+        """
+        gaussian = no_cached_init(TestGaussian)(ndims=3)
+        for name, integrator in INTEGRATORS.items():
+            sampler = HMC(gaussian.Xinit, gaussian.E, gaussian.dEdX,
+                          epsilon=0.3, integrator=name, ladder_cache_size=0)
+            state = sampler.state.copy()
+            state.EX[:] = 0.
+            integrator.integrate(state, sampler.epsilon, 0, update_EX=True)
+            self.assertTrue(np.allclose(state.X, sampler.state.X) and
+                            np.allclose(state.V, sampler.state.V),
+                            msg="{} integrator moved in zero steps".format(name))
+            self.assertTrue(np.allclose(state.EX, sampler.state.EX),
+                            msg="{} integrator did not evaluate the energy".format(name))
+
+
+class TestParallelTempering(unittest.TestCase):
+    """
+    Checks that the particles at temperature 1 sample the target
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+
+    def check_moments(self, samples, tol):
+        self.assertTrue(np.abs(np.mean(samples)) < tol,
+                        msg='mean: {} is not within tolerance'.format(np.mean(samples)))
+        self.assertTrue(np.abs(np.std(samples) - 1) < tol,
+                        msg='std: {} is not within tolerance'.format(np.std(samples)))
+
+    def test_1d_gaussian(self):
+        """
+        Checks that tempered HMC and MJHMC sample a 1d gaussian
+        """
+        gaussian = no_cached_init(TestGaussian)(ndims=1, nbatch=400)
+        tempered = ParallelTempering(HMC(distribution=gaussian, epsilon=0.5))
+        tempered.burn_in()
+        self.check_moments(tempered.sample(500), eps)
+        self.assertTrue(np.all(tempered.swap_acceptance_rate > 0))
+
+        tempered = ParallelTempering(MarkovJumpHMC(distribution=gaussian.reset(), epsilon=0.5))
+        tempered.n_burn_in = 50
+        tempered.burn_in()
+        self.check_moments(tempered.sample(200), 2 * eps)
+
+    def test_advance(self):
+        """
+        Checks that advancing continuous-time samplers only moves the particles
+        that have not yet been advanced by the whole duration
+        """
+        gaussian = no_cached_init(TestGaussian)(ndims=1, nbatch=40)
+        for sampler_class in [ContinuousTimeHMC, MarkovJumpHMC]:
+            tempered = ParallelTempering(sampler_class(distribution=gaussian.reset(), epsilon=0.5))
+            sampler = tempered.sampler
+            n_active = []
+            sampling_iteration = sampler.sampling_iteration
+
+            def counted_iteration():
+                n_active.append(len(sampler.state.active_idx))
+                sampling_iteration()
+            sampler.sampling_iteration = counted_iteration
+            tempered.advance(2.)
+
+            n_transitions = sampler.l_count + sampler.fl_count + sampler.f_count + sampler.r_count
+            self.assertEqual(n_transitions, np.sum(n_active))
+            self.assertEqual(n_active[0], gaussian.nbatch)
+            self.assertTrue(np.all(np.diff(n_active) <= 0) and n_active[-1] < gaussian.nbatch)
+            self.assertTrue(np.array_equal(sampler.state.active_idx, np.arange(gaussian.nbatch)))
+
+    def test_bimodal(self):
+        """
+        Checks that tempering moves particles started in one mode of a mixture to the other
+        """
+        mixture = no_cached_init(GaussianMixture)(np.array([[-4.], [4.]]), nbatch=200)
+        tempered = ParallelTempering(HMC(distribution=mixture, epsilon=0.5),
+                                     max_temperature=30.)
+        state = tempered.sampler.state
+        state.X[:] = 4.
+        state.update_EX()
+        state.update_dEdX()
+        tempered.burn_in()
+        fraction = np.mean(tempered.sample(500) > 0)
+        self.assertTrue(np.abs(fraction - 0.5) < eps,
+                        msg='{} of the samples are in the positive mode'.format(fraction))
+
+
+class GaussianMean(DataDistribution):
+    """
+    Posterior of the mean of unit variance gaussian data
+    """
+
+    @overrides(DataDistribution)
+    def data_E_dEdX_val(self, X, data, targets):
+        residuals = targets.reshape((-1, 1)) - X
+        return (np.sum(residuals ** 2, axis=0).reshape((1, -1)) / 2.,
+                - np.sum(residuals, axis=0).reshape((1, -1)))
+
+
+class TestStochasticGradientMJHMC(unittest.TestCase):
+    """
+    Checks that minibatch gradients sample the posterior when the gradient noise is accounted for
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+
+    def run_sampler(self, grad_noise_scale):
+        """ Returns the samples of the posterior of the mean of gaussian data, standardized by
+        the exact posterior, with the gradient noise estimate scaled by grad_noise_scale
+        """
+        n_data = 1000
+        batch_size = 100
+        targets = np.random.randn(n_data) + 3
+        posterior = GaussianMean(np.zeros((n_data, 1)), targets, 1, nbatch=200,
+                                 batch_size=batch_size)
+        sampler = StochasticGradientMJHMC(
+            distribution=posterior, epsilon=0.003, beta=0.9, num_leapfrog_steps=10,
+            grad_noise=grad_noise_scale * n_data ** 2 / float(batch_size))
+        # the noise correction must not be clipped for the test to check it
+        self.assertTrue(1. - sampler.momentum_decay > sampler.epsilon ** 2 * sampler.grad_noise / 2.)
+        sampler.burn_in()
+        samples = sampler.sample(200)
+        precision = 1. + n_data
+        return (samples - np.sum(targets) / precision) * np.sqrt(precision)
+
+    def test_gaussian_mean(self):
+        """
+        Checks the moments of the posterior of the mean of gaussian data
+        """
+        z_samples = self.run_sampler(1.)
+        self.assertTrue(np.abs(np.mean(z_samples)) < 2 * eps,
+                        msg='mean: {} is not within tolerance'.format(np.mean(z_samples)))
+        self.assertTrue(np.abs(np.std(z_samples) - 1) < 2 * eps,
+                        msg='std: {} is not within tolerance'.format(np.std(z_samples)))
+
+    def test_uncorrected_noise(self):
+        """
+        Checks that ignoring the gradient noise inflates the posterior
+        """
+        z_samples = self.run_sampler(0.)
+        self.assertTrue(np.std(z_samples) > 1 + 2 * eps,
+                        msg='std: {} is not inflated'.format(np.std(z_samples)))
+
+
+class TestFusedEvaluation(unittest.TestCase):
+    """
+    Checks that trajectory end points get their energy and gradient from a single call
+    """
+
+    def test_fused_calls(self):
+        """
+        Checks that the energy is only evaluated together with the gradient
+        """
+        class FusedGaussian(no_cached_init(TestGaussian)):
+            def E_val(self, X):
+                self.n_separate += 1
+                return super(FusedGaussian, self).E_val(X)
+
+            def E_dEdX_val(self, X):
+                self.n_fused += X.shape[1]
+                return (super(FusedGaussian, self).E_val(X),
+                        super(FusedGaussian, self).dEdX_val(X))
+
+        np.random.seed(n_seed)
+        gaussian = FusedGaussian(ndims=2, nbatch=10)
+        for sampler_class in [HMC, MarkovJumpHMC, NUTS]:
+            gaussian.n_separate = 0
+            gaussian.n_fused = 0
+            sampler = sampler_class(distribution=gaussian, epsilon=0.3)
+            sampler.sample(20)
+            self.assertEqual(gaussian.n_separate, 0)
+            self.assertEqual(gaussian.E_count, gaussian.n_fused,
+                             msg='energy counted incorrectly by {}'.format(sampler_class.__name__))
+
+
+class TestCompiledTrajectory(unittest.TestCase):
+    """
+    Checks that HMCState hands whole trajectories to distributions that can compute them
+    """
+
+    def run_sampler(self, distribution_class):
+        np.random.seed(n_seed)
+        gaussian = distribution_class(ndims=2, nbatch=10)
+        sampler = MarkovJumpHMC(distribution=gaussian, epsilon=0.3, integrator='two_stage',
+                                resample=False)
+        return sampler.sample(50)
+
+    def test_trajectory_matches_integrator(self):
+        """
+        Checks that a distribution's trajectory replaces the integrator and leaves the chain unchanged
+        """
+        UncachedGaussian = no_cached_init(TestGaussian)
+
+        class TrajectoryGaussian(UncachedGaussian):
+            n_trajectories = 0
+
+            def trajectory(self, X, V, dEdX, epsilon, n_steps, integrator, inv_temperature=None):
+                TrajectoryGaussian.n_trajectories += 1
+                X, V = X.copy(), V.copy()
+                for _ in xrange(n_steps):
+                    for kick, drift in zip(integrator.kicks, integrator.drifts):
+                        V -= kick * epsilon * self.dEdX_val(X)
+                        X += drift * epsilon * V
+                    V -= integrator.kicks[-1] * epsilon * self.dEdX_val(X)
+                return X, V, self.dEdX_val(X), self.E_val(X)
+
+        samples = self.run_sampler(UncachedGaussian)
+        trajectory_samples = self.run_sampler(TrajectoryGaussian)
+        self.assertTrue(TrajectoryGaussian.n_trajectories > 0)
+        self.assertTrue(np.allclose(samples, trajectory_samples))
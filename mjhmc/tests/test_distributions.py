@@ -0,0 +1,289 @@
+import unittest
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from scipy import sparse
+from mjhmc.misc import init_cache
+from mjhmc.tests.helpers import no_cached_init
+from mjhmc.misc.distributions import (DiagonalGaussian, LowRankGaussian,
+                                      BandedGaussian, SparseGaussian, TestGaussian,
+                                      GaussianMixture, ProductOfT,
+                                      BayesianLogisticRegression)
+
+n_seed = 1
+ndims = 6
+nbatch = 5000
+tol = 1e-8
+
+
+class TestStructuredGaussians(unittest.TestCase):
+    """ checks the structured energy kernels against the dense precision matrix
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        diag = np.random.rand(ndims) + 0.5
+        factor = np.random.randn(ndims, 2)
+        bands = np.zeros((3, ndims))
+        bands[-1] = 3. + np.random.rand(ndims)
+        bands[0] = np.random.rand(ndims) * 0.5
+        bands[1] = np.random.rand(ndims) * 0.5
+        J_sparse = sparse.diags([bands[-1], bands[1, 1:], bands[1, 1:]], [0, 1, -1])
+        self.distributions = [
+            no_cached_init(DiagonalGaussian)(diag, nbatch=nbatch),
+            no_cached_init(LowRankGaussian)(diag, factor, nbatch=nbatch),
+            no_cached_init(BandedGaussian)(bands, nbatch=nbatch),
+            no_cached_init(SparseGaussian)(J_sparse, nbatch=nbatch)
+        ]
+
+    def test_kernels(self):
+        """
+        energy and gradient match the dense quadratic form
+        """
+        X = np.random.randn(ndims, 10)
+        for distr in self.distributions:
+            J = np.asarray(sparse.csr_matrix(distr.J).todense())
+            E_dense = np.sum(X * np.dot(J, X), axis=0).reshape((1, -1)) / 2.
+            self.assertTrue(np.allclose(distr.E(X), E_dense, atol=tol),
+                            msg='energy mismatch for {}'.format(type(distr).__name__))
+            self.assertTrue(np.allclose(distr.dEdX(X), np.dot(J, X), atol=tol),
+                            msg='gradient mismatch for {}'.format(type(distr).__name__))
+
+    def test_exact_init(self):
+        """
+        initializations of the exactly sampleable families have covariance inv(J)
+        """
+        for distr in self.distributions[:3]:
+            target_cov = np.linalg.inv(distr.J)
+            sample_cov = np.cov(distr.Xinit)
+            self.assertTrue(np.linalg.norm(sample_cov - target_cov) < 0.1,
+                            msg='{} init covariance \n {} \n does not match \n {}'.format(
+                                type(distr).__name__, sample_cov, target_cov))
+
+    def test_hash(self):
+        """
+        hashes depend on the parameters only
+        """
+        for distr in self.distributions:
+            self.assertEqual(hash(distr), hash(distr))
+        self.assertEqual(len(set(hash(distr) for distr in self.distributions)),
+                         len(self.distributions))
+
+
+class TestGaussianMixture(unittest.TestCase):
+    """ checks the log-sum-exp mixture kernels against direct evaluation
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        self.means = 3 * np.random.randn(4, ndims)
+        self.scales = np.random.rand(4, ndims) + 0.5
+        self.weights = np.random.rand(4)
+        self.mixture = no_cached_init(GaussianMixture)(self.means, self.scales,
+                                                       self.weights, nbatch=nbatch)
+
+    def direct_energy(self, X):
+        weights = self.weights / np.sum(self.weights)
+        density = 0.
+        for mean, scale, weight in zip(self.means, self.scales, weights):
+            Z = (X - mean.reshape((-1, 1))) / scale.reshape((-1, 1))
+            density += weight / np.prod(scale) * np.exp(-0.5 * np.sum(Z ** 2, axis=0))
+        return - np.log(density).reshape((1, -1))
+
+    def test_kernels(self):
+        """
+        energy matches direct evaluation and gradient matches finite differences
+        """
+        X = 2 * np.random.randn(ndims, 10)
+        self.assertTrue(np.allclose(self.mixture.E(X), self.direct_energy(X)))
+        step = 1e-6
+        num_grad = np.zeros(X.shape)
+        for dim in xrange(ndims):
+            dX = np.zeros(X.shape)
+            dX[dim] = step
+            num_grad[dim] = (self.direct_energy(X + dX) - self.direct_energy(X - dX)) / (2 * step)
+        self.assertTrue(np.allclose(self.mixture.dEdX(X), num_grad, atol=1e-5))
+
+    def test_far_from_modes(self):
+        """
+        energy and gradient stay finite far from every component
+        """
+        X = 1e4 * np.ones((ndims, 3))
+        self.assertTrue(np.all(np.isfinite(self.mixture.E(X))))
+        self.assertTrue(np.all(np.isfinite(self.mixture.dEdX(X))))
+
+    def test_exact_init(self):
+        """
+        initialization has the mixture mean
+        """
+        weights = self.weights / np.sum(self.weights)
+        target_mean = np.dot(weights, self.means)
+        self.assertTrue(np.allclose(np.mean(self.mixture.Xinit, axis=1), target_mean, atol=0.2))
+
+
+class TestProductOfT(unittest.TestCase):
+    """ checks the numpy product of T experts kernels
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        W = np.random.randn(ndims, ndims)
+        W[np.random.rand(ndims, ndims) > 0.2] = 0
+        W += 2 * np.eye(ndims)
+        lognu = np.log(np.random.rand(ndims) * 2 + 2.1)
+        b = np.random.randn(ndims)
+        self.sparse_poe = no_cached_init(ProductOfT)(ndims, ndims, 10, lognu=lognu,
+                                                     W=sparse.csr_matrix(W), b=b)
+        self.dense_poe = no_cached_init(ProductOfT)(ndims, ndims, 10, lognu=lognu,
+                                                    W=W + 1e-300, b=b)
+
+    def test_kernels(self):
+        """
+        sparse and dense weights agree, and the gradient matches finite differences
+        """
+        X = np.random.randn(ndims, 10)
+        E, dEdX = self.sparse_poe.E_dEdX(X)
+        self.assertTrue(np.allclose(E, self.dense_poe.E(X)))
+        self.assertTrue(np.allclose(E, self.sparse_poe.E(X)))
+        self.assertTrue(np.allclose(dEdX, self.dense_poe.dEdX(X)))
+        step = 1e-6
+        num_grad = np.zeros(X.shape)
+        for dim in xrange(ndims):
+            dX = np.zeros(X.shape)
+            dX[dim] = step
+            num_grad[dim] = (self.sparse_poe.E(X + dX) - self.sparse_poe.E(X - dX)) / (2 * step)
+        self.assertTrue(np.allclose(dEdX, num_grad, atol=1e-5))
+
+    def test_counts(self):
+        """
+        the fused evaluation counts as one energy and one gradient evaluation
+        """
+        self.sparse_poe.E_dEdX(np.random.randn(ndims, 7))
+        self.assertEqual((self.sparse_poe.E_count, self.sparse_poe.dEdX_count), (7, 7))
+
+
+class TestBayesianLogisticRegression(unittest.TestCase):
+    """ checks the full data and minibatch kernels of a memory-mapped posterior
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        n_data = 2000
+        data = np.hstack((np.random.randn(n_data, ndims - 1), np.ones((n_data, 1))))
+        targets = (np.random.rand(n_data) < 0.5).astype(float)
+        self.data_file = tempfile.NamedTemporaryFile(suffix='.dat')
+        mapped = np.memmap(self.data_file.name, dtype=float, mode='w+', shape=data.shape)
+        mapped[:] = data
+        mapped.flush()
+        mapped = np.memmap(self.data_file.name, dtype=float, mode='r', shape=data.shape)
+        self.mapped_blr = BayesianLogisticRegression(mapped, targets, chunk_size=300,
+                                                     batch_size=50)
+        self.blr = BayesianLogisticRegression(data, targets, chunk_size=n_data)
+
+    def tearDown(self):
+        self.data_file.close()
+
+    def test_kernels(self):
+        """
+        streaming over chunks of the memory-mapped data matches evaluation in memory,
+        and the gradient matches finite differences
+        """
+        X = np.random.randn(ndims, 10)
+        E, dEdX = self.mapped_blr.E_dEdX(X)
+        self.assertTrue(np.allclose(E, self.blr.E(X)))
+        self.assertTrue(np.allclose(dEdX, self.blr.dEdX(X)))
+        step = 1e-6
+        num_grad = np.zeros(X.shape)
+        for dim in xrange(ndims):
+            dX = np.zeros(X.shape)
+            dX[dim] = step
+            num_grad[dim] = (self.blr.E(X + dX) - self.blr.E(X - dX)) / (2 * step)
+        self.assertTrue(np.allclose(dEdX, num_grad, atol=1e-4))
+
+    def test_stochastic_gradient(self):
+        """
+        minibatch gradients are unbiased
+        """
+        X = np.random.randn(ndims, 3)
+        dEdX = self.mapped_blr.dEdX(X)
+        mean_dEdX = np.mean([self.mapped_blr.stochastic_dEdX(X) for _ in xrange(2000)], axis=0)
+        self.assertTrue(np.max(np.abs(mean_dEdX - dEdX)) < 0.05 * np.max(np.abs(dEdX)))
+
+
+class TestInitCache(unittest.TestCase):
+    """ checks that cached initializations are only read from disk once
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        self.gaussian = no_cached_init(TestGaussian)(ndims=3, nbatch=10, sigma=np.pi)
+        self.mjhmc_endpt = np.random.randn(3, 20)
+        self.control_endpt = np.random.randn(3, 20)
+        self.path = init_cache.save_initialization(
+            self.gaussian, self.mjhmc_endpt, self.control_endpt,
+            {'emc_var_estimate': 1., 'true_var_estimate': 2.})
+        init_cache.clear_loaded_initializations()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        init_cache.clear_loaded_initializations()
+
+    def test_reset_from_memory(self):
+        """
+        resets slice the initialization from memory after the first load
+        """
+        self.gaussian.mjhmc = False
+        self.gaussian.cached_init_X()
+        self.assertTrue(np.array_equal(self.gaussian.Xinit, self.control_endpt[:, :10]))
+        load_initialization = init_cache.load_initialization
+        def fail(*args, **kwargs):
+            raise AssertionError("initialization was read from disk again")
+        init_cache.load_initialization = fail
+        try:
+            self.gaussian.mjhmc = True
+            self.gaussian.cached_init_X()
+            self.assertTrue(np.array_equal(self.gaussian.Xinit, self.mjhmc_endpt[:, :10]))
+            self.assertEqual(self.gaussian.load_cache()[1:3], (1., 2.))
+        finally:
+            init_cache.load_initialization = load_initialization
+
+    def test_legacy_pickle(self):
+        """
+        initializations in the old pickle format are imported into the store when first needed,
+        with exact samples in place of a missing control initialization
+        """
+        poe = no_cached_init(ProductOfT)(3, 3, nbatch=10, lognu=np.zeros(3))
+        legacy_path = '{}/{}'.format(init_cache.init_dir(), init_cache.legacy_pickle_name(poe))
+        with open(legacy_path, 'wb') as legacy_file:
+            pickle.dump((self.mjhmc_endpt, 1., 2.), legacy_file)
+        try:
+            mjhmc_endpt, control_endpt, meta = init_cache.get_initialization(poe)
+            self.assertTrue(np.array_equal(mjhmc_endpt, self.mjhmc_endpt))
+            self.assertEqual(control_endpt.shape, self.mjhmc_endpt.shape)
+            self.assertEqual(meta['true_var_estimate'], 2.)
+            self.assertTrue(os.path.isdir(init_cache.entry_path(poe)))
+        finally:
+            os.remove(legacy_path)
+            if os.path.isdir(init_cache.entry_path(poe)):
+                shutil.rmtree(init_cache.entry_path(poe))
+
+    def test_eviction(self):
+        """
+        least recently used entries are evicted beyond the byte cap
+        """
+        other = no_cached_init(TestGaussian)(ndims=3, nbatch=10, sigma=np.e)
+        other_path = init_cache.save_initialization(
+            other, self.mjhmc_endpt, self.control_endpt,
+            {'emc_var_estimate': 1., 'true_var_estimate': 2.})
+        max_bytes = init_cache.INIT_CACHE_BYTES
+        init_cache.INIT_CACHE_BYTES = self.mjhmc_endpt.nbytes * 3
+        try:
+            init_cache.get_initialization(self.gaussian)
+            init_cache.get_initialization(other)
+            self.assertEqual(list(init_cache._loaded_inits.keys()),
+                             [init_cache.entry_name(other)])
+        finally:
+            init_cache.INIT_CACHE_BYTES = max_bytes
+            shutil.rmtree(other_path)
@@ -2,13 +2,17 @@
 This module contains unit tests for the theano autocorrelation function
 """
 import unittest
+import tempfile
 import numpy as np
 
 
-from mjhmc.misc.autocor import autocorrelation, slow_autocorrelation, sample_to_df
+from mjhmc.misc.autocor import (autocorrelation, slow_autocorrelation, sample_to_df,
+                                fft_autocor, fast_length, StreamingAutocorrelation,
+                                stream_autocorrelation, memmap_autocor)
 
 from mjhmc.misc.distributions import Gaussian, MultimodalGaussian
 from mjhmc.samplers.markov_jump_hmc import MarkovJumpHMC
+from mjhmc.tests.helpers import no_cached_init
 
 # default is 1E-8
 TOL = 1E-7
@@ -73,3 +77,106 @@ class TestFastAutocorrelation(unittest.TestCase):
         fast_ac_df = autocorrelation(sample_df)
         fast_ac = fast_ac_df.autocorrelation.as_matrix()
         self.assertTrue(np.isclose(slow_ac, fast_ac, atol=TOL).all())
+
+
+def ar1_samples(n_dims=5, n_batch=4, n_samples=500, rho=0.9):
+    """ returns zero mean AR(1) sequences - [n_dims, n_batch, n_samples]
+    """
+    samples = np.zeros((n_dims, n_batch, n_samples))
+    noise = np.random.randn(n_dims, n_batch, n_samples)
+    for t_idx in xrange(1, n_samples):
+        samples[:, :, t_idx] = rho * samples[:, :, t_idx - 1] + noise[:, :, t_idx]
+    return samples
+
+
+class TestFFTAutocorrelation(unittest.TestCase):
+    """
+    Test class for the zero padded FFT autocorrelation
+    """
+
+    def setUp(self):
+        np.random.seed(2015)
+        self.samples = ar1_samples()
+        self.slow_ac = slow_autocorrelation(self.samples, None, None)[0]
+
+    def test_fast_length(self):
+        """ fast lengths are the smallest 5-smooth numbers at least as large
+        """
+        self.assertEqual([fast_length(n) for n in [1, 7, 17, 97, 1025, 2001]],
+                         [1, 8, 18, 100, 1080, 2025])
+
+    def test_matches_slow(self):
+        """ matches slow_autocorrelation at every lag, in one chunk or one dimension at a time
+        """
+        fast_ac = fft_autocor(self.samples)
+        self.assertEqual(fast_ac.shape, (self.samples.shape[-1],))
+        self.assertTrue(np.allclose(fast_ac[:len(self.slow_ac)], self.slow_ac, atol=TOL))
+        chunked_ac = fft_autocor(self.samples, max_lag=50, chunk_bytes=1)
+        self.assertTrue(np.allclose(chunked_ac, self.slow_ac[:51], atol=TOL))
+
+    def test_memmap(self):
+        """ a memory-mapped archive, read in chunks by a thread pool, matches the array in memory
+        """
+        with tempfile.NamedTemporaryFile(suffix='.dat') as archive:
+            mapped = np.memmap(archive.name, dtype=np.float32, mode='w+', shape=self.samples.shape)
+            mapped[:] = self.samples
+            mapped.flush()
+            del mapped
+            mapped_ac = memmap_autocor(archive.name, self.samples.shape, sample_dtype=np.float32,
+                                       max_lag=50, chunk_bytes=1, n_threads=3)
+        in_memory_ac = fft_autocor(self.samples.astype(np.float32), max_lag=50)
+        self.assertTrue(np.allclose(mapped_ac, in_memory_ac, atol=TOL))
+
+    def test_single_precision(self):
+        """ single precision transforms are accurate to single precision
+        """
+        fast_ac = fft_autocor(self.samples, max_lag=50, dtype=np.float32)
+        self.assertTrue(np.allclose(fast_ac, self.slow_ac[:51], atol=1e-5))
+
+
+class TestStreamingAutocorrelation(unittest.TestCase):
+    """
+    Test class for the streaming autocorrelation accumulator
+    """
+
+    def setUp(self):
+        np.random.seed(2015)
+        self.samples = ar1_samples(n_samples=300)
+        self.max_lag = 40
+        self.fft_ac = fft_autocor(self.samples, max_lag=self.max_lag)
+
+    def test_update(self):
+        """ adding samples one at a time matches fft_autocor, including before max_lag samples
+        """
+        accumulator = StreamingAutocorrelation(5, 4, self.max_lag)
+        for t_idx in xrange(self.samples.shape[-1]):
+            accumulator.update(self.samples[:, :, t_idx])
+            if t_idx == 10:
+                early_ac = fft_autocor(self.samples[:, :, :11])
+                self.assertTrue(np.allclose(accumulator.autocorrelation(), early_ac, atol=TOL))
+        self.assertTrue(np.allclose(accumulator.autocorrelation(), self.fft_ac, atol=TOL))
+
+    def test_update_block(self):
+        """ adding blocks shorter and longer than max_lag, mixed with single samples,
+        matches fft_autocor
+        """
+        accumulator = StreamingAutocorrelation(5, 4, self.max_lag)
+        start = 0
+        for n_block in [7, 1, 60, 13, 100]:
+            accumulator.update_block(self.samples[:, :, start:start + n_block])
+            start += n_block
+            accumulator.update(self.samples[:, :, start])
+            start += 1
+        accumulator.update_block(self.samples[:, :, start:])
+        self.assertEqual(accumulator.n_seen, self.samples.shape[-1])
+        self.assertTrue(np.allclose(accumulator.autocorrelation(), self.fft_ac, atol=TOL))
+
+    def test_stream_sampler(self):
+        """ streaming a sampler returns an autocorrelation for each lag, starting at 1
+        """
+        autocor, e_evals, grad_evals = stream_autocorrelation(
+            MarkovJumpHMC, no_cached_init(Gaussian)(nbatch=10), 20, num_steps=100)
+        self.assertEqual(autocor.shape, (21,))
+        self.assertEqual(grad_evals.shape, (21,))
+        self.assertEqual(autocor[0], 1.)
+        self.assertTrue(np.all(np.diff(grad_evals) >= 0))
@@ -0,0 +1,157 @@
+"""
+This module contains unit tests for the theano Markov jump HMC kernel in mjhmc.fast.hmc
+They are checked against the numpy MarkovJumpHMC, and skipped if theano is not installed
+"""
+import unittest
+import numpy as np
+
+try:
+    import theano
+    import theano.tensor as T
+    from theano.tensor.shared_randomstreams import RandomStreams
+    from mjhmc.fast.hmc import MJHMC_accept, mjhmc_move, mjhmc_scan
+except ImportError:
+    theano = None
+
+from mjhmc.misc.distributions import Gaussian
+from mjhmc.samplers.markov_jump_hmc import MarkovJumpHMC
+from mjhmc.samplers.hmc_state import HMCState
+from mjhmc.tests.helpers import no_cached_init
+
+n_seed = 2015
+n_steps = 5
+# default is 1E-8
+TOL = 1E-6
+
+
+@unittest.skipIf(theano is None, 'theano is not installed')
+class TestFastMJHMC(unittest.TestCase):
+    """
+    Test class for the theano MJHMC kernel
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        self.s_rng = RandomStreams(n_seed)
+        self.gaussian = no_cached_init(Gaussian)(ndims=2, nbatch=4, log_conditioning=1)
+        self.sampler = MarkovJumpHMC(distribution=self.gaussian, epsilon=0.3,
+                                     num_leapfrog_steps=n_steps, beta=0.05)
+        self.precision = self.gaussian.precision.reshape((-1, 1))
+
+    def energy_fn(self, pos):
+        """ symbolic energy of self.gaussian
+        """
+        return 0.5 * (self.precision * pos ** 2).sum(axis=0)
+
+    def np_state(self, pos, vel):
+        """ numpy state of the sampler at pos and vel, with an empty ladder cache
+        """
+        return HMCState(pos.copy(), self.sampler, V=vel.copy())
+
+    def test_accept_rates(self):
+        """ Checks that the transitions and dwelling times drawn by MJHMC_accept follow
+        the rates of the numpy sampler
+        """
+        state = self.np_state(self.sampler.state.X, self.sampler.state.V)
+        l_state = state.copy().L()
+        flf_state = state.copy().FLF()
+        l_rates = self.sampler.transition_rates(state, l_state)[0]
+        flf_rates = self.sampler.transition_rates(state, flf_state)[0]
+        rates = np.vstack((l_rates, flf_rates - np.minimum(flf_rates, l_rates),
+                           self.sampler.p_r * np.ones(self.sampler.nbatch)))
+
+        n_draws = 20000
+        H = T.vector()
+        transition, dwelling_time = MJHMC_accept(H, H - T.log(l_rates) * 2,
+                                                 H - T.log(flf_rates) * 2,
+                                                 self.sampler.p_r, self.s_rng)
+        draw = theano.function([H], [transition, dwelling_time])
+        transitions, dwelling_times = zip(*[draw(state.H()[0]) for _ in xrange(n_draws)])
+        transitions = np.array(transitions)
+        # the dwelling time is exponential with the total rate
+        total_rate = np.sum(rates, axis=0)
+        self.assertTrue(np.allclose(np.mean(dwelling_times, axis=0), 1. / total_rate, rtol=0.05))
+        for t_idx in range(3):
+            freq = np.mean(transitions == t_idx, axis=0)
+            self.assertTrue(np.allclose(freq, rates[t_idx] / total_rate, atol=0.02),
+                            msg='{} != {}'.format(freq, rates[t_idx] / total_rate))
+
+    def test_scan_steps(self):
+        """ Checks a few iterations of mjhmc_scan against the L, F, R and FLF
+        states of the numpy sampler, including the iterations that read the FLF cache
+        """
+        n_iterations = 20
+        pos, vel, flf_pos, flf_vel = [T.matrix() for _ in range(4)]
+        flf_cached = T.bvector()
+        outputs, scan_updates = mjhmc_scan(self.s_rng, pos, vel, flf_pos, flf_vel, flf_cached,
+                                           self.energy_fn, T.constant(self.sampler.epsilon),
+                                           T.constant(n_steps), T.constant(self.sampler.p_r),
+                                           n_iterations)
+        simulate = theano.function([pos, vel, flf_pos, flf_vel, flf_cached], outputs,
+                                   updates=scan_updates)
+
+        X, V = self.sampler.state.X.copy(), self.sampler.state.V.copy()
+        nbatch = X.shape[1]
+        (all_pos, all_vel, all_flf_pos, all_flf_vel, all_flf_cached,
+         dwelling_times, transitions, n_grads, samples) = simulate(
+             X, V, np.zeros_like(X), np.zeros_like(V), np.zeros(nbatch, dtype='int8'))
+
+        prev_cached = np.zeros(nbatch, dtype=bool)
+        for idx in xrange(n_iterations):
+            self.assertTrue(np.allclose(samples[idx], X, atol=TOL))
+            state = self.np_state(X, V)
+            l_state = state.copy().L()
+            is_l = transitions[idx] == 0
+            is_f = transitions[idx] == 1
+            is_r = transitions[idx] == 2
+            self.assertTrue(np.all(is_l | is_f | is_r))
+            self.assertTrue(np.all(dwelling_times[idx] > 0))
+            # every gradient of the FLF trajectory is saved when all of the particles are cached
+            expected_grads = (n_steps + 1) * (1 if np.all(prev_cached) else 2)
+            self.assertEqual(n_grads[idx], expected_grads)
+
+            self.assertTrue(np.allclose(all_pos[idx][:, is_l], l_state.X[:, is_l], atol=TOL))
+            self.assertTrue(np.allclose(all_vel[idx][:, is_l], l_state.V[:, is_l], atol=TOL))
+            self.assertTrue(np.allclose(all_pos[idx][:, ~is_l], X[:, ~is_l], atol=TOL))
+            self.assertTrue(np.allclose(all_vel[idx][:, is_f], -V[:, is_f], atol=TOL))
+            # the FLF state of the new state is read from the cache after an L transition
+            new_state = self.np_state(all_pos[idx], all_vel[idx])
+            flf_state = new_state.copy().FLF()
+            self.assertTrue(np.array_equal(all_flf_cached[idx].astype(bool), is_l))
+            self.assertTrue(np.allclose(all_flf_pos[idx][:, is_l], flf_state.X[:, is_l], atol=TOL))
+            self.assertTrue(np.allclose(all_flf_vel[idx][:, is_l], flf_state.V[:, is_l], atol=TOL))
+
+            prev_cached = is_l
+            # the randomized momentum can only be read from the kernel
+            X, V = all_pos[idx], all_vel[idx]
+
+        # the steps covered both the integrated and the cached FLF path
+        self.assertTrue(np.any(n_grads == n_steps + 1))
+        self.assertTrue(np.any(n_grads == 2 * (n_steps + 1)))
+
+    def test_flf_cache(self):
+        """ Checks that mjhmc_move draws the same transitions when the FLF state
+        is read from the cache as when it is integrated
+        """
+        pos, vel, flf_pos, flf_vel = [T.matrix() for _ in range(4)]
+        flf_cached = T.bvector()
+        outputs = mjhmc_move(self.s_rng, pos, vel, flf_pos, flf_vel, flf_cached,
+                             self.energy_fn, T.constant(self.sampler.epsilon),
+                             T.constant(n_steps), T.constant(self.sampler.p_r))
+        move = theano.function([pos, vel, flf_pos, flf_vel, flf_cached], outputs)
+
+        state = self.np_state(self.sampler.state.X, self.sampler.state.V)
+        flf_state = state.copy().FLF()
+        nbatch = state.X.shape[1]
+        self.s_rng.seed(n_seed)
+        integrated = move(state.X, state.V, np.zeros_like(state.X), np.zeros_like(state.V),
+                          np.zeros(nbatch, dtype='int8'))
+        self.s_rng.seed(n_seed)
+        cached = move(state.X, state.V, flf_state.X, flf_state.V,
+                      np.ones(nbatch, dtype='int8'))
+
+        # new positions, velocities, dwelling times and transitions
+        for out_idx in [0, 1, 5, 6]:
+            self.assertTrue(np.allclose(integrated[out_idx], cached[out_idx], atol=TOL))
+        self.assertEqual(integrated[7], 2 * (n_steps + 1))
+        self.assertEqual(cached[7], n_steps + 1)
@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+from mjhmc.misc.gen_mj_init import Moments, Snapshot
+
+n_seed = 1
+ndims = 4
+nbatch = 30
+n_blocks = 50
+
+class TestMoments(unittest.TestCase):
+    """test that the streaming moments match the batch estimates
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        scales = np.arange(1, ndims + 1).reshape((-1, 1, 1))
+        # [ndims, nbatch, n_blocks]
+        self.samples = scales * np.random.randn(ndims, nbatch, n_blocks) + 3.
+
+    def test_blocks(self):
+        """
+        per coordinate and pooled variances match np.var over all of the samples
+        """
+        moments = Moments()
+        for block_idx in xrange(n_blocks):
+            moments.update(self.samples[:, :, block_idx])
+        flat = self.samples.reshape((ndims, -1))
+        self.assertTrue(np.allclose(moments.mean, np.mean(flat, axis=1)))
+        self.assertTrue(np.allclose(moments.coordinate_variance, np.var(flat, axis=1, ddof=1)))
+        self.assertTrue(np.isclose(moments.variance, np.var(flat, ddof=1)))
+
+    def test_merge_shards(self):
+        """
+        merging the moments of particle shards matches a single accumulator
+        """
+        full = Moments()
+        shards = [Moments(), Moments(), Moments()]
+        bounds = [0, 7, 20, nbatch]
+        for block_idx in xrange(n_blocks):
+            block = self.samples[:, :, block_idx]
+            full.update(block)
+            for shard, start, stop in zip(shards, bounds[:-1], bounds[1:]):
+                shard.update(block[:, start:stop])
+        merged = Moments()
+        for shard in shards:
+            merged.merge(shard)
+        self.assertEqual(merged.count, full.count)
+        self.assertTrue(np.allclose(merged.coordinate_variance, full.coordinate_variance))
+        self.assertTrue(np.isclose(merged.variance, full.variance))
+
+
+class FakeState(object):
+    def __init__(self, X):
+        self.X = X
+        self.EX = np.sum(X ** 2, axis=0).reshape((1, -1)) / 2.
+
+class FakeSampler(object):
+    def __init__(self, X):
+        self.state = FakeState(X)
+
+class TestSnapshot(unittest.TestCase):
+    """test the stationarity diagnostic used to end burn in
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+
+    def test_stationary(self):
+        """
+        independent draws from the same distribution agree
+        """
+        earlier = Snapshot(FakeSampler(np.random.randn(ndims, 1000)))
+        later = Snapshot(FakeSampler(np.random.randn(ndims, 1000)))
+        self.assertTrue(later.agrees_with(earlier))
+
+    def test_drifting(self):
+        """
+        a change of scale or strongly correlated particles are detected
+        """
+        X = np.random.randn(ndims, 1000)
+        earlier = Snapshot(FakeSampler(X))
+        wider = Snapshot(FakeSampler(1.2 * np.random.randn(ndims, 1000)))
+        stuck = Snapshot(FakeSampler(X + 0.1 * np.random.randn(ndims, 1000)))
+        self.assertFalse(wider.agrees_with(earlier))
+        self.assertFalse(stuck.agrees_with(earlier))
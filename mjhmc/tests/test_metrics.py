@@ -0,0 +1,79 @@
+import unittest
+import numpy as np
+from mjhmc.misc.autocor import fft_autocor
+from mjhmc.misc.metrics import (integrated_autocorrelation_time, chain_autocorrelation,
+                                effective_sample_size, bulk_ess, tail_ess,
+                                sample_metrics, autocor_metrics)
+
+n_seed = 1
+
+
+def ar1_samples(rho, n_batch=8, n_samples=4000):
+    """ returns AR(1) sequences with coefficient rho[d] in dimension d
+    their integrated autocorrelation time is (1 + rho) / (1 - rho)
+    """
+    rho = np.asarray(rho, dtype=float).reshape((-1, 1))
+    samples = np.zeros((len(rho), n_batch, n_samples))
+    noise = np.random.randn(len(rho), n_batch, n_samples)
+    for t_idx in xrange(1, n_samples):
+        samples[:, :, t_idx] = rho * samples[:, :, t_idx - 1] + noise[:, :, t_idx]
+    return samples
+
+
+class TestMetrics(unittest.TestCase):
+    """ checks the autocorrelation time and ESS estimators on AR(1) sequences
+    """
+
+    def setUp(self):
+        np.random.seed(n_seed)
+        self.rho = np.array([0., 0.5, 0.9, -0.5])
+        self.tau = (1 + self.rho) / (1 - self.rho)
+        self.samples = ar1_samples(self.rho)
+
+    def test_geyer_exact(self):
+        """
+        the initial sequence estimators recover the time of an exact autocorrelation,
+        and ignore the noise after the first non positive pair
+        """
+        lags = np.arange(100)
+        autocor = 0.8 ** lags
+        autocor[60:62] = -0.01
+        autocor[62:] = np.abs(np.random.randn(38)) * 0.01
+        tau = integrated_autocorrelation_time(np.vstack((autocor, autocor)))
+        self.assertTrue(np.allclose(tau, 9., atol=1e-3))
+        self.assertTrue(np.allclose(integrated_autocorrelation_time(autocor, monotone=False),
+                                    9., atol=1e-3))
+
+    def test_ar1(self):
+        """
+        autocorrelation times and ESS match those of AR(1) sequences in every dimension
+        """
+        tau = integrated_autocorrelation_time(chain_autocorrelation(self.samples, 200))
+        self.assertTrue(np.allclose(tau, self.tau, rtol=0.1), msg='{} != {}'.format(tau, self.tau))
+        n_total = np.prod(self.samples.shape[1:])
+        for ess in [effective_sample_size(self.samples), bulk_ess(self.samples)]:
+            self.assertTrue(np.allclose(ess, n_total / self.tau, rtol=0.1),
+                            msg='{} != {}'.format(ess, n_total / self.tau))
+        self.assertTrue(np.all(tail_ess(self.samples) > 0))
+
+    def test_not_mixing(self):
+        """
+        chains stuck in different places have a small bulk ESS
+        """
+        stuck = self.samples.copy()
+        stuck[:, :4] += 3.
+        self.assertTrue(np.all(bulk_ess(stuck) < 0.05 * bulk_ess(self.samples)))
+
+    def test_summaries(self):
+        """
+        the summaries use the worst dimension, and agree with the mean autocorrelation
+        of a single dimension
+        """
+        metrics = sample_metrics(self.samples, grad_evals=1000., run_time=2.)
+        self.assertTrue(np.isclose(metrics['tau_int'], self.tau[2], rtol=0.1))
+        self.assertTrue(np.isclose(metrics['ess_per_second'], metrics['bulk_ess'] / 2.))
+        n_samples = self.samples.shape[-1]
+        autocor = fft_autocor(self.samples[1:2])
+        metrics = autocor_metrics(autocor, np.arange(1, n_samples + 1) * 5.)
+        self.assertTrue(np.isclose(metrics['tau_int'], self.tau[1], rtol=0.1))
+        self.assertTrue(np.isclose(metrics['ess_per_grad'], 1. / (5. * metrics['tau_int'])))
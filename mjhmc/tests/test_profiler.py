@@ -0,0 +1,77 @@
+import unittest
+import shutil
+import tempfile
+from mjhmc.misc.profiler import SamplingProfiler
+
+
+class FakeNodeStats(object):
+    def __init__(self, node_name, micros):
+        self.node_name = node_name
+        self.all_end_rel_micros = micros
+
+
+class FakeDevStats(object):
+    def __init__(self, device, node_stats):
+        self.device = device
+        self.node_stats = node_stats
+
+
+class FakeStepStats(object):
+    """ stands in for the StepStats protobuf of a traced run
+    """
+
+    def __init__(self, dev_stats=None):
+        self.dev_stats = list(dev_stats or [])
+
+    def MergeFrom(self, other):
+        self.dev_stats.extend(other.dev_stats)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    """ checks the sampling and aggregation of the profiler
+    """
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.profiler = SamplingProfiler('test', every=3, max_traces=2, log_dir=self.log_dir,
+                                         write_at_exit=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def run_profiler(self, n_runs):
+        for _ in xrange(n_runs):
+            if self.profiler.should_trace('grad'):
+                step_stats = FakeStepStats([FakeDevStats('cpu', [FakeNodeStats('matmul', 30),
+                                                                 FakeNodeStats('add', 10)])])
+                self.profiler.record('grad', 0.1, step_stats)
+            else:
+                self.profiler.record('grad', 0.01)
+
+    def test_sampling(self):
+        """
+        every Nth run is traced, and only max_traces traces are merged
+        """
+        self.run_profiler(10)
+        self.assertEqual(self.profiler.n_runs['grad'], 10)
+        self.assertEqual(self.profiler.n_traced['grad'], 4)
+        self.assertEqual(self.profiler.n_merged, 2)
+        self.assertEqual(len(self.profiler.step_stats.dev_stats), 2)
+
+    def test_time_budget(self):
+        """
+        tracing stops once the budget of traced time is spent
+        """
+        self.profiler.time_budget = 0.15
+        self.run_profiler(10)
+        self.assertEqual(self.profiler.n_traced['grad'], 2)
+
+    def test_summary(self):
+        """
+        op timings are aggregated across traced runs, slowest first
+        """
+        self.run_profiler(4)
+        self.assertEqual(self.profiler.summary(),
+                         [('grad', 'cpu', 'matmul', 2, 0.06, 0.03),
+                          ('grad', 'cpu', 'add', 2, 0.02, 0.01)])
+        self.assertTrue('matmul' in self.profiler.summary_table())
@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from mjhmc.misc.utils import min_idx
+from mjhmc.misc.utils import min_idx, stable_digest
 
 n_seed = 1
 list_length = 100
@@ -51,3 +51,33 @@ class TestMinIdx(unittest.TestCase):
         self.assertTrue((mi_1_test == mi_1_control).all(), "idx minimums do not match")
         self.assertTrue((mi_2_test == mi_2_control).all(), "idx minimums do not match")
         self.assertTrue((mi_3_test == mi_3_control).all(), "idx minimums do not match")
+
+
+class TestStableDigest(unittest.TestCase):
+    """test that stable digest only depends on the contents of its argument
+    """
+
+    def test_across_processes(self):
+        """
+        digests of strings agree between processes with different hash seeds
+        """
+        import os
+        import subprocess
+        import sys
+        params = ('name', 3, 0.5, np.arange(4.))
+        script = ("import numpy as np; from mjhmc.misc.utils import stable_digest; "
+                  "print(stable_digest(('name', 3, 0.5, np.arange(4.))))")
+        for seed in ['1', '2']:
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            digest = subprocess.check_output([sys.executable, '-c', script], env=env).strip()
+            self.assertEqual(digest.decode('ascii'), stable_digest(params))
+
+    def test_contents(self):
+        """
+        equal contents give equal digests and different contents different digests
+        """
+        arr = np.random.randn(3, 4)
+        self.assertEqual(stable_digest((1, arr)), stable_digest((1, arr.copy())))
+        self.assertNotEqual(stable_digest((1, arr)), stable_digest((1, arr.T)))
+        self.assertNotEqual(stable_digest(('ab', 'c')), stable_digest(('a', 'bc')))
+        self.assertNotEqual(stable_digest((1, 2)), stable_digest(((1, 2),)))